@@ -19,6 +19,7 @@ from .__version__ import __version__
 from .pirecorder import *
 from .camconfig import Camconfig
 from .convert import Convert
+from .imgpack import ImagePack
 from .schedule import Schedule
 from .stream import Stream
 from .videoin import VideoIn
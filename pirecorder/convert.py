@@ -25,16 +25,75 @@ import time
 import glob
 import argparse
 import subprocess
+import numpy as np
 
-from threading import Thread
+from queue import Queue, Empty, Full
+from types import SimpleNamespace
+from threading import Thread, Event
+from collections import deque
 from multiprocess import Pool
+from multiprocess.pool import ThreadPool
 from pythutils.sysutils import lineprint
-from pythutils.drawutils import draw_text
 from pythutils.fileutils import listfiles, get_ext, commonpref, move
-from pythutils.mediautils import get_vid_params, videowriter, imgresize
+from pythutils.mediautils import videowriter, imgresize
+
+from .h264 import accessunits, framecount, splitfile
+from .imgpack import ImagePack
+from .ledger import Ledger
+from .mp4mux import MP4Muxer
+from .overlay import NumberOverlay
+from .sidecar import readframes, sidecarname
+from .watch import DirWatcher
 
 class KeyboardInterruptError(Exception): pass
 
+
+def partname(fileout):
+
+    """
+    Returns the name of the hidden temporary file that is written before it is
+    renamed to fileout, such that unfinished files are never mistaken for
+    converted files
+    """
+
+    dirname, basename = os.path.split(fileout)
+
+    return os.path.join(dirname, "."+basename+".part")
+
+
+def framerate(times, default = 24.):
+
+    """
+    Returns the framerate of a video from the timestamps of its frames in
+    microseconds, ignoring unknown (negative) timestamps, or default if it
+    can not be determined
+    """
+
+    times = np.asarray(times)
+    steps = np.diff(times[times >= 0])
+    if len(steps) == 0 or np.median(steps) <= 0:
+        return default
+
+    return 1000000. / np.median(steps)
+
+
+def ffmpegwriter(fileout, w, h, fps, preset = "veryfast"):
+
+    """
+    Starts an FFmpeg process that encodes raw bgr frames written to its stdin
+    to a h264 mp4 file
+    """
+
+    comm = ["ffmpeg", "-y", "-nostats", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "%dx%d" % (w, h),
+            "-r", str(fps), "-i", "-",
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v", "libx264", "-preset", preset, "-pix_fmt", "yuv420p",
+            "-f", "mp4", fileout]
+
+    return subprocess.Popen(comm, stdin = subprocess.PIPE)
+
+
 class Convert:
 
     """
@@ -51,15 +110,26 @@ class Convert:
         Directory where the converted videos should be stored. If the directory
         does not exist yet it will be newly created.
     type : str, default = ".h264"
-        The filetype of the media to convert.
-    withframe : bool, default = False
+        The filetype of the media to convert. Use ".mjpeg" to convert image
+        sequences that were stored in a single packed file to video.
+    withframe : bool or "track", default = False
         Type of conversion, either very fast conversion using FFmpeg or using
-        OpenCV to draw the frame number on each video frame.
+        OpenCV to draw the frame number on each video frame. Frames with their
+        number drawn are encoded by FFmpeg with the provided preset. With
+        "track" the video is converted as fast as without frame numbers, and
+        the frame numbers are added as a subtitle track that players and
+        analysis tools can show or read.
+        Without frame numbers, raw h264 videos that have a sidecar file with
+        the timestamps of each frame (.h264.frames) are converted with the
+        exact timing of the recording, such that videos with dropped frames
+        or a variable framerate keep their true duration.
     delete : bool, default = False
         If the original videos should be deleted or not.
     pools : int, default = 4
         Number of simultaneous converting processing that should be allowed.
         Works optimally when equal to the number of computer processing cores.
+        When converting an image sequence it sets the number of threads that
+        decode images in parallel.
     resizeval : float, default = 1
         Float value to which the video should be resized.
     imgfps : int, default = 25
@@ -67,19 +137,47 @@ class Convert:
     sleeptime : int, default = None
         Time in seconds between subsequent checks for files within a folder. The
         default value (None) only converts the current files.
+    prefetch : int, default = 8
+        Number of images that are read ahead of the video writer when
+        converting an image sequence. Images are streamed from disk so memory
+        use stays constant regardless of the length of the image sequence. At
+        least as many images as pools are read ahead.
+    preset : str, default = "veryfast"
+        The FFmpeg x264 preset used to encode videos when withframe is True.
+        Faster presets convert quicker at the cost of larger files.
+    watch : bool, default = False
+        If the folder should be continuously monitored for new videos after
+        converting the current files. Instead of rechecking the folder every
+        sleeptime seconds, videos are converted as soon as they are closed
+        after writing, using linux inotify and a persistent pool of processes.
+    splitsize : int, default = 0
+        If larger than 0, raw h264 videos that need to be re-encoded (when
+        resizing or drawing frame numbers) and that are larger than splitsize
+        MB are split at keyframes into chunks of about splitsize MB. These
+        chunks are converted in parallel and joined losslessly, such that
+        large single videos also make use of all processing cores.
+    ledger : bool, default = False
+        If a ledger of all converted videos should be kept in the outdir
+        ("convert_ledger.jsonl"), storing for each video the output file,
+        conversion parameters, duration and status. Videos are then only
+        skipped if they were converted succesfully with the same parameters
+        and the output is unchanged, rather than when a video with the same
+        name exists in the outdir.
     """
 
     def __init__(self, indir = "", outdir = "", type = ".h264",
                  withframe = False, overwrite = False, delete = False,
                  pools = 4, resizeval = 1, fps = None, imgfps = 25,
-                 internal = False, sleeptime = None):
+                 internal = False, sleeptime = None, prefetch = 8,
+                 preset = "veryfast", watch = False, splitsize = 0,
+                 ledger = False):
 
         if internal:
             lineprint("Running convert function..", label="pirecorder")
 
-        self.indir = os.getcwd() if indir == "" else indir
+        self.indir = os.getcwd() if indir == "" else os.path.abspath(indir)
         assert os.path.exists(self.indir), "in-directory does not exist.."
-        self.outdir = self.indir if outdir == "" else outdir
+        self.outdir = self.indir if outdir == "" else os.path.abspath(outdir)
         if not os.path.exists(self.outdir):
             os.makedirs(self.outdir)
 
@@ -93,20 +191,37 @@ class Convert:
         self.resizeval = float(resizeval)
         self.fps = int(fps) if fps is not None else None
         self.imgfps = int(imgfps)
+        self.prefetch = max(1, int(prefetch))
+        self.preset = preset
+        self.splitsize = float(splitsize)
         self.terminated = False
+        self.params = {"type": self.type, "withframe": self.withframe,
+                       "resizeval": self.resizeval, "fps": self.fps,
+                       "preset": self.preset}
+        self.ledger = None
+        if ledger and self.type in [".h264",".mp4",".avi"]:
+            self.ledger = Ledger(os.path.join(self.outdir, "convert_ledger.jsonl"))
+
+        if watch and self.type not in [".h264",".mp4",".avi"]:
+            lineprint("Watching a folder only works for videos..", label="pirecorder")
+            watch = False
 
         while True:
             files = listfiles(self.indir, self.type, keepdir = False)
-            old = listfiles(self.indir, self.type, keepext = False)
-            new = listfiles(self.outdir, ".mp4", keepext = False)
+            new = set(listfiles(self.outdir, ".mp4", keepext = False))
             self.todo = files
-            if not overwrite:
-                self.todo = [files[i] for i,file in enumerate(old) if file not in new]
+            if self.ledger is not None and not overwrite:
+                self.todo = [f for f in files if not self.ledger.isdone(f, self.params)]
+            elif not overwrite:
+                self.todo = [f for f in files if os.path.splitext(f)[0] not in new]
             if self.type in [".jpg",".jpeg",".png"] and len(self.todo)>0:
                  if len([f for f in new if commonpref(self.todo) in f])>0 and not overwrite:
                      self.todo = []
             self.convertpool()
             msg = "No files to convert.."
+            if watch and not self.terminated:
+                self.watchdir(overwrite)
+                return
             if sleeptime == None:
                 if not self.terminated:
                     lineprint(msg, label="pirecorder")
@@ -122,45 +237,540 @@ class Convert:
     def conv_single(self, filein):
 
         try:
+            start = time.time()
             filebase = os.path.basename(filein)
-            fileout = filein if self.outdir == "" else self.outdir+"/"+filebase
+            fileout = self.outname(filein)
+            tmpout = partname(fileout)
             lineprint("Start converting "+filebase, label="pirecorder")
 
-            if self.withframe:
-                vid = cv2.VideoCapture(filein)
-                fps, width, height, _ = get_vid_params(vid)
-                if self.fps is None:
-                    self.fps = fps
-                vidout = videowriter(fileout, width, height, self.fps, self.resizeval)
+            self.conv_file(filein, tmpout)
+            os.rename(tmpout, fileout)
+            if self.ledger is not None:
+                self.ledger.record(filein, fileout, self.params,
+                                   time.time()-start, "done")
+            lineprint("Finished converting "+filebase, label="pirecorder")
+
+            return filein, os.getpid(), start, time.time()
+
+        except KeyboardInterrupt:
+            raise KeyboardInterruptError()
+
+        except Exception:
+            if os.path.exists(tmpout):
+                os.remove(tmpout)
+            if self.ledger is not None:
+                self.ledger.record(filein, fileout, self.params,
+                                   time.time()-start, "failed")
+            raise
+
+
+    def outname(self, filein):
+
+        """Returns the name of the converted video"""
+
+        filebase = os.path.basename(filein)
+        fileout = filein if self.outdir == "" else self.outdir+"/"+filebase
+
+        return fileout[:-len(self.type)]+".mp4"
+
+
+    def conv_file(self, filein, fileout, startframe = 1, track = True):
+
+        """
+        Converts a single video, or chunk of a video, to mp4. The number of
+        the first frame is used for drawing frame numbers, and track sets if
+        the frame number subtitle track should be added.
+        """
+
+        if self.withframe and self.withframe != "track":
+            self.conv_frames(filein, fileout, startframe)
+
+        elif not self.withframe and self.conv_timed(filein, fileout):
+            pass
 
+        else:
+            fpscom = str(self.fps) if self.fps is not None else str(24)
+            bashcomm = "ffmpeg -r "+fpscom+" -i '"+filein+"'"
+            track = track and self.withframe == "track"
+            if track:
+                srtfile = fileout+".srt"
+                self.frametrack(filein, srtfile, float(fpscom))
+                bashcomm = bashcomm+" -i '"+srtfile+"' -map 0:v -map 1:s"+\
+                           " -c:s mov_text -metadata:s:s:0 title=frame"
+            if self.resizeval != 1:
+                bashcomm = bashcomm+" -vf 'scale=iw*"+str(self.resizeval)+":-2'"
+            else:
+                bashcomm = bashcomm+" -vcodec copy"
+            bashcomm = bashcomm+" -f mp4 '"+fileout+"'"
+            bashcomm = bashcomm + " -y -nostats -loglevel 0"
+            output = subprocess.check_output(['bash','-c', bashcomm])
+            if track:
+                os.remove(srtfile)
+
+
+    def conv_timed(self, filein, fileout):
+
+        """
+        Converts a raw h264 video to mp4 using the timestamps of each frame
+        from its sidecar file. The h264 frames are muxed as they are, or
+        first resized by FFmpeg. A sidecar with fewer records than frames
+        that was modified in the last seconds is first given time to be
+        completed. Returns False if the video has no sidecar file or the
+        sidecar does not match the frames of the video.
+        """
+
+        framesfile = sidecarname(filein)
+        if self.type != ".h264" or not os.path.exists(framesfile):
+            return False
+        times = np.array(readframes(framesfile)["timestamp"])
+        # Give a sidecar that is still being written, e.g. when converting
+        # while recording, a moment to be completed
+        frames = framecount(filein)
+        while len(times) < frames and time.time() - os.path.getmtime(framesfile) < 5:
+            time.sleep(0.2)
+            times = np.array(readframes(framesfile)["timestamp"])
+        fps = framerate(times, float(self.fps) if self.fps is not None else 24.)
+
+        source = filein
+        if self.resizeval != 1:
+            source = fileout+".h264"
+            subprocess.check_call(["ffmpeg", "-y", "-nostats", "-loglevel", "error",
+                                   "-r", str(fps), "-i", filein, "-vf",
+                                   "scale=iw*"+str(self.resizeval)+":-2",
+                                   "-c:v", "libx264", "-preset", self.preset,
+                                   "-bf", "0", "-vsync", "0",
+                                   "-f", "h264", source])
+        try:
+            units = list(accessunits(source))
+            if len(units) != len(times):
+                lineprint("Frames of "+os.path.basename(filein)+" do not match"+\
+                          " its sidecar, converting with a fixed framerate..",
+                          label="pirecorder")
+                return False
+            with open(source, "rb") as f, open(fileout, "wb") as out:
+                muxer = MP4Muxer(out, fps)
+                for (offset, size, _), timestamp in zip(units, times):
+                    f.seek(offset)
+                    frame = SimpleNamespace(complete = True, frame_type = 0,
+                            timestamp = int(timestamp) if timestamp >= 0 else None)
+                    muxer.write(f.read(size), frame)
+                muxer.close()
+        finally:
+            if source != filein and os.path.exists(source):
+                os.remove(source)
+
+        return True
+
+
+    def splitjobs(self, files, chunks):
+
+        """
+        Generator of conversion jobs. Raw h264 videos that need re-encoding and
+        are larger than splitsize are split at keyframes into chunks that are
+        converted as separate jobs, stored in chunks by video name. Other
+        videos are a single job.
+        """
+
+        reencode = self.resizeval != 1 or self.withframe not in [False, "track"]
+        for filein in files:
+            parts = []
+            timed = not self.withframe and os.path.exists(sidecarname(filein))
+            if self.splitsize > 0 and reencode and self.type == ".h264" and \
+               not timed and os.path.getsize(filein) > 1.5 * self.splitsize * 1000000:
+                prefix = os.path.dirname(self.outname(filein)) + "/." + \
+                         os.path.basename(filein)[:-len(self.type)]
+                parts = splitfile(filein, self.splitsize * 1000000, prefix)
+            if len(parts) == 0:
+                yield filein
+                continue
+            lineprint("Split "+os.path.basename(filein)+" into "+str(len(parts))+\
+                      " chunks..", label="pirecorder")
+            chunks[filein] = [chunk[:-len(".h264")]+".mp4" for chunk, _ in parts]
+            for chunk, frame in parts:
+                yield (filein, chunk, frame+1)
+
+
+    def conv_chunk(self, job):
+
+        """Converts a single chunk of a video that was split at keyframes"""
+
+        chunkout = None
+        try:
+            start = time.time()
+            filein, chunk, startframe = job
+            chunkout = chunk[:-len(".h264")]+".mp4"
+            self.conv_file(chunk, chunkout, startframe, track = False)
+            os.remove(chunk)
+
+            return job, os.getpid(), start, time.time()
+
+        except KeyboardInterrupt:
+            raise KeyboardInterruptError()
+
+        except Exception:
+            if chunkout is not None and os.path.exists(chunkout):
+                os.remove(chunkout)
+            raise
+
+
+    def conv_job(self, job):
+
+        return self.conv_chunk(job) if isinstance(job, tuple) else self.conv_single(job)
+
+
+    def join(self, filein, chunks, elapsed = 0):
+
+        """
+        Joins the converted chunks of a video losslessly. The time it took
+        to convert the chunks, elapsed, is added to the time of the join in
+        the ledger.
+        """
+
+        start = time.time()
+        fileout = self.outname(filein)
+        tmpout = partname(fileout)
+        listfile = tmpout+".txt"
+        with open(listfile, "w") as f:
+            for chunk in chunks:
+                f.write("file '"+chunk+"'\n")
+
+        comm = ["ffmpeg", "-y", "-nostats", "-loglevel", "error", "-f", "concat",
+                "-safe", "0", "-i", listfile]
+        if self.withframe == "track":
+            fps = float(self.fps) if self.fps is not None else 24.
+            srtfile = self.frametrack(filein, tmpout+".srt", fps)
+            comm += ["-i", srtfile, "-map", "0:v", "-map", "1:s", "-c:s",
+                     "mov_text", "-metadata:s:s:0", "title=frame"]
+        comm += ["-c:v", "copy", "-f", "mp4", tmpout]
+        status = "failed"
+        try:
+            subprocess.check_call(comm)
+            os.rename(tmpout, fileout)
+            status = "done"
+        finally:
+            for tmpfile in chunks + [listfile, tmpout+".srt", tmpout]:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+            if self.ledger is not None:
+                self.ledger.record(filein, fileout, self.params,
+                                   elapsed+time.time()-start, status)
+        lineprint("Finished converting "+os.path.basename(filein), label="pirecorder")
+
+
+    def frametrack(self, filein, fileout, fps):
+
+        """
+        Writes a subtitle file with the frame number of each frame of a video
+        such that it can be muxed as a subtitle track without re-encoding
+        """
+
+        if get_ext(filein) == ".h264":
+            frames = framecount(filein)
+        else:
+            vid = cv2.VideoCapture(filein)
+            frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+            vid.release()
+
+        def srttime(frame):
+            ms = int(round(frame * 1000. / fps))
+            return "%02d:%02d:%02d,%03d" % (ms//3600000, ms//60000%60,
+                                            ms//1000%60, ms%1000)
+
+        with open(fileout, "w") as f:
+            for i in range(frames):
+                f.write("%d\n%s --> %s\n%d\n\n" % (i+1, srttime(i),
+                                                   srttime(i+1), i+1))
+
+        return fileout
+
+
+    def conv_frames(self, filein, fileout, startframe = 1):
+
+        """
+        Converts a video while drawing the frame number on each frame. Frames
+        are decoded, annotated and encoded in three separate threads connected
+        by bounded queues, with encoding done by an FFmpeg process that reads
+        raw frames over a pipe. Prints the throughput of each stage. An error
+        in any stage stops the other stages and is raised. Without fps, the
+        framerate is taken from the sidecar file of the video, or else from
+        the video itself, which for raw h264 is often unknown, or else is 24.
+        """
+
+        vid = cv2.VideoCapture(filein)
+        fps = self.fps
+        if fps is None and os.path.exists(sidecarname(filein)):
+            fps = framerate(readframes(sidecarname(filein))["timestamp"], None)
+        if fps is None:
+            fps = vid.get(cv2.CAP_PROP_FPS)
+            fps = fps if fps > 0 else 24.
+        numberer = NumberOverlay((10,10), 0.9, col="white", shadow=True)
+        decoded = Queue(maxsize = self.prefetch)
+        annotated = Queue(maxsize = self.prefetch)
+        stats = {"decode": [0, 0.], "annotate": [0, 0.], "encode": [0, 0.]}
+        done = object()
+        cancel = Event()
+        errors = []
+
+        def put(queue, item):
+            while not cancel.is_set():
+                try:
+                    queue.put(item, timeout = 0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def get(queue):
+            while not cancel.is_set():
+                try:
+                    return queue.get(timeout = 0.1)
+                except Empty:
+                    pass
+            return done
+
+        def decode():
+            frame_nr = startframe - 1
+            try:
                 while True:
+                    start = time.time()
                     flag, frame = vid.read()
-                    if flag:
-                        if self.resizeval != 1:
-                            frame = imgresize(frame, self.resizeval)
-                        frame_nr = int(vid.get(cv2.CAP_PROP_POS_FRAMES))
-                        draw_text(frame, str(frame_nr), (10,10), 0.9, col="white",
-                                  shadow=True)
-                        vidout.write(frame)
                     if not flag:
                         break
+                    if self.resizeval != 1:
+                        frame = imgresize(frame, self.resizeval)
+                    frame_nr += 1
+                    stats["decode"][0] += 1
+                    stats["decode"][1] += time.time() - start
+                    if not put(decoded, (frame_nr, frame)):
+                        break
+            except Exception as e:
+                errors.append(e)
+            finally:
+                vid.release()
+                put(decoded, done)
+
+        def annotate():
+            try:
+                while True:
+                    item = get(decoded)
+                    if item is done:
+                        break
+                    start = time.time()
+                    frame_nr, frame = item
+                    numberer.draw(frame, frame_nr)
+                    stats["annotate"][0] += 1
+                    stats["annotate"][1] += time.time() - start
+                    if not put(annotated, frame):
+                        break
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put(annotated, done)
+
+        threads = [Thread(target = decode), Thread(target = annotate)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        begin = time.time()
+        encoder = None
+        try:
+            while True:
+                frame = annotated.get()
+                if frame is done:
+                    break
+                if encoder is None:
+                    h, w = frame.shape[:2]
+                    encoder = ffmpegwriter(fileout, w, h, fps, self.preset)
+                start = time.time()
+                try:
+                    encoder.stdin.write(frame.tobytes())
+                except BrokenPipeError:
+                    # FFmpeg exited early, its exit code is raised below
+                    break
+                stats["encode"][0] += 1
+                stats["encode"][1] += time.time() - start
+        finally:
+            # Stop the other stages, which may be waiting on a full queue
+            cancel.set()
+            for thread in threads:
+                thread.join()
+            if encoder is not None:
+                try:
+                    encoder.stdin.close()
+                except BrokenPipeError:
+                    pass
+                encoder.wait()
+        if len(errors) > 0:
+            raise errors[0]
+        if encoder is not None and encoder.returncode != 0:
+            raise RuntimeError("FFmpeg failed encoding "+fileout)
+
+        total = time.time() - begin
+        rates = ["%s %dfps" % (stage, stats[stage][0]/max(stats[stage][1],1e-6))
+                 for stage in ["decode", "annotate", "encode"]]
+        slowest = min(stats, key = lambda k: stats[k][0]/max(stats[k][1],1e-6))
+        lineprint(os.path.basename(filein)+": "+", ".join(rates)+"; overall "+\
+                  str(int(stats["encode"][0]/max(total,1e-6)))+"fps, "+\
+                  slowest+" bound", label="pirecorder")
+
+
+    def readimg(self, filename, pack = None):
+
+        """
+        Reads and potentially resizes a single image, from file or from the
+        position filename in an ImagePack
+        """
+
+        if pack is not None:
+            frame = pack.image(filename)
+            filename = os.path.basename(pack.filename)+" image "+str(filename)
+        else:
+            frame = cv2.imread(filename)
+        if frame is None:
+            lineprint("Could not read "+filename+", skipping..", label="pirecorder")
+        elif self.resizeval != 1:
+            frame = imgresize(frame, self.resizeval)
+
+        return frame
+
+
+    def firstimg(self, files, pack = None):
+
+        """
+        Returns the files from the first image that can be read onwards,
+        together with that image at its original size, skipping unreadable
+        images such as truncated copies. The image is None if no image in
+        files can be read.
+        """
+
+        for i, filename in enumerate(files):
+            frame = pack.image(filename) if pack is not None else cv2.imread(filename)
+            if frame is not None:
+                return files[i:], frame
+            name = os.path.basename(pack.filename)+" image "+str(filename) \
+                   if pack is not None else filename
+            lineprint("Could not read "+name+", skipping..", label="pirecorder")
+
+        return files[len(files):], None
+
+
+    def imgstream(self, files, pack = None):
+
+        """
+        Generator that yields the (resized) images in files, or at the
+        positions files in pack, in order. Images are decoded in parallel by
+        a pool of threads, one per pool, that stays at most prefetch images
+        ahead of the consumer to keep memory bounded.
+        """
+
+        window = max(self.prefetch, self.pools)
+        pool = ThreadPool(self.pools)
+        pending = deque()
+        try:
+            for filename in files:
+                pending.append(pool.apply_async(self.readimg, (filename, pack)))
+                if len(pending) >= window:
+                    frame = pending.popleft().get()
+                    if frame is not None:
+                        yield frame
+            while pending:
+                frame = pending.popleft().get()
+                if frame is not None:
+                    yield frame
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def watchdir(self, overwrite = False):
+
+        """
+        Converts videos as soon as they are completely written to the folder,
+        using a persistent pool of processes and an in-memory index of the
+        videos that are already converted
+        """
+
+        watcher = DirWatcher(self.indir)
+        done = set(listfiles(self.outdir, ".mp4", keepext = False))
+        queued = set()
+        pool = Pool(self.pools)
+
+        def finished(filein):
+            queued.discard(filein)
+            done.add(os.path.splitext(filein)[0])
+            if self.ledger is not None:
+                self.ledger.update()
+            if self.delete:
+                os.remove(filein)
+                if os.path.exists(sidecarname(filein)):
+                    os.remove(sidecarname(filein))
+
+        def failed(e, filein):
+            queued.discard(filein)
+            if self.ledger is not None:
+                self.ledger.update()
+            lineprint("Got exception: %r" % (e,), label="pirecorder")
+
+        lineprint("Watching "+self.indir+" for new files..", label="pirecorder")
+        try:
+            while True:
+                files = watcher.events(timeout = 1)
+                if watcher.overflow:
+                    watcher.overflow = False
+                    files = listfiles(self.indir, self.type, keepdir = False)
+                for filein in files:
+                    name, ext = os.path.splitext(filein)
+                    if ext.lower() != self.type.lower() or filein in queued:
+                        continue
+                    if overwrite:
+                        pass
+                    elif self.ledger is not None:
+                        if self.ledger.isdone(filein, self.params):
+                            continue
+                    elif name in done:
+                        continue
+                    queued.add(filein)
+                    pool.apply_async(self.conv_single, (filein,),
+                                     callback = lambda _, f=filein: finished(f),
+                                     error_callback = lambda e, f=filein: failed(e, f))
+        except KeyboardInterrupt:
+            lineprint("Terminating watching for files..", label="pirecorder")
+            self.terminated = True
+        finally:
+            watcher.close()
+            pool.terminate()
+            pool.join()
 
-            else:
-                if self.resizeval != 1:
-                    comm = "' -vf 'scale=iw*" + str(self.resizeval) + ":-2' '"
-                else:
-                    comm = "' -vcodec copy '"
-                bashcomm = "ffmpeg"
-                fpscom = str(self.fps) if self.fps is not None else str(24)
-                bashcomm = bashcomm+" -r "+ fpscom
-                bashcomm = bashcomm+" -i '"+filein+comm+fileout[:-len(self.type)]+".mp4'"
-                bashcomm = bashcomm + " -y -nostats -loglevel 0"
-                output = subprocess.check_output(['bash','-c', bashcomm])
 
-            lineprint("Finished converting "+filebase, label="pirecorder")
+    def schedule(self, files):
 
-        except KeyboardInterrupt:
-            raise KeyboardInterruptError()
+        """
+        Orders files to convert by their expected conversion time, largest
+        first, such that no single large file is left for the end while the
+        other processes are idle. As all files in a run are of the same type
+        and converted the same way, the expected time scales with file size.
+        """
+
+        return sorted(files, key = os.path.getsize, reverse = True)
+
+
+    def poolstats(self, converted, begin, workers):
+
+        """Prints how well the conversion work was spread across processes"""
+
+        end = max(stop for _, _, _, stop in converted)
+        wall = end - begin
+        busy = {}
+        for _, pid, start, stop in converted:
+            busy[pid] = busy.get(pid, 0) + stop - start
+        work = sum(busy.values())
+        idle = [wall - busy.get(pid, 0) for pid in busy]
+        idle += [wall] * (workers - len(busy))
+        lineprint("Converted "+str(len(converted))+" files/chunks in "+str(round(wall,1))+\
+                  "s (ideal "+str(round(work/workers,1))+"s), mean idle time per"+\
+                  " process "+str(round(sum(idle)/workers,1))+"s, max "+\
+                  str(round(max(idle),1))+"s", label="pirecorder")
 
 
     def convertpool(self):
@@ -169,11 +779,33 @@ class Convert:
 
             if self.type in [".h264",".mp4",".avi"]:
 
-                pool = Pool(min(self.pools, len(self.todo)))
+                workers = self.pools if self.splitsize > 0 else min(self.pools, len(self.todo))
+                pool = Pool(workers)
+                chunks = {}
+                results = []
+                converted = []
                 try:
-                    pool.map(self.conv_single, self.todo)
+                    begin = time.time()
+                    jobs = self.splitjobs(self.schedule(self.todo), chunks)
+                    for result in pool.imap_unordered(self.conv_job, jobs,
+                                                      chunksize = 1):
+                        results.append(result)
+                        if isinstance(result[0], tuple):
+                            filein = result[0][0]
+                            todo = [r for r in results if isinstance(r[0], tuple) \
+                                    and r[0][0] == filein]
+                            if len(todo) < len(chunks[filein]):
+                                continue
+                            self.join(filein, chunks[filein],
+                                      sum(stop - start for _, _, start, stop in todo))
+                        else:
+                            filein = result[0]
+                            if self.ledger is not None:
+                                self.ledger.update()
+                        converted.append(filein)
                     pool.close()
                     lineprint("Done converting all videofiles!", label="pirecorder")
+                    self.poolstats(results, begin, workers)
                 except KeyboardInterrupt:
                     lineprint("User terminated converting pool..", label="pirecorder")
                     self.terminated = True
@@ -185,31 +817,72 @@ class Convert:
                     pool.terminate()
                 finally:
                     pool.join()
+                    # Remove the chunks of videos that were not joined
+                    for filein, parts in chunks.items():
+                        if filein not in converted:
+                            for part in parts:
+                                for tmpfile in [part, part[:-len(".mp4")]+".h264"]:
+                                    if os.path.exists(tmpfile):
+                                        os.remove(tmpfile)
+                    if self.ledger is not None:
+                        self.ledger.update()
 
                 if self.delete:
-                    for filein in self.todo:
+                    for filein in converted:
                         os.remove(filein)
-                    lineprint("Deleted all original videofiles..", label="pirecorder")
+                        if os.path.exists(sidecarname(filein)):
+                            os.remove(sidecarname(filein))
+                    lineprint("Deleted all converted original videofiles..", label="pirecorder")
 
             elif self.type in [".jpg",".jpeg",".png"]:
 
                 vidname = commonpref(self.todo)
                 lineprint("Start converting "+str(len(self.todo))+" images", label="pirecorder")
 
-                frame_array = []
-                for filename in self.todo:
-                    frame = cv2.imread(filename)
-                    frame_array.append(frame)
-                    #os.rename(filename, self.outdir+"/"+filename)
-                h, w, _ = frame_array[0].shape
+                files, first = self.firstimg(self.todo)
+                if first is None:
+                    lineprint("No readable images found..", label="pirecorder")
+                    return
+                h, w, _ = first.shape
                 if self.outdir != "":
                     vidname = self.outdir+"/"+os.path.basename(vidname)
-                vidout = videowriter(vidname, w, h, self.imgfps, self.resizeval)
-                for i in range(len(frame_array)):
-                    vidout.write(frame_array[i])
+                tmpname = os.path.join(os.path.dirname(vidname),
+                                       "."+os.path.basename(vidname)+"_part")
+                vidout = videowriter(tmpname, w, h, self.imgfps, self.resizeval)
+                for frame in self.imgstream(files):
+                    vidout.write(frame)
                 vidout.release()
+                ext = get_ext(vidname)
+                os.rename(tmpname+".mp4", (vidname[:-len(ext)] if ext else vidname)+".mp4")
                 lineprint("Finished converting "+os.path.basename(vidname), label="pirecorder")
 
+            elif self.type == ".mjpeg":
+
+                for filein in self.todo:
+                    with ImagePack(filein) as pack:
+                        if len(pack) == 0:
+                            continue
+                        lineprint("Start converting "+str(len(pack))+" images in "+\
+                                  filein, label="pirecorder")
+                        fileout = self.outname(filein)
+                        tmpname = os.path.join(os.path.dirname(fileout),
+                                  "."+os.path.basename(fileout)[:-len(".mp4")]+"_part")
+                        positions, first = self.firstimg(range(len(pack)), pack)
+                        if first is None:
+                            lineprint("No readable images in "+filein+"..",
+                                      label="pirecorder")
+                            continue
+                        h, w, _ = first.shape
+                        vidout = videowriter(tmpname, w, h, self.imgfps, self.resizeval)
+                        for frame in self.imgstream(positions, pack):
+                            vidout.write(frame)
+                        vidout.release()
+                        os.rename(tmpname+".mp4", fileout)
+                    lineprint("Finished converting "+os.path.basename(fileout), label="pirecorder")
+                    if self.delete:
+                        os.remove(filein)
+                        os.remove(filein+".idx")
+
             else:
                 lineprint("No video or image files found..", label="pirecorder")
 
@@ -232,12 +905,22 @@ def conv():
     parser.add_argument("-g", "--fps", default=24, type=int, metavar="")
     parser.add_argument("-f", "--imgfps", default=25, type=int, metavar="")
     parser.add_argument("-s", "--sleeptime", default=None, type=int, metavar="")
+    parser.add_argument("-b", "--prefetch", default=8, type=int, metavar="")
+    parser.add_argument("-e", "--preset", default="veryfast", metavar="")
+    parser.add_argument("-a", "--watch", default="False", metavar="")
+    parser.add_argument("-x", "--splitsize", default=0, type=float, metavar="")
+    parser.add_argument("-l", "--ledger", default="False", metavar="")
 
     args = parser.parse_args()
-    args.withframe = ast.literal_eval(args.withframe)
+    if args.withframe != "track":
+        args.withframe = ast.literal_eval(args.withframe)
     args.delete = ast.literal_eval(args.delete)
+    args.watch = ast.literal_eval(args.watch)
+    args.ledger = ast.literal_eval(args.ledger)
     Convert(indir = args.indir, outdir = args.outdir, type = args.type,
             withframe = args.withframe, overwrite = args.overwrite, 
             delete = args.delete, pools = args.pools,
             resizeval = args.resizeval, fps = args.fps, imgfps = args.imgfps,
-            sleeptime = args.sleeptime)
+            sleeptime = args.sleeptime, prefetch = args.prefetch,
+            preset = args.preset, watch = args.watch,
+            splitsize = args.splitsize, ledger = args.ledger)
@@ -0,0 +1,512 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Recording daemon that keeps the camera open between recordings
+"""
+
+import os
+import time
+import socket
+import argparse
+import threading
+from ast import literal_eval
+from pythutils.sysutils import lineprint, homedir, isrpi
+
+SOCKETNAME = "pirecorderd.sock"
+COMMANDS = ["record", "trigger", "stop", "status", "reconfigure", "quit"]
+TUPLES = {"gains": 2, "roi": 4, "imgdims": 2, "viddims": 2, "maxres": 2}
+
+# The types, or list of allowed values, of each setting of PiRecorder and
+# if it can be None
+SETTINGS = {"recdir": (("str",), False),
+            "recvolumes": (("list",), True),
+            "minfree": (("int",), False),
+            "offloaddir": (("str",), True),
+            "offloadrate": (("float",), False),
+            "offloadworkers": (("int",), False),
+            "offloaddelete": (("bool",), False),
+            "subdirs": (("bool",), False),
+            "label": (("str",), False),
+            "rectype": (["img", "imgseq", "vid", "vidseq", "vidbuffer", "vidmotion"], False),
+            "automode": (("bool",), False),
+            "warmuptol": (("float",), False),
+            "warmupmax": (("float",), False),
+            "maxres": (("str", "tuple"), False),
+            "annotatesize": (("int",), False),
+            "rotation": (("int",), False),
+            "brighttune": (("int",), False),
+            "roi": (("tuple",), True),
+            "gains": (("tuple",), False),
+            "brightness": (("int",), False),
+            "contrast": (("int",), False),
+            "saturation": (("int",), False),
+            "iso": (("int",), False),
+            "sharpness": (("int",), False),
+            "compensation": (("int",), False),
+            "shutterspeed": (("int",), False),
+            "imgdims": (("tuple",), False),
+            "viddims": (("tuple",), False),
+            "imgfps": (("int",), False),
+            "vidfps": (("int",), False),
+            "imgwait": (("float",), False),
+            "imgnr": (("int",), False),
+            "imgtime": (("int",), False),
+            "imgquality": (("int",), False),
+            "imgwriters": (("int",), False),
+            "imgburst": (("bool",), False),
+            "imgpack": (("bool",), False),
+            "imgoverrun": (["skip", "catchup"], False),
+            "vidduration": (("int",), False),
+            "viddelay": (("int",), False),
+            "vidformat": (["h264", "mp4"], False),
+            "vidsidecar": (("bool",), False),
+            "vidquality": (("int",), False),
+            "maxviddur": (("int",), False),
+            "maxvidsize": (("int",), False),
+            "vidbuffer": (("int",), False),
+            "motionthresh": (("int",), False),
+            "motionarea": (("float",), False),
+            "motionon": (("float",), False),
+            "motionoff": (("float",), False)}
+
+def socketpath():
+
+    """Returns the default path of the socket of the daemon"""
+
+    return homedir() + "pirecorder/" + SOCKETNAME
+
+
+def clientcode(socketfile, command = "record", configfile = None):
+
+    """
+    Returns a python one-liner that sends command to the daemon together
+    with the time it was sent, such that the daemon can report the latency,
+    and prints the reply. Only the socket module is imported, so the client
+    starts within milliseconds, e.g. when run by cron. The code contains no
+    % signs, which cron would interpret as newlines.
+    """
+
+    config = "" if configfile is None else ' + " ' + configfile + '"'
+    return 'import socket, time; s = socket.socket(socket.AF_UNIX); '+\
+           's.settimeout(60); s.connect("'+socketfile+'"); '+\
+           's.sendall(("'+command+' " + repr(time.time())'+config+' + "\\n").encode()); '+\
+           'print(s.makefile().readline().strip())'
+
+
+def send(command, socketfile = None, timeout = 60):
+
+    """
+    Sends a command to the daemon and returns its reply. Record and trigger
+    commands are sent with the current time, unless a time is given.
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socketfile or socketpath())
+        words = command.split(" ")
+        if words[0] in ["record", "trigger"]:
+            try:
+                float(words[1])
+            except (IndexError, ValueError):
+                words.insert(1, repr(time.time()))
+            command = " ".join(words)
+        sock.sendall((command + "\n").encode())
+        return sock.makefile("r").readline().strip()
+    finally:
+        sock.close()
+
+
+def schema(nametypes = ()):
+
+    """
+    Returns the types, or the list of allowed values, of each setting and if
+    it can be None, with the nametypes allowed for the name parameters
+    """
+
+    settings = dict(SETTINGS)
+    for nr in range(1, 6):
+        settings["nameparam"+str(nr)] = (list(nametypes), False)
+
+    return settings
+
+
+def convert(key, value, settings):
+
+    """
+    Returns the value of a setting given as a string converted to its type,
+    and raises a ValueError if the setting does not exist or the value does
+    not match its type in settings, as returned by schema. Values are only
+    parsed as python literals, never evaluated.
+    """
+
+    if key not in settings:
+        raise ValueError("unknown setting "+key)
+    types, nullable = settings[key]
+    try:
+        parsed = literal_eval(value)
+    except (ValueError, SyntaxError):
+        parsed = value
+    if parsed is None and nullable:
+        return None
+    if isinstance(types, list):
+        if parsed in types:
+            return parsed
+        raise ValueError(key+" should be one of "+", ".join(map(str, types)))
+    for kind in types:
+        if kind == "bool" and isinstance(parsed, bool):
+            return parsed
+        if isinstance(parsed, bool):
+            continue
+        if kind == "int" and isinstance(parsed, int):
+            return parsed
+        if kind == "float" and isinstance(parsed, (int, float)):
+            return float(parsed)
+        if kind == "tuple" and isinstance(parsed, tuple) and\
+           len(parsed) == TUPLES.get(key, len(parsed)) and\
+           all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in parsed):
+            return parsed
+        if kind == "list" and isinstance(parsed, list) and\
+           all(isinstance(v, str) for v in parsed):
+            return parsed
+        if kind == "str" and isinstance(parsed, (str, int, float)):
+            return value if not isinstance(parsed, str) else parsed
+    if "tuple" in types and key in TUPLES:
+        types = [kind if kind != "tuple" else "tuple of "+str(TUPLES[key])+" numbers"
+                 for kind in types]
+    raise ValueError(key+" should be of type "+" or ".join(types))
+
+
+class Daemon:
+
+    """
+    Keeps the camera of a PiRecorder open and configured between recordings,
+    and accepts commands over a unix socket, one per line, with a single
+    line reply:
+
+    record [time] [configfile]
+        Starts a recording with the configuration of the daemon and replies
+        once the first image or frame has arrived. If the time the command was
+        sent is given, in seconds since the epoch, the reply includes the
+        latency from the command to the first frame. The configfile, if
+        given, should be the one the daemon was started with.
+    trigger [time]
+        Triggers a running vidbuffer or vidmotion recording and replies with
+        the latency to its first frame.
+    stop
+        Stops the running recording.
+    status
+        Replies with the state of the camera and recording, and the number
+        and latency of the recordings so far.
+    reconfigure key=value ...
+        Changes settings of the configuration, as with the settings function,
+        and sets up the camera again. Each value is checked against the type
+        of its setting, and nothing is changed if any value does not match.
+        Only possible without a running recording.
+    quit
+        Stops the daemon.
+
+    As the camera has already warmed up, the latency from a command to the
+    first frame is reduced from seconds to tens of milliseconds. Scheduled
+    recordings use the daemon when scheduled with daemon set to True, or
+    commands can be sent with e.g. pirecorderd record, or with
+    echo status | nc -U ~/pirecorder/pirecorderd.sock.
+
+    Parameters
+    -----------
+    configfile : str, default = "pirecorder.conf"
+        The name of the configuration file to be used for recordings.
+    backend : str, default = "picamera"
+        The camera backend, "picamera" or "sim".
+    socketfile : str, default = None
+        The unix socket to accept commands on, by default pirecorderd.sock in
+        the pirecorder folder.
+    logging : bool, default = True
+        If the output should be logged to the pirecorder log file.
+    """
+
+    def __init__(self, configfile = "pirecorder.conf", backend = "picamera",
+                 socketfile = None, logging = True):
+
+        from .pirecorder import PiRecorder
+
+        self.rec = PiRecorder(configfile, logging = logging, backend = backend)
+        self.rec.keepcam = True
+        self.socketfile = socketfile or self.rec.setupdir + "/" + SOCKETNAME
+        self.lock = threading.Lock()
+        self.thread = None
+        self.since = None
+        self.recordings = 0
+        self.latencies = []
+        self.stopped = threading.Event()
+
+
+    def recording(self):
+
+        """Returns if a recording is running"""
+
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def warm(self):
+
+        """Opens and sets up the camera, if it is not open yet"""
+
+        if getattr(self.rec, "cam", None) is None or self.rec.cam.closed:
+            self.rec._setup_cam()
+            lineprint("Camera ready, waiting for commands on "+self.socketfile+"..")
+
+
+    def _latency(self, sent, timeout = 30):
+
+        """
+        Waits until the first frame of the recording has arrived, or the
+        recording ended, and returns the reply with the latency
+        """
+
+        end = time.time() + timeout
+        while self.rec.started is None and self.recording() and time.time() < end:
+            time.sleep(0.002)
+        if self.rec.started is None:
+            if self.recording():
+                return "ok, no frames yet"
+            return "error, recording ended without frames"
+        if sent is None:
+            return "ok"
+        latency = (self.rec.started - sent) * 1000
+        self.latencies.append(latency)
+        lineprint("Trigger to first frame latency "+str(round(latency,1))+"ms")
+        return "ok, first frame after "+str(round(latency,1))+"ms"
+
+
+    def _record(self):
+
+        try:
+            self.rec.record(interactive = False)
+        except Exception as e:
+            lineprint("Recording failed: "+str(e))
+            if getattr(self.rec, "cam", None) is not None:
+                self.rec.cam.close()
+
+
+    def record(self, sent = None, configfile = None):
+
+        """Starts a recording in the background and returns the reply"""
+
+        if configfile is not None and configfile != self.rec.configfilerel:
+            return "error, daemon runs with "+self.rec.configfilerel
+        with self.lock:
+            if self.recording():
+                return "error, already recording"
+            self.warm()
+            self.recordings += 1
+            self.since = time.time()
+            self.rec.started = None
+            self.thread = threading.Thread(target = self._record)
+            self.thread.daemon = True
+            self.thread.start()
+        if self.rec.config.rec.rectype in ["vidbuffer", "vidmotion"]:
+            while getattr(self.rec, "triggers", None) is None and self.recording():
+                time.sleep(0.002)
+            return "ok, waiting for triggers"
+
+        return self._latency(sent)
+
+
+    def trigger(self, sent = None):
+
+        """Triggers a running vidbuffer or vidmotion recording"""
+
+        if not self.recording() or getattr(self.rec, "triggers", None) is None:
+            return "error, no vidbuffer or vidmotion recording running"
+        self.rec.started = None
+        self.rec.trigger()
+
+        return self._latency(sent)
+
+
+    def stop(self):
+
+        """Stops the running recording and waits until it has finished"""
+
+        if not self.recording():
+            return "ok, not recording"
+        self.rec.stop()
+        self.thread.join()
+
+        return "ok"
+
+
+    def status(self):
+
+        """Returns the status of the daemon as a single line"""
+
+        cam = getattr(self.rec, "cam", None)
+        status = "camera "+("closed" if cam is None or cam.closed else "ready")
+        if self.recording():
+            status += ", recording "+self.rec.config.rec.rectype+" since "+\
+                      time.strftime("%H:%M:%S", time.localtime(self.since))
+        else:
+            status += ", idle"
+        status += ", "+str(self.recordings)+" recordings"
+        if len(self.latencies) > 0:
+            latencies = sorted(self.latencies)
+            status += ", latency last "+str(round(self.latencies[-1],1))+\
+                      "ms, median "+str(round(latencies[len(latencies)//2],1))+"ms"
+
+        return status
+
+
+    def reconfigure(self, settings):
+
+        """
+        Changes the settings given as key=value strings and sets up the
+        camera again
+        """
+
+        kwargs = {}
+        types = schema(self.rec.nametypes)
+        for setting in settings:
+            if "=" not in setting:
+                return "error, settings should be given as key=value"
+            key, value = setting.split("=", 1)
+            try:
+                kwargs[key] = convert(key, value, types)
+            except ValueError as e:
+                return "error, "+str(e)
+        if len(kwargs) == 0:
+            return "error, no settings given"
+        with self.lock:
+            if self.recording():
+                return "error, recording running"
+            self.rec.settings(**kwargs)
+            if getattr(self.rec, "cam", None) is not None:
+                self.rec.cam.close()
+            self.warm()
+
+        return "ok"
+
+
+    def handle(self, line):
+
+        """Handles a single command and returns the reply"""
+
+        words = line.split()
+        if len(words) == 0 or words[0] not in COMMANDS:
+            return "unknown command"
+        command, args = words[0], words[1:]
+        if command in ["record", "trigger"]:
+            sent = None
+            if len(args) > 0:
+                try:
+                    sent = float(args[0])
+                    args = args[1:]
+                except ValueError:
+                    pass
+            if command == "trigger":
+                return self.trigger(sent)
+            return self.record(sent, args[0] if len(args) > 0 else None)
+        if command == "stop":
+            return self.stop()
+        if command == "status":
+            return self.status()
+        if command == "reconfigure":
+            return self.reconfigure(args)
+        self.stopped.set()
+
+        return "ok"
+
+
+    def _serve(self, conn):
+
+        with conn:
+            conn.settimeout(60)
+            try:
+                for line in conn.makefile("r"):
+                    if line.strip():
+                        try:
+                            reply = self.handle(line.strip())
+                        except Exception as e:
+                            reply = "error, "+str(e)
+                        conn.sendall((reply + "\n").encode())
+            except (socket.timeout, OSError):
+                pass
+
+
+    def run(self):
+
+        """Sets up the camera and handles commands until quit"""
+
+        if os.path.exists(self.socketfile):
+            os.remove(self.socketfile)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socketfile)
+        sock.listen(5)
+        sock.settimeout(0.5)
+        try:
+            self.warm()
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    continue
+                thread = threading.Thread(target = self._serve, args = (conn,))
+                thread.daemon = True
+                thread.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.remove(self.socketfile)
+            self.stop()
+            if getattr(self.rec, "cam", None) is not None:
+                self.rec.cam.close()
+            if self.rec.offloader is not None:
+                self.rec.offloader.close(wait = False)
+            lineprint("pirecorderd stopped after "+str(self.recordings)+" recordings..")
+
+
+def daemon():
+
+    """To run the pirecorder daemon or send it commands from the command line"""
+
+    parser = argparse.ArgumentParser(prog="pirecorderd",
+             description=Daemon.__doc__,
+             formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="run",
+                        choices=["run"] + COMMANDS,
+                        help="run the daemon, or the command to send to it")
+    parser.add_argument("settings", nargs="*",
+                        help="key=value settings to reconfigure")
+    parser.add_argument("-c", "--configfile", default="pirecorder.conf",
+                        metavar="", help="pirecorder configuration file")
+    parser.add_argument("-b", "--backend", default="picamera",
+                        choices=["picamera", "sim"],
+                        help="camera backend, sim for a simulated camera")
+    parser.add_argument("-s", "--socketfile", default=None, metavar="")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.backend != "sim" and not isrpi():
+            lineprint("PiRecorder only works on a raspberry pi. Exiting..")
+            return
+        Daemon(args.configfile, args.backend, args.socketfile).run()
+    else:
+        print(send(" ".join([args.command] + args.settings), args.socketfile))
+
+
+if __name__ == "__main__":
+    daemon()
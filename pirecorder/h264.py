@@ -0,0 +1,273 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Helper functions to inspect raw h264 (annex b) elementary streams as
+recorded by the raspberry pi camera
+"""
+
+import os
+import io
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+
+
+def nalunits(filename, chunksize = 1<<22):
+
+    """
+    Generator that scans a h264 elementary stream and yields the byte offset
+    of the start code, the nal unit type, and if the nal unit starts a new
+    frame (first_mb_in_slice is 0) for each nal unit in the file
+    """
+
+    with io.open(filename, "rb") as f:
+        pos = 0
+        tail = b""
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            data = tail + chunk
+            start = pos - len(tail)
+            i = data.find(b"\x00\x00\x01")
+            while i != -1 and i + 4 < len(data):
+                offset = i-1 if i > 0 and data[i-1:i] == b"\x00" else i
+                header = bytearray(data[i+3:i+5])
+                yield start+offset, header[0] & 0x1f, bool(header[1] & 0x80)
+                i = data.find(b"\x00\x00\x01", i+3)
+            keep = len(data)-i if i != -1 else 4
+            tail = data[-keep:]
+            pos += len(chunk)
+
+
+def splitnals(data):
+
+    """Returns a list of the nal units, without start codes, in annex b data"""
+
+    data = bytes(data)
+    starts = []
+    i = data.find(b"\x00\x00\x01")
+    while i != -1:
+        starts.append(i+3)
+        i = data.find(b"\x00\x00\x01", i+3)
+    nals = []
+    for start, end in zip(starts, starts[1:] + [len(data)+3]):
+        # Zero bytes before a start code are not part of the nal unit
+        nal = data[start:end-3].rstrip(b"\x00")
+        if len(nal) > 0:
+            nals.append(nal)
+
+    return nals
+
+
+class _BitReader(object):
+
+    def __init__(self, data):
+
+        self.data = data
+        self.pos = 0
+
+
+    def u(self, n):
+
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+
+    def ue(self):
+
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+
+    def se(self):
+
+        value = self.ue()
+        return (value + 1) // 2 if value % 2 else -(value // 2)
+
+
+def spsinfo(sps):
+
+    """
+    Returns a dict with the profile, level, chroma format, bit depths and
+    the cropped frame width and height from a sequence parameter set nal
+    unit without start code
+    """
+
+    rbsp = bytearray()
+    zeros = 0
+    for byte in bytearray(sps[1:]):
+        if zeros >= 2 and byte == 3:
+            zeros = 0
+            continue
+        zeros = zeros + 1 if byte == 0 else 0
+        rbsp.append(byte)
+
+    bits = _BitReader(rbsp)
+    info = {"profile": bits.u(8), "compat": bits.u(8), "level": bits.u(8),
+            "chroma": 1, "bitdepthluma": 8, "bitdepthchroma": 8}
+    bits.ue()
+    if info["profile"] in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138,
+                           139, 134, 135):
+        info["chroma"] = bits.ue()
+        if info["chroma"] == 3:
+            bits.u(1)
+        info["bitdepthluma"] = bits.ue() + 8
+        info["bitdepthchroma"] = bits.ue() + 8
+        bits.u(1)
+        if bits.u(1):
+            for i in range(12 if info["chroma"] == 3 else 8):
+                if bits.u(1):
+                    last, nxt = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if nxt != 0:
+                            nxt = (last + bits.se() + 256) % 256
+                        last = nxt if nxt != 0 else last
+    bits.ue()
+    poctype = bits.ue()
+    if poctype == 0:
+        bits.ue()
+    elif poctype == 1:
+        bits.u(1)
+        bits.se()
+        bits.se()
+        for _ in range(bits.ue()):
+            bits.se()
+    bits.ue()
+    bits.u(1)
+    width = (bits.ue() + 1) * 16
+    height = (bits.ue() + 1) * 16
+    framembsonly = bits.u(1)
+    height *= 2 - framembsonly
+    if not framembsonly:
+        bits.u(1)
+    bits.u(1)
+    if bits.u(1):
+        cropx = 1 if info["chroma"] in (0, 3) else 2
+        cropy = (2 if info["chroma"] == 1 else 1) * (2 - framembsonly)
+        left, right, top, bottom = [bits.ue() for _ in range(4)]
+        width -= (left + right) * cropx
+        height -= (top + bottom) * cropy
+    info["width"], info["height"] = width, height
+
+    return info
+
+
+def isframestart(naltype, firstmb):
+
+    """Returns if a nal unit starts a new coded frame"""
+
+    return naltype in (NAL_SLICE, NAL_IDR) and firstmb
+
+
+def framecount(filename):
+
+    """Returns the number of frames in a h264 elementary stream"""
+
+    return sum(1 for _, naltype, firstmb in nalunits(filename)
+               if isframestart(naltype, firstmb))
+
+
+def keyframes(filename):
+
+    """
+    Returns a list of (byte offset, frame number) of all keyframes in a h264
+    elementary stream at which the stream can be cut, i.e. idr frames that
+    are directly preceded by the sequence headers (sps) needed to decode
+    them, as written by the raspberry pi camera with inline headers
+    """
+
+    points = []
+    frame = 0
+    spsoffset = None
+    for offset, naltype, firstmb in nalunits(filename):
+        if naltype == NAL_SPS:
+            spsoffset = offset
+        elif isframestart(naltype, firstmb):
+            if naltype == NAL_IDR and spsoffset is not None:
+                points.append((spsoffset, frame))
+            spsoffset = None
+            frame += 1
+
+    return points
+
+
+def accessunits(filename):
+
+    """
+    Generator that yields the byte offset, size and if it is a keyframe of
+    each access unit, i.e. a coded frame with the headers that precede it,
+    in a h264 elementary stream
+    """
+
+    start = None
+    keyframe = False
+    invcl = False
+    for offset, naltype, firstmb in nalunits(filename):
+        vcl = naltype in (NAL_SLICE, NAL_IDR)
+        if start is not None and invcl and (not vcl or firstmb):
+            yield start, offset - start, keyframe
+            start = None
+        if start is None:
+            start, keyframe = offset, False
+        keyframe = keyframe or naltype == NAL_IDR
+        invcl = vcl
+    if start is not None and invcl:
+        yield start, os.path.getsize(filename) - start, keyframe
+
+
+def splitfile(filename, chunksize, prefix):
+
+    """
+    Splits a h264 elementary stream at keyframes into chunks of at least
+    chunksize bytes that can each be decoded independently. The chunks are
+    stored as prefix_c000.h264, prefix_c001.h264, etc. Returns a list of
+    (chunk filename, number of the first frame in the chunk), or an empty
+    list if the file could not be split.
+    """
+
+    size = os.path.getsize(filename)
+    cuts = []
+    for offset, frame in keyframes(filename):
+        last = cuts[-1][0] if cuts else 0
+        if offset - last >= chunksize and size - offset >= chunksize / 2:
+            cuts.append((offset, frame))
+    if len(cuts) == 0:
+        return []
+
+    chunks = []
+    bounds = [(0, 0)] + cuts + [(size, None)]
+    with io.open(filename, "rb") as f:
+        for i, ((start, frame), (end, _)) in enumerate(zip(bounds[:-1], bounds[1:])):
+            chunkname = prefix+"_c%03d.h264" % i
+            f.seek(start)
+            with io.open(chunkname, "wb") as out:
+                remaining = end - start
+                while remaining > 0:
+                    data = f.read(min(remaining, 1<<22))
+                    out.write(data)
+                    remaining -= len(data)
+            chunks.append((chunkname, frame))
+
+    return chunks
@@ -0,0 +1,350 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Packed storage of long image sequences in a single file
+"""
+
+import os
+import cv2
+import argparse
+import numpy as np
+from datetime import datetime
+from pythutils.sysutils import lineprint
+
+MAGIC = b"PIMGIDX1"
+INDEX = np.dtype([("offset", "<u8"), ("size", "<u4"), ("frame", "<u4"),
+                  ("time", "<f8")])
+
+def jpegend(data, pos):
+
+    """
+    Returns the offset just after the end of the jpeg image that starts at
+    pos in data, or -1 if the image is incomplete. The markers of the image
+    are followed, so embedded thumbnails are skipped.
+    """
+
+    i = pos + 2
+    while i + 4 <= len(data):
+        if data[i] != 0xff:
+            return -1
+        marker = data[i+1]
+        if marker == 0xff:
+            i += 1
+        elif marker == 0xd9:
+            return i + 2
+        elif 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            i += 2
+        elif marker == 0xda:
+            # Skip the entropy coded data up to the next marker
+            j = i + 2 + ((data[i+2] << 8) | data[i+3])
+            while True:
+                j = data.find(b"\xff", j)
+                if j == -1 or j + 1 >= len(data):
+                    return -1
+                if data[j+1] == 0x00 or 0xd0 <= data[j+1] <= 0xd7:
+                    j += 2
+                else:
+                    break
+            i = j
+        else:
+            i += 2 + ((data[i+2] << 8) | data[i+3])
+    if i + 2 <= len(data) and data[i:i+2] == b"\xff\xd9":
+        return i + 2
+
+    return -1
+
+
+class ImagePack:
+
+    """
+    Stores a sequence of jpeg images in a single file, as one continuous
+    mjpeg stream that can also be read directly by e.g. FFmpeg, together
+    with a compact binary index file (.idx) with the offset, size, frame
+    number and timestamp of each image. Images are appended to the end of
+    the file, so a pack stays readable up to the last image written when a
+    recording is interrupted. If the index is missing or incomplete, it is
+    rebuilt from the images, without timestamps.
+
+    Images can be read by their position in the pack, by frame number or by
+    time, and exported back to individual image files.
+
+    Parameters
+    -----------
+    filename : str
+        The packed file, normally with the .mjpeg extension.
+    mode : ["r", "a"], default = "r"
+        If the pack is opened for reading ("r"), or for appending images
+        ("a"), in which case it is created when it does not exist yet.
+    """
+
+    def __init__(self, filename, mode = "r"):
+
+        if mode not in ["r", "a"]:
+            raise ValueError("mode should be 'r' or 'a'..")
+        self.filename = filename
+        self.indexfile = filename + ".idx"
+        self.mode = mode
+        if mode == "a":
+            self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        else:
+            self.fd = os.open(filename, os.O_RDONLY)
+        self._index = self._readindex()
+        self._pending = []
+        self.lastframe = int(self._index["frame"][-1]) if len(self._index) else 0
+        self.size = os.fstat(self.fd).st_size
+
+        self.idxfd = None
+        if mode == "a":
+            # Remove any incomplete image and index entry of an interrupted
+            # recording before appending
+            end = int(self._index["offset"][-1] + self._index["size"][-1]) \
+                  if len(self._index) else 0
+            if self.size > end:
+                os.ftruncate(self.fd, end)
+                self.size = end
+            self.idxfd = os.open(self.indexfile, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(self.idxfd).st_size != len(MAGIC) + self._index.nbytes:
+                os.ftruncate(self.idxfd, 0)
+                os.write(self.idxfd, MAGIC + self._index.tobytes())
+            os.lseek(self.idxfd, 0, os.SEEK_END)
+
+
+    @property
+    def index(self):
+
+        """The index of the images as a numpy structured array"""
+
+        if len(self._pending) > 0:
+            self._index = np.concatenate([self._index, np.array(self._pending, INDEX)])
+            self._pending = []
+        return self._index
+
+
+    def _readindex(self):
+
+        size = os.path.getsize(self.filename)
+        index = np.zeros(0, INDEX)
+        if os.path.exists(self.indexfile):
+            with open(self.indexfile, "rb") as f:
+                if f.read(len(MAGIC)) == MAGIC:
+                    data = f.read()
+                    index = np.frombuffer(data[:len(data)//INDEX.itemsize*INDEX.itemsize],
+                                          INDEX).copy()
+        # Keep only entries of images that were completely written
+        index = index[index["offset"] + index["size"] <= size]
+        end = int(index["offset"][-1] + index["size"][-1]) if len(index) else 0
+        if end < size:
+            first = int(index["frame"][-1]) + 1 if len(index) else 1
+            index = np.concatenate([index, self._scan(end, first)])
+        return index
+
+
+    def _scan(self, start, first = 1, chunksize = 1<<22, maxsize = 1<<26):
+
+        """
+        Finds the images in the pack from byte offset start onwards, and
+        numbers them from first. The pack is read in chunks of chunksize
+        bytes, so only about a chunk and a single image are held in memory.
+        An image that has not ended within maxsize bytes is corrupt and
+        skipped, continuing at the next image.
+        """
+
+        entries = []
+        with open(self.filename, "rb") as f:
+            f.seek(start)
+            data = b""
+            base = start
+            i = 0
+            eof = False
+            while True:
+                pos = data.find(b"\xff\xd8", i)
+                end = jpegend(data, pos) if pos != -1 else -1
+                if end != -1:
+                    entries.append((base + pos, end - pos, first + len(entries), np.nan))
+                    i = end
+                    continue
+                if pos != -1 and len(data) - pos > maxsize:
+                    lineprint("Skipping corrupt image data at byte "+\
+                              str(base + pos)+" of "+\
+                              os.path.basename(self.filename)+"..")
+                    i = pos + 2
+                    continue
+                if eof:
+                    break
+                if pos == -1:
+                    # Keep a last 0xff that may start a marker in the next chunk
+                    pos = len(data) - 1 if data.endswith(b"\xff") else len(data)
+                base += pos
+                chunk = f.read(chunksize)
+                eof = len(chunk) == 0
+                data = data[pos:] + chunk
+                i = 0
+        index = np.array(entries, INDEX)
+        if len(index) > 0:
+            lineprint("Rebuilt the index of "+str(len(index))+" images in "+\
+                      os.path.basename(self.filename)+" without timestamps..")
+        return index
+
+
+    def __len__(self):
+
+        return len(self.index)
+
+
+    def __iter__(self):
+
+        for i in range(len(self)):
+            yield self.read(i)
+
+
+    @property
+    def frames(self):
+
+        """The frame numbers of the images"""
+
+        return self.index["frame"]
+
+
+    @property
+    def times(self):
+
+        """The timestamps of the images in seconds since the epoch"""
+
+        return self.index["time"]
+
+
+    def append(self, data, frame = None, timestamp = None):
+
+        """
+        Appends the jpeg image data with its frame number and timestamp, by
+        default the next frame number and the current time
+        """
+
+        if self.mode != "a":
+            raise IOError("Pack is not opened for appending..")
+        frame = frame if frame is not None else self.lastframe + 1
+        timestamp = timestamp if timestamp is not None else \
+                    datetime.now().timestamp()
+        view = memoryview(data).cast("B")
+        offset = self.size
+        written = 0
+        while written < len(view):
+            written += os.write(self.fd, view[written:])
+        self.size += len(view)
+        entry = (offset, len(view), frame, timestamp)
+        os.write(self.idxfd, np.array([entry], INDEX).tobytes())
+        self._pending.append(entry)
+        self.lastframe = frame
+
+
+    def read(self, i):
+
+        """Returns the jpeg data of the image at position i"""
+
+        entry = self.index[i]
+        return os.pread(self.fd, int(entry["size"]), int(entry["offset"]))
+
+
+    def image(self, i):
+
+        """Returns the decoded image at position i"""
+
+        return cv2.imdecode(np.frombuffer(self.read(i), np.uint8), cv2.IMREAD_COLOR)
+
+
+    def byframe(self, frame):
+
+        """Returns the position of the image with frame number frame"""
+
+        found = np.flatnonzero(self.index["frame"] == frame)
+        if len(found) == 0:
+            raise KeyError("Frame "+str(frame)+" not in pack..")
+        return int(found[0])
+
+
+    def bytime(self, timestamp):
+
+        """
+        Returns the position of the last image taken at or before timestamp,
+        in seconds since the epoch or as a datetime
+        """
+
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+        return max(0, int(np.searchsorted(self.index["time"], timestamp,
+                                          side = "right")) - 1)
+
+
+    def export(self, outdir = "", start = 0, stop = None):
+
+        """
+        Writes the images from position start up to stop to individual jpeg
+        files in outdir, named after the pack with the frame number and the
+        time of each image, e.g. pack_im00001_101300.jpg. Returns the list
+        of files written.
+        """
+
+        outdir = outdir if outdir != "" else os.path.dirname(self.filename)
+        if outdir and not os.path.exists(outdir):
+            os.makedirs(outdir)
+        base = os.path.splitext(os.path.basename(self.filename))[0]
+        digits = max(3, len(str(int(self.index["frame"].max())))) if len(self) else 3
+        files = []
+        for i in range(start, len(self) if stop is None else min(stop, len(self))):
+            entry = self.index[i]
+            name = base+"_im"+str(int(entry["frame"])).zfill(digits)
+            if not np.isnan(entry["time"]):
+                name += datetime.fromtimestamp(entry["time"]).strftime("_%H%M%S")
+            filename = os.path.join(outdir, name+".jpg")
+            with open(filename, "wb") as f:
+                f.write(self.read(i))
+            files.append(filename)
+
+        return files
+
+
+    def close(self):
+
+        os.close(self.fd)
+        if self.idxfd is not None:
+            os.close(self.idxfd)
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+def unpack():
+
+    """To export a packed image sequence from the command line"""
+
+    parser = argparse.ArgumentParser(prog="unpack",
+             description="Exports the images of a packed image sequence")
+    parser.add_argument("filename", help="the packed image sequence (.mjpeg)")
+    parser.add_argument("-o", "--outdir", default="", metavar="")
+    parser.add_argument("-s", "--start", default=0, type=int, metavar="")
+    parser.add_argument("-e", "--stop", default=None, type=int, metavar="")
+    args = parser.parse_args()
+
+    with ImagePack(args.filename) as pack:
+        files = pack.export(args.outdir, args.start, args.stop)
+    lineprint("Exported "+str(len(files))+" images..")
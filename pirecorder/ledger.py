@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import io
+import json
+import time
+import hashlib
+
+def partialhash(filename, blocksize = 1<<20):
+
+    """
+    Returns a fast hash of a file based on its size and its first and last
+    blocksize bytes
+    """
+
+    size = os.path.getsize(filename)
+    md5 = hashlib.md5(str(size).encode())
+    with io.open(filename, "rb") as f:
+        md5.update(f.read(blocksize))
+        if size > blocksize:
+            f.seek(max(blocksize, size-blocksize))
+            md5.update(f.read(blocksize))
+
+    return md5.hexdigest()
+
+
+class Ledger:
+
+    """
+    Append-only record of converted media files, stored as one json entry
+    per line. Each entry stores the source file with its size, modification
+    time and partial hash, the output file and its size, the conversion
+    parameters, the time it took and the status of the conversion. The last
+    entry of a source file is kept in memory for fast lookups, and entries
+    appended by other processes, e.g. conversion workers, are added to it
+    with update.
+
+    Parameters
+    -----------
+    filename : str
+        The ledger file. If it does not exist yet it will be created.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = os.path.abspath(filename)
+        self.entries = {}
+        self.offset = 0
+
+        lines = self.update()
+        if lines > 2 * len(self.entries) + 100:
+            self.compact()
+
+
+    def update(self):
+
+        """
+        Adds the entries that were appended to the ledger file since it was
+        last read to the index, and returns the number of lines read
+        """
+
+        lines = 0
+        if not os.path.isfile(self.filename):
+            return lines
+        with io.open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                # Leave a partly written last entry for the next update
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                lines += 1
+                try:
+                    entry = json.loads(line.decode())
+                    self.entries[entry["source"]] = entry
+                except (ValueError, KeyError):
+                    continue
+
+        return lines
+
+
+    def __getstate__(self):
+
+        # Worker processes only append entries, so leave the in-memory index
+        state = self.__dict__.copy()
+        state["entries"] = {}
+        return state
+
+
+    def compact(self):
+
+        """Rewrites the ledger with only the last entry of each source file"""
+
+        tmpfile = self.filename + ".tmp"
+        with io.open(tmpfile, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.rename(tmpfile, self.filename)
+        self.offset = os.path.getsize(self.filename)
+
+
+    def isdone(self, source, params):
+
+        """
+        Returns if source was converted succesfully with the same parameters
+        and the output still exists unchanged
+        """
+
+        entry = self.entries.get(os.path.abspath(source))
+        if entry is None or entry["status"] != "done":
+            return False
+        if entry["params"] != params:
+            return False
+        try:
+            if os.path.getsize(entry["output"]) != entry["outsize"]:
+                return False
+            stat = os.stat(source)
+        except OSError:
+            return False
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime != entry["mtime"]:
+            return partialhash(source) == entry["hash"]
+
+        return True
+
+
+    def record(self, source, output, params, elapsed, status):
+
+        """Appends an entry for source to the ledger"""
+
+        source = os.path.abspath(source)
+        stat = os.stat(source)
+        entry = {"source": source,
+                 "size": stat.st_size,
+                 "mtime": stat.st_mtime,
+                 "hash": partialhash(source),
+                 "output": os.path.abspath(output),
+                 "outsize": os.path.getsize(output) if os.path.exists(output) else 0,
+                 "params": params,
+                 "elapsed": round(elapsed, 3),
+                 "status": status,
+                 "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.entries[source] = entry
+        with io.open(self.filename, "a") as f:
+            f.write(json.dumps(entry) + "\n")
@@ -0,0 +1,242 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Motion detection on a low resolution stream of the raspberry pi camera
+"""
+
+import cv2
+import time
+import numpy as np
+from threading import Thread, Event
+
+def analysissize(resolution, width = 160):
+
+    """
+    Returns the size of the low resolution analysis stream with the aspect
+    ratio of resolution, with the height a multiple of 16 as required for
+    unpadded yuv frames
+    """
+
+    w, h = resolution
+    return (width, max(16, int(round(width * h / float(w) / 16)) * 16))
+
+
+class MotionDetector(object):
+
+    """
+    Detects motion in unencoded yuv frames, e.g. from a splitter port of the
+    camera. Only the luminance (Y) plane is used. Each frame is compared with
+    a running average of previous frames, and the proportion of pixels that
+    differ more than a threshold is the motion level of the frame. Motion
+    starts after onframes consecutive frames with motion and stops after
+    offframes consecutive frames without motion.
+
+    Frames are analysed in a separate thread with vectorised numpy. When the
+    analysis of the previous frame has not finished yet, a new frame is
+    skipped instead, so writing to the detector never stalls the camera.
+
+    Parameters
+    -----------
+    size : tuple
+        The width and height of the frames.
+    roi : tuple, default = None
+        The region of interest to analyse as proportions (x, y, w, h) of the
+        frame. If None the full frame is analysed.
+    threshold : int, default = 15
+        The minimum difference in pixel intensity to count as motion.
+    area : float, default = 0.5
+        The percentage of pixels that need to differ for a frame to have
+        motion.
+    onframes : int, default = 3
+        The number of consecutive frames with motion to start motion.
+    offframes : int, default = 150
+        The number of consecutive frames without motion to stop motion.
+    alpha : float, default = 0.05
+        How fast the background adapts to changes, as the weight of each new
+        frame in the running average.
+    callback : function, default = None
+        Function that is called from the analysis thread with "trigger" when
+        motion starts and with "release" when motion stops.
+    """
+
+    def __init__(self, size, roi = None, threshold = 15, area = 0.5,
+                 onframes = 3, offframes = 150, alpha = 0.05, callback = None):
+
+        self.width, self.height = [int(v) for v in size]
+        self.fwidth = (self.width + 31) // 32 * 32
+        self.fheight = (self.height + 15) // 16 * 16
+        self.framesize = self.fwidth * self.fheight * 3 // 2
+        self.ysize = self.fwidth * self.fheight
+
+        x, y, w, h = roi if roi is not None else (0, 0, 1, 1)
+        self.rows = slice(int(y*self.height), max(int(y*self.height)+1,
+                                                   int((y+h)*self.height)))
+        self.cols = slice(int(x*self.width), max(int(x*self.width)+1,
+                                                  int((x+w)*self.width)))
+
+        self.threshold = threshold
+        self.area = area / 100.
+        self.onframes = max(1, int(onframes))
+        self.offframes = max(1, int(offframes))
+        self.alpha = alpha
+        self.callback = callback
+
+        self.buffer = bytearray()
+        self.yplane = np.empty((self.fheight, self.fwidth), np.uint8)
+        self.background = None
+        self.level = 0.
+        self.motion = False
+        self.count = 0
+        self.frames = 0
+        self.analysed = 0
+        self.skipped = 0
+        self.exception = None
+
+        self.ready = Event()
+        self.ready.set()
+        self.pending = Event()
+        self.stopped = Event()
+        self.thread = None
+
+
+    def write(self, data):
+
+        if len(self.buffer) == 0 and len(data) == self.framesize:
+            self._frame(data)
+        else:
+            self.buffer.extend(data)
+            while len(self.buffer) >= self.framesize:
+                self._frame(self.buffer[:self.framesize])
+                del self.buffer[:self.framesize]
+
+        return len(data)
+
+
+    def _frame(self, data):
+
+        self.frames += 1
+        if not self.ready.is_set():
+            self.skipped += 1
+            return
+        if self.thread is None:
+            self.thread = Thread(target = self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.ready.clear()
+        self.yplane.ravel()[:] = np.frombuffer(data, np.uint8, self.ysize)
+        self.pending.set()
+
+
+    def analyse(self, yplane):
+
+        """
+        Updates the background model with the Y plane of a frame, and
+        returns "trigger" or "release" when motion starts or stops, else None
+        """
+
+        gray = yplane[self.rows, self.cols].astype(np.float32)
+        if self.background is None:
+            self.background = gray
+            return None
+
+        diff = np.abs(gray - self.background)
+        self.level = np.count_nonzero(diff > self.threshold) / float(diff.size)
+        self.background *= 1 - self.alpha
+        self.background += self.alpha * gray
+        self.analysed += 1
+
+        if (self.level >= self.area) != self.motion:
+            self.count += 1
+        else:
+            self.count = 0
+        if not self.motion and self.count >= self.onframes:
+            self.motion, self.count = True, 0
+            return "trigger"
+        if self.motion and self.count >= self.offframes:
+            self.motion, self.count = False, 0
+            return "release"
+
+        return None
+
+
+    def _run(self):
+
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            if self.stopped.is_set():
+                return
+            try:
+                event = self.analyse(self.yplane)
+                if event is not None and self.callback is not None:
+                    self.callback(event)
+            except Exception as e:
+                self.exception = e
+            self.ready.set()
+
+
+    def flush(self):
+
+        pass
+
+
+    def close(self):
+
+        """Stops the analysis thread"""
+
+        if self.thread is not None:
+            self.stopped.set()
+            self.pending.set()
+            self.thread.join()
+
+
+def detectfile(filename, width = 160, roi = None, threshold = 15, area = 0.5,
+               onframes = 3, offframes = 150, alpha = 0.05):
+
+    """
+    Runs motion detection on all frames of a recorded video, resized to the
+    size of the analysis stream, to test the detection settings and the speed
+    of the analysis. Returns a list of (start, stop) frame numbers of the
+    detected motion and the number of frames analysed per second.
+    """
+
+    cap = cv2.VideoCapture(filename)
+    size = analysissize((cap.get(cv2.CAP_PROP_FRAME_WIDTH),
+                         cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), width)
+    detector = MotionDetector(size, roi, threshold, area, onframes, offframes, alpha)
+
+    spans = []
+    frame = 0
+    elapsed = 0.
+    while True:
+        ret, img = cap.read()
+        if not ret:
+            break
+        img = cv2.resize(img, size, interpolation = cv2.INTER_AREA)
+        yplane = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        start = time.time()
+        event = detector.analyse(yplane)
+        elapsed += time.time() - start
+        if event == "trigger":
+            spans.append([frame - detector.onframes + 1, None])
+        elif event == "release":
+            spans[-1][1] = frame - detector.offframes + 1
+        frame += 1
+    cap.release()
+    if len(spans) > 0 and spans[-1][1] is None:
+        spans[-1][1] = frame
+
+    return [tuple(span) for span in spans], frame / max(elapsed, 1e-9)
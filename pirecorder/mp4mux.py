@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Muxer that writes h264 encoder output directly to fragmented mp4
+"""
+
+import struct
+
+from .h264 import splitnals, spsinfo, NAL_IDR, NAL_SPS, NAL_PPS
+
+NAL_AUD = 9
+SPS_HEADER = 2
+
+MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def box(name, *payloads):
+
+    """Returns an mp4 box of type name with the payloads as content"""
+
+    content = b"".join(payloads)
+    return struct.pack(">I4s", 8 + len(content), name) + content
+
+
+def fullbox(name, version, flags, *payloads):
+
+    """Returns an mp4 full box with version and flags"""
+
+    return box(name, struct.pack(">I", (version << 24) | flags), *payloads)
+
+
+class MP4Muxer(object):
+
+    """
+    Muxes the h264 output of the camera encoder directly into a fragmented
+    mp4 file while recording. Each group of frames, from one keyframe to
+    the next, is written as a separate fragment as soon as it is complete,
+    with sample durations taken from the frame timestamps of the camera.
+    The file therefore stays playable when a recording is interrupted, with
+    at most the last group of frames lost. A random access index is added
+    when the muxer is closed, for fast seeking.
+
+    Parameters
+    -----------
+    output : object
+        Object with write and flush methods to write the mp4 data to, e.g.
+        an AsyncWriter or a file.
+    framerate : float
+        The framerate of the camera, used when frames have no timestamp.
+    timescale : int, default = 90000
+        The number of time units per second in the mp4 file.
+    """
+
+    def __init__(self, output, framerate, timescale = 90000):
+
+        self.output = output
+        self.framerate = float(framerate)
+        self.timescale = timescale
+        self.sps = None
+        self.pps = None
+        self.started = False
+        self.pending = bytearray()
+        self.samples = []
+        self.first = None
+        self.last = None
+        self.sequence = 0
+        self.offset = 0
+        self.fragments = []
+        self.frames = 0
+        self.skipped = 0
+
+
+    def write(self, data, frame = None):
+
+        """
+        Adds encoder data, with frame the camera frame information, and
+        returns the number of bytes written to the output
+        """
+
+        self.pending.extend(data)
+        if frame is not None and not frame.complete:
+            return 0
+        unit, self.pending = bytes(self.pending), bytearray()
+        nals = splitnals(unit)
+        for nal in nals:
+            if nal[0] & 0x1f == NAL_SPS:
+                self.sps = nal
+            elif nal[0] & 0x1f == NAL_PPS:
+                self.pps = nal
+        nals = [nal for nal in nals if nal[0] & 0x1f not in (NAL_SPS, NAL_PPS, NAL_AUD)]
+        if len(nals) == 0 or (frame is not None and frame.frame_type == SPS_HEADER):
+            return 0
+
+        keyframe = any(nal[0] & 0x1f == NAL_IDR for nal in nals)
+        if frame is not None and frame.timestamp is not None:
+            timestamp = frame.timestamp
+        elif self.last is not None:
+            timestamp = self.last + 1000000 / self.framerate
+        else:
+            timestamp = 0
+        if self.last is not None and timestamp <= self.last:
+            timestamp = self.last + 1000000 / self.framerate
+
+        written = 0
+        if not self.started:
+            if not keyframe or self.sps is None or self.pps is None:
+                self.skipped += 1
+                return 0
+            written += self._write(self._init())
+            self.started = True
+            self.first = timestamp
+        elif keyframe and len(self.samples) > 0:
+            written += self._fragment(timestamp)
+
+        sample = b"".join(struct.pack(">I", len(nal)) + nal for nal in nals)
+        self.samples.append((sample, timestamp, keyframe))
+        self.last = timestamp
+        self.frames += 1
+
+        return written
+
+
+    def close(self):
+
+        """Writes the last fragment and the random access index"""
+
+        written = 0
+        if len(self.samples) > 0:
+            written += self._fragment(None)
+        if self.started:
+            entries = b"".join(struct.pack(">QQ3B", time, offset, 1, 1, 1)
+                               for time, offset in self.fragments)
+            tfra = fullbox(b"tfra", 1, 0, struct.pack(">3I", 1, 0,
+                           len(self.fragments)), entries)
+            mfro = fullbox(b"mfro", 0, 0, struct.pack(">I", len(tfra) + 24))
+            written += self._write(box(b"mfra", tfra, mfro))
+            self.output.flush()
+
+        return written
+
+
+    def _write(self, data):
+
+        self.output.write(data)
+        self.offset += len(data)
+        return len(data)
+
+
+    def _ticks(self, timestamp):
+
+        return int(round((timestamp - self.first) * self.timescale / 1000000.))
+
+
+    def _init(self):
+
+        info = spsinfo(self.sps)
+        width, height = info["width"], info["height"]
+
+        avcc = struct.pack(">5BB", 1, info["profile"], info["compat"],
+                           info["level"], 0xff, 0xe1)
+        avcc += struct.pack(">H", len(self.sps)) + self.sps
+        avcc += struct.pack(">BH", 1, len(self.pps)) + self.pps
+        if info["profile"] not in (66, 77, 88):
+            avcc += struct.pack(">4B", 0xfc | info["chroma"],
+                                0xf8 | (info["bitdepthluma"] - 8),
+                                0xf8 | (info["bitdepthchroma"] - 8), 0)
+        avc1 = box(b"avc1", b"\x00" * 6, struct.pack(">H", 1), b"\x00" * 16,
+                   struct.pack(">HHIIIH", width, height, 0x480000, 0x480000, 0, 1),
+                   b"\x00" * 32, struct.pack(">Hh", 0x18, -1), box(b"avcC", avcc))
+        stbl = box(b"stbl",
+                   fullbox(b"stsd", 0, 0, struct.pack(">I", 1), avc1),
+                   fullbox(b"stts", 0, 0, struct.pack(">I", 0)),
+                   fullbox(b"stsc", 0, 0, struct.pack(">I", 0)),
+                   fullbox(b"stsz", 0, 0, struct.pack(">II", 0, 0)),
+                   fullbox(b"stco", 0, 0, struct.pack(">I", 0)))
+        minf = box(b"minf",
+                   fullbox(b"vmhd", 0, 1, struct.pack(">4H", 0, 0, 0, 0)),
+                   box(b"dinf", fullbox(b"dref", 0, 0, struct.pack(">I", 1),
+                                        fullbox(b"url ", 0, 1))),
+                   stbl)
+        mdia = box(b"mdia",
+                   fullbox(b"mdhd", 0, 0, struct.pack(">4IHH", 0, 0,
+                           self.timescale, 0, 0x55c4, 0)),
+                   fullbox(b"hdlr", 0, 0, struct.pack(">I4s3I", 0, b"vide", 0, 0, 0),
+                           b"VideoHandler\x00"),
+                   minf)
+        tkhd = fullbox(b"tkhd", 0, 3, struct.pack(">5I", 0, 0, 1, 0, 0),
+                       struct.pack(">2IhhHH", 0, 0, 0, 0, 0, 0), MATRIX,
+                       struct.pack(">II", width << 16, height << 16))
+        mvhd = fullbox(b"mvhd", 0, 0, struct.pack(">4IIH", 0, 0, 1000, 0,
+                       0x10000, 0x100), b"\x00" * 10, MATRIX, b"\x00" * 24,
+                       struct.pack(">I", 2))
+        mvex = box(b"mvex", fullbox(b"trex", 0, 0, struct.pack(">5I", 1, 1, 0, 0, 0)))
+        ftyp = box(b"ftyp", b"isom", struct.pack(">I", 0x200),
+                   b"isom", b"iso6", b"avc1", b"mp41")
+
+        return ftyp + box(b"moov", mvhd, box(b"trak", tkhd, mdia), mvex)
+
+
+    def _fragment(self, nexttime):
+
+        samples, self.samples = self.samples, []
+        ticks = [self._ticks(timestamp) for _, timestamp, _ in samples]
+        if nexttime is not None:
+            ticks.append(self._ticks(nexttime))
+        else:
+            ticks.append(ticks[-1] + int(round(self.timescale / self.framerate)))
+
+        entries = b""
+        for i, (sample, _, keyframe) in enumerate(samples):
+            flags = 0x02000000 if keyframe else 0x01010000
+            entries += struct.pack(">3I", max(1, ticks[i+1] - ticks[i]),
+                                   len(sample), flags)
+        self.sequence += 1
+
+        def moof(offset):
+            trun = fullbox(b"trun", 0, 0x701, struct.pack(">Ii", len(samples),
+                           offset), entries)
+            traf = box(b"traf", fullbox(b"tfhd", 0, 0x20000, struct.pack(">I", 1)),
+                       fullbox(b"tfdt", 1, 0, struct.pack(">Q", ticks[0])), trun)
+            return box(b"moof", fullbox(b"mfhd", 0, 0,
+                       struct.pack(">I", self.sequence)), traf)
+
+        moofsize = len(moof(0))
+        self.fragments.append((ticks[0], self.offset))
+        written = self._write(moof(moofsize + 8))
+        written += self._write(box(b"mdat", *[sample for sample, _, _ in samples]))
+        self.output.flush()
+
+        return written
@@ -0,0 +1,416 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Background offloading of finished recordings to a NAS or archive folder
+"""
+
+import os
+import time
+import zlib
+import argparse
+import threading
+import subprocess
+from queue import Queue, Empty
+from pythutils.sysutils import lineprint
+
+def lowpriority():
+
+    """
+    Gives the calling thread the idle io scheduling class and a low cpu
+    priority, such that it only uses storage and processor time that is
+    not needed by other threads, such as those of the camera
+    """
+
+    tid = threading.get_native_id()
+    try:
+        subprocess.call(["ionice", "-c", "3", "-p", str(tid)],
+                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    except OSError:
+        pass
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except (OSError, AttributeError):
+        pass
+
+
+def _dropcache(fd):
+
+    # Keep copied data from pushing recordings out of the page cache
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except (OSError, AttributeError):
+        pass
+
+
+class Limiter(object):
+
+    """
+    Limits the combined rate of the threads that use it to rate bytes per
+    second. A rate of 0 means no limit. Waiting ends early once the stop
+    event, if given, is set.
+    """
+
+    def __init__(self, rate = 0, stop = None):
+
+        self.rate = float(rate)
+        self.stop = threading.Event() if stop is None else stop
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def wait(self, size):
+
+        """
+        Waits until size bytes can be transferred within the rate, and returns
+        False if the wait was stopped
+        """
+
+        if self.rate <= 0:
+            return not self.stop.is_set()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + size / self.rate
+        if start > now:
+            return not self.stop.wait(start - now)
+
+        return not self.stop.is_set()
+
+
+class Offloader(object):
+
+    """
+    Copies finished recordings to a target directory, e.g. a mounted NAS
+    or archive drive, from a small pool of background threads. Copies run
+    at idle io priority and at most at rate MB/s in total, so recording is
+    never starved of storage or network bandwidth.
+
+    Files are copied in chunks to a hidden partial file in the target
+    directory, with a crc32 checksum of each chunk stored in a journal next
+    to it. An interrupted copy is resumed after the last chunk whose
+    checksum still matches the original file, instead of copied again.
+    Finished copies are renamed to their final name. With delete, the copy
+    is read back and its checksum compared to that of the original before
+    the original is deleted. Files that are still queued are stored in
+    statefile, so they are offloaded the next time an Offloader is started
+    with the same statefile. Failed copies are retried after retry seconds.
+
+    Parameters
+    -----------
+    target : str
+        The directory to copy files to. Files keep their path relative to
+        the root they are stored in.
+    roots : list, default = None
+        The directories that files are stored in, e.g. the recording
+        volumes. If None, paths are relative to the working directory.
+    rate : float, default = 0
+        The maximum combined copy rate in MB per second. 0 means no limit.
+    workers : int, default = 1
+        The number of files that are copied simultaneously.
+    delete : bool, default = False
+        If the original files should be deleted after their copy has been
+        verified.
+    statefile : str, default = None
+        The file to keep the list of files to offload in.
+    chunksize : int, default = 4194304
+        The size in bytes of the chunks that are copied and checksummed.
+    retry : float, default = 30
+        The time in seconds after which failed copies are retried.
+    """
+
+    def __init__(self, target, roots = None, rate = 0, workers = 1,
+                 delete = False, statefile = None, chunksize = 1<<22,
+                 retry = 30):
+
+        self.target = os.path.abspath(target)
+        roots = [os.getcwd()] if roots is None else roots
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.delete = delete
+        self.statefile = statefile
+        self.chunksize = int(chunksize)
+        self.retry = retry
+
+        self.copied = 0
+        self.bytes = 0
+        self.resumed = 0
+        self.failed = 0
+        self.busytime = 0.
+        self.pending = []
+        self.retrying = set()
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.stopped = threading.Event()
+        self.limiter = Limiter(rate * 1000000, self.stopped)
+
+        if statefile is not None and os.path.exists(statefile):
+            with open(statefile) as f:
+                files = [line.rstrip("\n") for line in f if line.strip()]
+            files = [filename for filename in files if os.path.exists(filename)]
+            if len(files) > 0:
+                lineprint("Resuming offload of "+str(len(files))+" files..")
+            for filename in files:
+                self.add(filename)
+
+        self.threads = [threading.Thread(target = self._run)
+                        for _ in range(max(1, int(workers)))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+
+    def add(self, filename):
+
+        """Queues a file that is completely written to be offloaded"""
+
+        filename = os.path.abspath(filename)
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.append(filename)
+            self._save()
+        self.queue.put((filename, 0))
+
+
+    def destination(self, filename):
+
+        """Returns the path of the copy of filename in the target directory"""
+
+        for root in self.roots:
+            if filename.startswith(root + os.sep):
+                return os.path.join(self.target, os.path.relpath(filename, root))
+
+        return os.path.join(self.target, os.path.basename(filename))
+
+
+    def _save(self):
+
+        if self.statefile is None:
+            return
+        tmpfile = self.statefile + ".tmp"
+        with open(tmpfile, "w") as f:
+            f.write("".join(filename + "\n" for filename in self.pending))
+        os.rename(tmpfile, self.statefile)
+
+
+    def _done(self, filename):
+
+        with self.lock:
+            if filename in self.pending:
+                self.pending.remove(filename)
+            self.retrying.discard(filename)
+            self._save()
+
+
+    def _run(self):
+
+        lowpriority()
+        while not self.stopped.is_set():
+            try:
+                filename, due = self.queue.get(timeout = 0.5)
+            except Empty:
+                continue
+            if due > time.time():
+                self.queue.put((filename, due))
+                time.sleep(0.5)
+                continue
+            start = time.time()
+            try:
+                if not os.path.exists(filename):
+                    self._done(filename)
+                    continue
+                if self.copy(filename):
+                    self.copied += 1
+                    self.busytime += time.time() - start
+                    self._done(filename)
+            except Exception as e:
+                self.failed += 1
+                self.retrying.add(filename)
+                lineprint("Offloading "+os.path.basename(filename)+" failed ("+\
+                          str(e)+"), retrying in "+str(self.retry)+"s..")
+                self.queue.put((filename, time.time() + self.retry))
+
+
+    def _resume(self, src, part, sums, crc):
+
+        """
+        Returns the number of chunks of a partial copy that match the
+        original, and the crc32 of those chunks of the original
+        """
+
+        if not os.path.exists(part) or not os.path.exists(sums):
+            return 0, crc
+        with open(sums) as f:
+            journal = [line.strip() for line in f if line.strip()]
+        chunks = min(len(journal), os.path.getsize(part) // self.chunksize)
+        for i in range(chunks):
+            data = os.pread(src, self.chunksize, i * self.chunksize)
+            if "%08x" % zlib.crc32(data) != journal[i]:
+                return i, crc
+            crc = zlib.crc32(data, crc)
+
+        return chunks, crc
+
+
+    def copy(self, filename):
+
+        """
+        Copies a file to the target directory, resuming any earlier partial
+        copy, and returns True when the copy is finished. A copy that is
+        interrupted because the offloader is closed returns False.
+        """
+
+        dest = self.destination(filename)
+        dirname, basename = os.path.split(dest)
+        part = os.path.join(dirname, "."+basename+".part")
+        sums = part + ".sums"
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok = True)
+
+        src = os.open(filename, os.O_RDONLY)
+        try:
+            size = os.fstat(src).st_size
+            chunks, crc = self._resume(src, part, sums, 0)
+            if chunks > 0:
+                self.resumed += 1
+            out = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(out, chunks * self.chunksize)
+                with open(sums, "a+") as journal:
+                    journal.seek(0)
+                    lines = journal.read().split()[:chunks]
+                    journal.seek(0)
+                    journal.truncate()
+                    journal.write("".join(line + "\n" for line in lines))
+                    offset = chunks * self.chunksize
+                    while offset < size:
+                        if self.stopped.is_set():
+                            return False
+                        data = os.pread(src, self.chunksize, offset)
+                        if len(data) == 0:
+                            break
+                        if not self.limiter.wait(len(data)):
+                            return False
+                        view = memoryview(data)
+                        pos = offset
+                        while len(view) > 0:
+                            written = os.pwrite(out, view, pos)
+                            view, pos = view[written:], pos + written
+                        os.fsync(out)
+                        _dropcache(src)
+                        _dropcache(out)
+                        journal.write("%08x\n" % zlib.crc32(data))
+                        journal.flush()
+                        crc = zlib.crc32(data, crc)
+                        offset += len(data)
+                        self.bytes += len(data)
+            finally:
+                os.close(out)
+
+            if os.path.getsize(part) != size:
+                raise IOError("size of copy does not match original")
+            if self.delete:
+                copycrc = 0
+                with open(part, "rb") as f:
+                    for data in iter(lambda: f.read(self.chunksize), b""):
+                        copycrc = zlib.crc32(data, copycrc)
+                if copycrc != crc:
+                    os.remove(part)
+                    os.remove(sums)
+                    raise IOError("checksum of copy does not match original")
+            os.rename(part, dest)
+            os.remove(sums)
+        finally:
+            os.close(src)
+
+        if self.delete:
+            os.remove(filename)
+
+        return True
+
+
+    def wait(self, timeout = None):
+
+        """
+        Waits until all queued files are offloaded, or have failed and are
+        waiting to be retried, for at most timeout seconds if given. Returns
+        if no files are left to offload.
+        """
+
+        end = None if timeout is None else time.monotonic() + timeout
+        while len(set(self.pending) - self.retrying) > 0:
+            if end is not None and time.monotonic() >= end:
+                return False
+            time.sleep(0.1)
+
+        return len(self.pending) == 0
+
+
+    def close(self, wait = True, timeout = None):
+
+        """
+        Stops offloading, after all queued files are offloaded if wait, for
+        at most timeout seconds if given, else after the current chunks,
+        keeping partial copies to resume
+        """
+
+        try:
+            if wait and len(self.pending) > 0:
+                lineprint("Waiting for "+str(len(self.pending))+\
+                          " files to be offloaded..")
+                self.wait(timeout)
+        finally:
+            self.stopped.set()
+            for thread in self.threads:
+                thread.join()
+        if len(self.pending) > 0 and self.statefile is not None:
+            lineprint(str(len(self.pending))+" files will be offloaded next time..")
+        if self.copied > 0:
+            lineprint("Offloaded "+str(self.copied)+" files ("+\
+                      str(round(self.bytes/1000000.,1))+"MB at "+\
+                      str(round(self.bytes/1000000./max(self.busytime,1e-6),1))+\
+                      "MB/s) to "+self.target+", "+str(self.resumed)+" resumed, "+\
+                      str(self.failed)+" failed attempts")
+
+
+def offload():
+
+    """To offload a directory of recordings from the command line"""
+
+    parser = argparse.ArgumentParser(prog="offload",
+             description="Copies recordings to a NAS or archive directory")
+    parser.add_argument("indir", help="the directory with the recordings")
+    parser.add_argument("target", help="the directory to copy the recordings to")
+    parser.add_argument("-r", "--rate", default=0, type=float, metavar="",
+                        help="the maximum rate in MB/s")
+    parser.add_argument("-w", "--workers", default=1, type=int, metavar="")
+    parser.add_argument("-d", "--delete", action="store_true",
+                        help="delete the recordings after verifying their copy")
+    args = parser.parse_args()
+
+    offloader = Offloader(args.target, [args.indir], args.rate, args.workers,
+                          args.delete)
+    for dirpath, _, files in os.walk(os.path.abspath(args.indir)):
+        for filename in sorted(files):
+            if filename.startswith("."):
+                continue
+            filename = os.path.join(dirpath, filename)
+            if not os.path.exists(offloader.destination(filename)):
+                offloader.add(filename)
+    try:
+        offloader.close()
+    except KeyboardInterrupt:
+        lineprint("Offloading stopped, partial copies will be resumed..")
+        offloader.close(wait = False)
@@ -0,0 +1,688 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Custom outputs for the raspberry pi camera encoder
+"""
+
+import os
+import time
+import errno
+from queue import Queue
+from collections import deque
+from threading import Thread, Event
+from time import strftime
+from pythutils.sysutils import lineprint
+
+from .mp4mux import MP4Muxer
+from .sidecar import FrameLog, sidecarname, RECORD
+from .storage import fallocate
+
+# picamera.PiVideoFrameType values
+FRAME = 0
+KEY_FRAME = 1
+SPS_HEADER = 2
+
+class AsyncWriter(object):
+
+    """
+    Writes data to files from a background thread, such that the thread that
+    writes data, e.g. the camera encoder, never has to wait for storage.
+    Data is copied into a preallocated ring of large buffers. Full buffers
+    are written to file by the writer thread in single bulk writes of
+    buffersize bytes, so file offsets stay aligned to the buffer size. Only
+    when all buffers are waiting to be written does writing data block.
+    Files can be preallocated when opened, such that they are stored
+    contiguously, with any unused preallocated space released on closing.
+
+    Parameters
+    -----------
+    buffersize : int, default = 4194304
+        The size of each buffer in bytes, rounded down to a multiple of 4096.
+    buffers : int, default = 16
+        The number of buffers in the ring.
+    fsync : str or float, default = "close"
+        When written data should be synced to storage, either "close" when a
+        file is closed, "always" after each buffer, "never", or a number of
+        seconds between syncs.
+    warnlevel : float, default = 0.5
+        The proportion of buffers waiting to be written at which a warning is
+        given that storage is falling behind.
+    storage : Storage, default = None
+        The storage to report the duration of each write to, to measure the
+        write throughput of the volumes.
+    onclose : function, default = None
+        Function that is called from the writer thread with the filename of
+        each file that is completely written and closed.
+    """
+
+    def __init__(self, buffersize = 1<<22, buffers = 16, fsync = "close",
+                 warnlevel = 0.5, storage = None, onclose = None):
+
+        self.buffersize = max(4096, buffersize - buffersize % 4096)
+        self.buffers = buffers
+        self.ring = [bytearray(self.buffersize) for _ in range(buffers)]
+        self.fsync = fsync
+        self.warnlevel = max(1, int(warnlevel * buffers))
+        self.storage = storage
+        self.onclose = onclose
+        self.filename = None
+        self.preallocated = False
+        self.free = Queue()
+        for i in range(1, buffers):
+            self.free.put(i)
+        self.queue = Queue()
+        self.current = 0
+        self.pos = 0
+
+        self.written = 0
+        self.maxdepth = 0
+        self.maxstall = 0.
+        self.waits = 0
+        self.exception = None
+
+        self.thread = Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    @property
+    def depth(self):
+
+        """The number of buffers waiting to be written"""
+
+        return self.buffers - 1 - self.free.qsize()
+
+
+    def open(self, filename, prealloc = 0):
+
+        """
+        Continues writing in a new file, closing the previous file, with
+        prealloc bytes of disk space reserved for the new file
+        """
+
+        self._submit()
+        self.queue.put(("open", (filename, prealloc)))
+
+
+    def write(self, data):
+
+        if self.exception is not None:
+            raise self.exception
+        view = memoryview(data).cast("B")
+        i = 0
+        while i < len(view):
+            n = min(len(view) - i, self.buffersize - self.pos)
+            self.ring[self.current][self.pos:self.pos+n] = view[i:i+n]
+            self.pos += n
+            i += n
+            if self.pos == self.buffersize:
+                self._submit()
+
+        return len(view)
+
+
+    def flush(self):
+
+        """Passes any data in the current buffer on to the writer thread"""
+
+        self._submit()
+
+
+    def close(self):
+
+        """Writes all remaining data, closes the file and stops the writer"""
+
+        self._submit()
+        self.queue.put(("close", None))
+        self.thread.join()
+        if self.exception is not None:
+            raise self.exception
+
+
+    def _submit(self):
+
+        if self.pos == 0:
+            return
+        self.queue.put(("write", (self.current, self.pos)))
+        self.maxdepth = max(self.maxdepth, self.depth)
+        if self.free.empty():
+            self.waits += 1
+        self.current = self.free.get()
+        self.pos = 0
+
+
+    def _sync(self, fd):
+
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            # Pipes and some special files can not be synced
+            if e.errno != errno.EINVAL:
+                raise
+
+
+    def _closefile(self, fd):
+
+        if fd is not None:
+            try:
+                if self.preallocated:
+                    os.ftruncate(fd, os.fstat(fd).st_size)
+                    self.preallocated = False
+                if self.fsync != "never":
+                    self._sync(fd)
+            finally:
+                os.close(fd)
+            if self.onclose is not None and self.exception is None:
+                self.onclose(self.filename)
+
+
+    def _run(self):
+
+        fd = None
+        lastsync = time.time()
+        lastwarn = 0
+        while True:
+            command, arg = self.queue.get()
+            depth = self.depth
+            if depth >= self.warnlevel and time.time() - lastwarn > 10:
+                lineprint("Storage is falling behind, "+str(depth)+" of "+\
+                          str(self.buffers)+" buffers waiting to be written..")
+                lastwarn = time.time()
+
+            try:
+                if command == "write":
+                    index, size = arg
+                    if self.exception is None:
+                        start = time.time()
+                        view = memoryview(self.ring[index])[:size]
+                        while len(view) > 0:
+                            view = view[os.write(fd, view):]
+                        if self.fsync == "always" or (not isinstance(self.fsync, str)
+                           and start - lastsync >= self.fsync):
+                            self._sync(fd)
+                            lastsync = start
+                        duration = time.time() - start
+                        self.maxstall = max(self.maxstall, duration)
+                        self.written += size
+                        if self.storage is not None:
+                            self.storage.report(self.filename, size, duration)
+                    self.free.put(index)
+                elif command == "open":
+                    self._closefile(fd)
+                    fd = None
+                    self.filename, prealloc = arg
+                    fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                 0o644)
+                    self.preallocated = fallocate(fd, prealloc)
+                elif command == "close":
+                    self._closefile(fd)
+                    return
+            except Exception as e:
+                if self.exception is None:
+                    self.exception = e
+                if command == "write":
+                    self.free.put(arg[0])
+                elif command == "close":
+                    return
+
+
+class ImageWriter(object):
+
+    """
+    Output for continuous image captures that stores each image in memory
+    and writes it to file from a pool of background threads, such that
+    capturing the next image never has to wait for storage. Images are
+    captured into a ring of reusable buffers. Only when all buffers are
+    waiting to be written does storing an image block, which provides
+    backpressure when storage can not keep up. The time it took to write
+    each image to file is kept in latencies. With a pack, images are
+    appended to the ImagePack instead of written to individual files, by a
+    single thread to keep them in order.
+
+    Parameters
+    -----------
+    buffers : int, default = 8
+        The number of image buffers in the ring.
+    threads : int, default = 2
+        The number of threads that write images to file.
+    pack : ImagePack, default = None
+        The pack, opened for appending, to store the images in.
+    storage : Storage, default = None
+        The storage to report the write time of each image to.
+    onclose : function, default = None
+        Function that is called with the filename of each image that is
+        written to file.
+    """
+
+    def __init__(self, buffers = 8, threads = 2, pack = None, storage = None,
+                 onclose = None):
+
+        self.buffers = max(2, buffers)
+        self.ring = [bytearray() for _ in range(self.buffers)]
+        self.free = Queue()
+        for i in range(1, self.buffers):
+            self.free.put(i)
+        self.queue = Queue()
+        self.current = 0
+        self.pos = 0
+
+        self.saved = 0
+        self.latencies = []
+        self.maxdepth = 0
+        self.waits = 0
+        self.exception = None
+
+        self.pack = pack
+        self.storage = storage
+        self.onclose = onclose
+        threads = 1 if pack is not None else max(1, threads)
+        self.threads = [Thread(target = self._run) for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+
+    @property
+    def depth(self):
+
+        """The number of images waiting to be written"""
+
+        return self.buffers - 1 - self.free.qsize()
+
+
+    def write(self, data):
+
+        view = memoryview(data).cast("B")
+        self.ring[self.current][self.pos:self.pos+len(view)] = view
+        self.pos += len(view)
+
+        return len(view)
+
+
+    def flush(self):
+
+        pass
+
+
+    def save(self, filename, frame = None, timestamp = None):
+
+        """
+        Writes the image captured since the last save to filename, or to the
+        pack with its frame number and timestamp, in the background, and
+        continues capturing in a free buffer
+        """
+
+        if self.exception is not None:
+            raise self.exception
+        self.queue.put((self.current, self.pos, filename, frame, timestamp))
+        self.saved += 1
+        self.maxdepth = max(self.maxdepth, self.depth)
+        if self.free.empty():
+            self.waits += 1
+        self.current = self.free.get()
+        self.pos = 0
+
+
+    def close(self):
+
+        """Writes all remaining images and stops the writer threads"""
+
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.exception is not None:
+            raise self.exception
+
+
+    def _run(self):
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            index, size, filename, frame, timestamp = item
+            start = time.time()
+            try:
+                if self.pack is not None:
+                    self.pack.append(memoryview(self.ring[index])[:size],
+                                     frame, timestamp)
+                else:
+                    with open(filename, "wb") as f:
+                        f.write(memoryview(self.ring[index])[:size])
+                self.latencies.append(time.time() - start)
+                if self.storage is not None:
+                    self.storage.report(filename if self.pack is None else
+                                        self.pack.filename, size,
+                                        self.latencies[-1])
+                if self.onclose is not None and self.pack is None:
+                    self.onclose(filename)
+            except Exception as e:
+                if self.exception is None:
+                    self.exception = e
+            self.free.put(index)
+
+
+class SegmentOutput(object):
+
+    """
+    Video output that splits a recording into segments of a maximum duration
+    and/or size. Segments are rotated by the output itself, inside the
+    encoder callback, at the sequence headers that the encoder writes before
+    each keyframe. Segments are therefore contiguous without any frames lost
+    between them, and each segment can be decoded on its own. When a segment
+    is full a keyframe is requested so the next segment starts right away.
+
+    Frames are counted per segment, and frames dropped by the camera are
+    detected from gaps in the frame timestamps. All file access is done by
+    an AsyncWriter, so the encoder never waits for storage. With the ".mp4"
+    filetype, the video is muxed directly into fragmented mp4 files with an
+    MP4Muxer, so no conversion is needed afterwards. With sidecar, the
+    timing and camera settings of each frame are logged by a FrameLog to a
+    sidecar file next to each segment. With a storage, each segment is
+    stored on the volume with enough space for its projected size, and
+    preallocated with that size. The volume of the next segment is already
+    determined in the background when a segment starts, so free space checks
+    are never done from the encoder callback.
+
+    Parameters
+    -----------
+    camera : PiCamera
+        The camera that records to the output.
+    basename : str
+        The filename of the video without extension.
+    filetype : str, default = ".h264"
+        The extension of the video files, ".h264" for raw h264 streams or
+        ".mp4" for fragmented mp4 files.
+    maxdur : float, default = 0
+        The maximum duration of a segment in seconds. 0 means no maximum.
+    maxsize : float, default = 0
+        The maximum size of a segment in MB. 0 means no maximum.
+    numbered : bool, default = False
+        If segment filenames should end with a segment number, e.g. _v01.
+    annotate : str, default = None
+        Annotation text to update every second, with "{timestamp:%H%M%S}"
+        replaced by the current time.
+    writer : AsyncWriter, default = None
+        The writer to use. If None, a writer with default settings is used.
+    sidecar : bool, default = False
+        If a sidecar file with a record of each frame should be written.
+    storage : Storage, default = None
+        The storage that determines the volume to store each segment on.
+    prealloc : int, default = 0
+        The projected size of a segment in bytes, to preallocate.
+    onclose : function, default = None
+        Function that is called with the filename of each segment and
+        sidecar file once it is completely written, e.g. to offload it.
+    onstart : function, default = None
+        Function that is called when the first frame is received, e.g. to
+        measure the latency of starting a recording.
+    preroll : float, default = 0
+        The seconds of buffered video that are written to the output at once
+        when it starts, to size the buffers of the sidecar file for.
+    """
+
+    def __init__(self, camera, basename, filetype = ".h264", maxdur = 0,
+                 maxsize = 0, numbered = False, annotate = None, writer = None,
+                 sidecar = False, storage = None, prealloc = 0, onclose = None,
+                 onstart = None, preroll = 0):
+
+        self.camera = camera
+        self.basename = basename
+        self.filetype = filetype
+        self.maxframes = int(round(maxdur * float(camera.framerate)))
+        self.maxsize = int(maxsize * 1000000)
+        self.numbered = numbered
+        self.annotate = annotate
+        self.interval = 1000000. / float(camera.framerate)
+        self.segments = []
+        self.size = 0
+        self.last = None
+        self.second = None
+        self.requested = False
+        self.muxer = None
+        self.storage = storage
+        self.prealloc = int(prealloc)
+        self.onstart = onstart
+        self.nextpath = None
+        self.writer = writer if writer is not None else \
+                      AsyncWriter(storage = storage, onclose = onclose)
+        self.framelog = None
+        self.framestart = None
+        if sidecar:
+            # Keep room for the records of the pre-roll next to those of a
+            # few seconds of recording
+            records = (preroll + 5) * float(camera.framerate) * RECORD.size
+            buffers = max(4, 2 + int(records // (1<<16)) + 1)
+            self.framelog = FrameLog(camera, AsyncWriter(1<<16, buffers,
+                                                         onclose = onclose))
+        self._open()
+
+
+    def _path(self, number):
+
+        nr = "_v%02d" % number if self.numbered else ""
+        filename = self.basename + nr + self.filetype
+        if self.storage is not None:
+            filename = self.storage.path(filename, self.prealloc)
+
+        return filename
+
+
+    def _prepare(self):
+
+        """Determines the path of the next segment in a background thread"""
+
+        if self.storage is None or (self.maxframes == 0 and self.maxsize == 0):
+            return
+        result = []
+        number = len(self.segments) + 1
+        thread = Thread(target = lambda: result.append(self._path(number)))
+        thread.daemon = True
+        thread.start()
+        self.nextpath = (thread, result)
+
+
+    def _open(self):
+
+        if self.nextpath is not None:
+            thread, result = self.nextpath
+            thread.join()
+            self.nextpath = None
+            filename = result[0] if len(result) > 0 else self._path(len(self.segments)+1)
+        else:
+            filename = self._path(len(self.segments)+1)
+        # Close the sidecar of the previous segment before its video, such
+        # that the sidecar is complete once the video is
+        if self.framelog is not None:
+            self.framelog.open(sidecarname(filename))
+            self.framestart = None
+        if self.muxer is not None:
+            self.muxer.close()
+        self.writer.open(filename, self.prealloc)
+        if self.filetype == ".mp4":
+            self.muxer = MP4Muxer(self.writer, self.camera.framerate)
+        self.segments.append({"filename": filename, "frames": 0, "size": 0,
+                              "dropped": 0, "gap": 0})
+        self.requested = False
+        self._prepare()
+
+
+    def _full(self, segment):
+
+        return (self.maxframes > 0 and segment["frames"] >= self.maxframes) or\
+               (self.maxsize > 0 and segment["size"] >= self.maxsize)
+
+
+    def write(self, data, frame = None):
+
+        frame = self.camera.frame if frame is None else frame
+        segment = self.segments[-1]
+        if frame is not None and frame.frame_type == SPS_HEADER:
+            if segment["frames"] > 0 and self._full(segment):
+                self._open()
+                segment = self.segments[-1]
+
+        elif frame is not None and frame.complete:
+            segment["frames"] += 1
+            if self.onstart is not None:
+                self.onstart()
+                self.onstart = None
+            if frame.timestamp is not None:
+                if self.last is not None:
+                    missed = int(round((frame.timestamp-self.last)/self.interval))-1
+                    if segment["frames"] == 1 and len(self.segments) > 1:
+                        segment["gap"] += max(0, missed)
+                    else:
+                        segment["dropped"] += max(0, missed)
+                self.last = frame.timestamp
+
+        if self.muxer is not None:
+            self.muxer.write(data, frame)
+        else:
+            self.writer.write(data)
+        segment["size"] += len(data)
+        self.size += len(data)
+
+        if self.framelog is not None and frame is not None:
+            if self.framestart is None:
+                self.framestart = segment["size"] - len(data)
+            if frame.frame_type != SPS_HEADER and frame.complete:
+                self.framelog.add(frame.timestamp, self.framestart,
+                                  segment["size"] - self.framestart,
+                                  frame.frame_type == KEY_FRAME)
+                self.framestart = None
+
+        if not self.requested and self._full(segment):
+            self.camera.request_key_frame()
+            self.requested = True
+
+        if self.annotate is not None:
+            second = strftime("%H%M%S")
+            if second != self.second:
+                self.camera.annotate_text = self.annotate.replace("{timestamp:%H%M%S}", second)
+                self.second = second
+
+        return len(data)
+
+
+    def flush(self):
+
+        self.writer.flush()
+
+
+    def close(self):
+
+        if self.framelog is not None:
+            self.framelog.close()
+        if self.muxer is not None:
+            self.muxer.close()
+        self.writer.close()
+
+
+class BufferOutput(object):
+
+    """
+    Video output that keeps the last seconds of video in memory, as groups
+    of frames that each start with the sequence headers of a keyframe. When
+    triggered, the buffered video is written to the triggered output
+    followed by the live video, without re-encoding, until released at the
+    next keyframe after which buffering continues. Switching is done inside
+    the encoder callback, so no frames are lost.
+
+    Parameters
+    -----------
+    camera : PiCamera
+        The camera that records to the output.
+    seconds : float
+        The minimum duration of video to keep in memory.
+    """
+
+    def __init__(self, camera, seconds):
+
+        self.camera = camera
+        self.frames = int(round(seconds * float(camera.framerate)))
+        self.groups = deque()
+        self.target = None
+        self.pending = None
+        self.releasing = False
+        self.released = Event()
+
+
+    @property
+    def size(self):
+
+        """The number of bytes of video in memory"""
+
+        return sum(size for _, size, _ in self.groups)
+
+
+    def write(self, data):
+
+        frame = self.camera.frame
+        keyframe = frame is not None and frame.frame_type == SPS_HEADER
+        if self.pending is not None and (len(self.groups) > 0 or keyframe):
+            for _, _, chunks in self.groups:
+                for chunk, chunkframe in chunks:
+                    self.pending.write(chunk, chunkframe)
+            self.groups.clear()
+            self.target, self.pending = self.pending, None
+
+        if self.target is not None:
+            if not (self.releasing and keyframe):
+                return self.target.write(data)
+            self.target = None
+            self.releasing = False
+            self.released.set()
+
+        if keyframe:
+            self.groups.append([frame.index, 0, []])
+            while len(self.groups) > 1 and \
+                  frame.index - self.groups[1][0] >= self.frames:
+                self.groups.popleft()
+        if len(self.groups) > 0:
+            self.groups[-1][1] += len(data)
+            self.groups[-1][2].append((bytes(data), frame))
+
+        return len(data)
+
+
+    def trigger(self, output):
+
+        """
+        Writes the buffered video to output, which should accept a frame
+        argument like SegmentOutput, and continues with the live video
+        """
+
+        self.released.clear()
+        self.pending = output
+
+
+    def release(self):
+
+        """
+        Stops writing to the triggered output at the next keyframe, which is
+        signalled by the released event
+        """
+
+        self.releasing = True
+        self.camera.request_key_frame()
+
+
+    def flush(self):
+
+        if self.target is not None:
+            self.target.flush()
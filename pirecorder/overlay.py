@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import cv2
+import time
+import numpy as np
+
+from pythutils.drawutils import namedcols, textdims, draw_text
+
+class NumberOverlay:
+
+    """
+    Fast drawing of frame numbers on video frames. The digits 0-9 and their
+    shadow are rendered once into a small atlas of pre-blended tiles, after
+    which a number is drawn by blending the tiles of its digits into the
+    frame. Output is near-identical to pythutils' draw_text(frame, str(nr),
+    loc, size, col=col, shadow=True), with small differences only where the
+    anti-aliased edges of neighbouring digits overlap.
+
+    Which method is faster depends on the OpenCV version, as newer versions
+    render text much faster themselves. By default both methods are timed
+    once on a copy of the first frame, after which the fastest one is used.
+
+    Parameters
+    -----------
+    loc : tuple, default = (10, 10)
+        The location of the text relative to the top left of the frame.
+    size : float, default = 0.9
+        The size of the text.
+    col : str, default = "white"
+        The color of the text.
+    shadow : bool, default = True
+        If a black shadow should be drawn around the text.
+    margin : int, default = 5
+        The margin around the text.
+    method : ["auto", "atlas", "text"], default = "auto"
+        If numbers should be drawn from the atlas ("atlas"), with draw_text
+        ("text"), or with the method that is fastest on the first frame.
+    """
+
+    def __init__(self, loc = (10, 10), size = 0.9, col = "white", shadow = True,
+                 margin = 5, method = "auto"):
+
+        if method not in ["auto", "atlas", "text"]:
+            raise ValueError("method should be 'auto', 'atlas' or 'text'..")
+        self.method = method
+        self.textargs = (loc, size, col, margin, shadow)
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        (_, th), topy, _ = textdims("0", size)
+        self.origin = (int(loc[0]+margin), int(loc[1]+margin+th+topy))
+
+        pad = 4
+        tw = cv2.getTextSize("0", font, size, 3)[0][0] + 2*pad
+        tilh = th + 2*pad + int(size*10)
+        self.offset = (pad, th + pad)
+
+        layers = [((0,0,0), 3)] if shadow else []
+        layers.append((namedcols(col), 1))
+        self.layers = []
+        for color, thickness in layers:
+            advance = (cv2.getTextSize("0"*101, font, size, thickness)[0][0] -
+                       cv2.getTextSize("0", font, size, thickness)[0][0]) / 100.
+            tiles = []
+            for digit in "0123456789":
+                black = np.zeros((tilh, tw, 3), np.uint8)
+                white = np.full((tilh, tw, 3), 255, np.uint8)
+                for canvas in (black, white):
+                    cv2.putText(canvas, digit, self.offset, font, size, color,
+                                thickness, cv2.LINE_AA)
+                black = black.astype(np.float32)
+                inv = (white.astype(np.float32) - black) / 255.
+                tiles.append((inv, black))
+            self.layers.append((advance, tiles))
+
+        # Merge shadow and text into a single tile per digit when both advance
+        # equally, so each digit only needs to be blended once
+        if len(self.layers) == 2 and self.layers[0][0] == self.layers[1][0]:
+            advance = self.layers[0][0]
+            tiles = [(cv2.multiply(sinv, tinv), cv2.add(cv2.multiply(spre, tinv), tpre))
+                     for (sinv, spre), (tinv, tpre) in zip(self.layers[0][1],
+                                                           self.layers[1][1])]
+            self.layers = [(advance, tiles)]
+
+
+    def _text(self, frame, number):
+
+        loc, size, col, margin, shadow = self.textargs
+        draw_text(frame, str(number), loc, size, col = col, margin = margin,
+                  shadow = shadow)
+
+        return frame
+
+
+    def calibrate(self, frame, rounds = 20):
+
+        """
+        Times both methods on a copy of frame and returns the fastest one,
+        which is used from then on
+        """
+
+        test = frame.copy()
+        times = {}
+        for method, func in [("atlas", self._atlas), ("text", self._text)]:
+            func(test, 88888)
+            start = time.perf_counter()
+            for i in range(rounds):
+                func(test, 10000 + i)
+            times[method] = time.perf_counter() - start
+        self.method = min(times, key = times.get)
+
+        return self.method
+
+
+    def draw(self, frame, number):
+
+        """Draws number on frame in place"""
+
+        if self.method == "auto":
+            self.calibrate(frame)
+        if self.method == "text":
+            return self._text(frame, number)
+
+        return self._atlas(frame, number)
+
+
+    def _atlas(self, frame, number):
+
+        fh, fw = frame.shape[:2]
+        y = self.origin[1] - self.offset[1]
+        for advance, tiles in self.layers:
+            for i, digit in enumerate(str(number)):
+                inv, pre = tiles[ord(digit)-48]
+                x = self.origin[0] + int(round(i*advance)) - self.offset[0]
+                h, w = inv.shape[:2]
+                x1, y1 = max(x, 0), max(y, 0)
+                x2, y2 = min(x+w, fw), min(y+h, fh)
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                if (x1, y1, x2, y2) != (x, y, x+w, y+h):
+                    inv = inv[y1-y:y2-y, x1-x:x2-x]
+                    pre = pre[y1-y:y2-y, x1-x:x2-x]
+                roi = frame[y1:y2, x1:x2]
+                cv2.add(cv2.multiply(roi, inv, dtype = cv2.CV_32F), pre,
+                        dst = roi, dtype = cv2.CV_8U)
+
+        return frame
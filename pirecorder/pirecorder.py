@@ -31,35 +31,26 @@ from ast import literal_eval
 from datetime import datetime
 from socket import gethostname
 from fractions import Fraction
-from time import sleep, strftime
+from threading import Event
+from time import sleep, strftime, time
 from localconfig import LocalConfig
 from pythutils.sysutils import Logger, lineprint, homedir, checkfrac, isrpi
 from pythutils.fileutils import name
 from pythutils.mediautils import picamconv
 
 from .stream import Stream
+from .outputs import SegmentOutput, BufferOutput, ImageWriter
+from .triggers import Triggers
+from .motion import MotionDetector, analysissize
+from .timing import Deadlines
+from .imgpack import ImagePack
+from .storage import Storage, vidsize, imgsize
+from .offload import Offloader
+from .warmup import warmup, logwarmup
 from .camconfig import Camconfig
 from .schedule import Schedule
 from .__version__ import __version__
 
-class VidOutput(object):
-
-    """
-    Video output object for continuous monitoring of file size while recording
-    """
-
-    def __init__(self, filename):
-        self.vid = io.open(filename, 'wb')
-        self.size = 0
-
-    def write(self, s):
-        self.vid.write(s)
-        self.size += len(s)
-
-    def flush(self):
-        self.vid.flush()
-
-
 class PiRecorder:
 
     """
@@ -72,6 +63,12 @@ class PiRecorder:
         The name of the configuration file to be used for recordings. If the
         file does not exist yet, automatically a new file with default
         configuration values will be created.
+    logging : bool, default = True
+        If the output should be logged to the pirecorder log file.
+    backend : str, default = "picamera"
+        The camera backend, either "picamera" for the raspberry pi camera, or
+        "sim" for a simulated camera that records synthetic images and videos
+        on any linux computer, e.g. to test and profile recordings.
 
     Returns
     -------
@@ -82,13 +79,15 @@ class PiRecorder:
         to schedule future recordings.
     """
 
-    def __init__(self, configfile = "pirecorder.conf", logging = True):
+    def __init__(self, configfile = "pirecorder.conf", logging = True,
+                 backend = "picamera"):
 
-        if not isrpi():
+        if backend != "sim" and not isrpi():
             lineprint("PiRecorder only works on a raspberry pi. Exiting..")
             return
 
         self.system = "auto"
+        self.backend = backend
         self.host = gethostname()
         self.home = homedir()
         self.setupdir = self.home + "pirecorder"
@@ -112,6 +111,10 @@ class PiRecorder:
         self.configfilerel = configfile
         self.configfile = self.setupdir + "/" + configfile
         self.nametypes = ("label","date","time","datetime","counter","rpi","")
+        self.keepcam = False
+        self.offloader = None
+        self.stopping = Event()
+        self.started = None
 
         self.config = LocalConfig(self.configfile, compact_form = True)
         overwrite = True
@@ -121,7 +124,7 @@ class PiRecorder:
                 if section not in list(self.config):
                     self.config.add_section(section)
             set = True
-        elif str(self.config).count("=")<36:
+        elif str(self.config).count("=")<55:
             overwrite = False
             set = True
         else:
@@ -131,12 +134,15 @@ class PiRecorder:
                           self.home + self.config.rec.recdir)
         if set:
             self.settings(overwrite=overwrite, internal="",
-                          recdir="pirecorder/recordings", subdirs=False, label="test", rectype="img", maxres="v2",
-                          automode=True, brightness=45, contrast=10, saturation=0, iso=200, sharpness=0, compensation=0,shutterspeed=8000,
+                          recdir="pirecorder/recordings", recvolumes=None, minfree=1000, offloaddir=None,
+                          offloadrate=0, offloadworkers=1, offloaddelete=False, subdirs=False, label="test", rectype="img", maxres="v2",
+                          automode=True, warmuptol=0.05, warmupmax=10, brightness=45, contrast=10, saturation=0, iso=200, sharpness=0, compensation=0,shutterspeed=8000,
                           rotation=0, brighttune=0, roi=None, gains=(1.0,2.5), annotatesize=0, nameparam1="label", nameparam2="date",
                           nameparam3="rpi", nameparam4="counter", nameparam5="time", imgdims=(2592,1944), 
-                          imgfps=1, imgwait=5.0, imgnr=12, imgtime=60, imgquality=50, viddims=(1640,1232),
-                          vidfps=24, vidduration=10, viddelay=10, vidquality=11, maxviddur=3600, maxvidsize=0)
+                          imgfps=1, imgwait=5.0, imgnr=12, imgtime=60, imgquality=50, imgwriters=2, imgoverrun="skip", imgburst=False, imgpack=False, viddims=(1640,1232),
+                          vidfps=24, vidduration=10, viddelay=10, vidquality=11, maxviddur=3600, maxvidsize=0,
+                          vidbuffer=10, motionthresh=15, motionarea=0.5, motionon=0.2, motionoff=5,
+                          vidformat="h264", vidsidecar=True)
             lineprint("Config settings stored and updated..")
 
 
@@ -162,8 +168,12 @@ class PiRecorder:
 
         """Sets up the raspberry pi camera based on the configuration"""
 
-        import picamera
-        import picamera.array
+        if self.backend == "sim":
+            from . import simcam as picamera
+            from .simcam import PiRGBArray
+        else:
+            import picamera
+            from picamera.array import PiRGBArray
 
         self.cam = picamera.PiCamera()
         self.cam.rotation = self.config.cus.rotation
@@ -176,7 +186,7 @@ class PiRecorder:
         if self.config.rec.rectype in ["img","imgseq"]:
             self.cam.resolution = literal_eval(self.config.img.imgdims)
             self.cam.framerate = self.config.img.imgfps
-        if self.config.rec.rectype in ["vid","vidseq"]:
+        if self.config.rec.rectype in ["vid","vidseq","vidbuffer","vidmotion"]:
             self.cam.resolution = picamconv(literal_eval(self.config.vid.viddims))
             self.cam.framerate = self.config.vid.vidfps
         
@@ -191,7 +201,7 @@ class PiRecorder:
             self.cam.zoom = literal_eval(self.config.cus.roi)
             w = int(self.cam.resolution[0] * self.cam.zoom[2])
             h = int(self.cam.resolution[1] * self.cam.zoom[3])
-            self.resize = picamconv((w, h)) if self.config.rec.rectype in ["vid", "vidseq"] else (w, h)
+            self.resize = picamconv((w, h)) if self.config.rec.rectype in ["vid", "vidseq", "vidbuffer", "vidmotion"] else (w, h)
 
         # Determine if long exposure is needed
         self.longexpo = False if self.cam.framerate >= 6 else True
@@ -201,14 +211,12 @@ class PiRecorder:
         self.cam.awb_mode = "auto"
         lineprint("Camera warming up..")
 
-        # Wait for the camera to adjust—time can be tuned depending on your framerate
-        if auto or self.config.cam.automode:
-            #self.cam.shutter_speed = 0
-            sleep(2)
-        elif self.cam.framerate >= 6:
-            sleep(6) if self.cam.framerate > 1.6 else sleep(10)
-        else:
-            sleep(2)
+        # Wait until the automatic exposure and white balance have settled
+        elapsed, converged, settings = warmup(self.cam, self.config.cam.warmuptol,
+                                              self.config.cam.warmupmax)
+        lineprint("Camera warmed up in "+str(round(elapsed,2))+"s"+\
+                  ("" if converged else ", exposure and white balance did not settle")+"..")
+        logwarmup(self.logfolder+"warmup.csv", self.host, elapsed, converged, settings)
 
         # If you’re using fixed settings (i.e. not in auto mode), lock the camera settings
         if not (auto or self.config.cam.automode):
@@ -222,7 +230,7 @@ class PiRecorder:
             # Use your preset shutter speed if provided; otherwise use the current exposure
             self.cam.shutter_speed = self.config.cam.shutterspeed if hasattr(self.config.cam, 'shutterspeed') else current_exposure
             # Apply preset gains if available; otherwise, keep auto-determined gains
-            self.cam.awb_gains = eval(self.config.cus.gains) if self.config.cus.gains else current_awb_gains
+            self.cam.awb_gains = literal_eval(str(self.config.cus.gains)) if self.config.cus.gains else current_awb_gains
             sleep(0.1)
 
         # Apply remaining fixed settings
@@ -233,7 +241,7 @@ class PiRecorder:
         self.cam.iso = self.config.cam.iso
         self.cam.sharpness = self.config.cam.sharpness
 
-        self.rawCapture = picamera.array.PiRGBArray(self.cam, size = self.cam.resolution)
+        self.rawCapture = PiRGBArray(self.cam, size = self.cam.resolution)
 
         self.maxvidsize = self.config.vid.maxvidsize if self.config.vid.maxvidsize>0 else 999
 
@@ -243,9 +251,13 @@ class PiRecorder:
         """
         Calculates minimum possible imgwait and imgnr based on imgtime. The
         minimum time between subsequent images is by default set to 0.45s, the
-        time it takes to take an image with max resolution.
+        time it takes to take an image with max resolution. In burst mode
+        images are taken from the video port, so the minimum time is that of
+        the maximum framerate of 40fps.
         """
 
+        if self.config.img.imgburst:
+            mintime = 0.025
         self.config.img.imgwait = max(mintime, self.config.img.imgwait)
         totimg = int(self.config.img.imgtime / self.config.img.imgwait)
         self.config.img.imgnr = min(self.config.img.imgnr, totimg)
@@ -268,7 +280,7 @@ class PiRecorder:
         is constructed from provided nameparams 1-5.
         """
 
-        self.filetype = ".jpg" if self.config.rec.rectype in ["img","imgseq"] else ".h264"
+        self.filetype = ".jpg" if self.config.rec.rectype in ["img","imgseq"] else "."+self.config.vid.vidformat
         nparlist = [self.config.cus.nameparam1,self.config.cus.nameparam2,self.config.cus.nameparam3,
                     self.config.cus.nameparam4,self.config.cus.nameparam5]
 
@@ -300,6 +312,54 @@ class PiRecorder:
             self.filename = subdir+"/"+self.filename
 
 
+    def _seqname(self, kind, ext, timestamp):
+
+        """
+        Returns the name of a file that belongs to an image sequence, with
+        the image counter in the filename replaced by kind
+        """
+
+        name = self.filename
+        for count in ["im{counter:05d}", "im{counter:03d}"]:
+            name = name.replace(count, kind)
+        if name == self.filename:
+            name = name[:-len(self.filetype)]+"_"+kind+self.filetype
+
+        return name.format(timestamp = timestamp)[:-len(self.filetype)]+ext
+
+
+    def _projected(self, duration = None):
+
+        """
+        Returns the projected size in bytes of a recording as configured, or
+        of a single video for the vidseq, vidbuffer and vidmotion rectypes,
+        or of a video of duration seconds
+        """
+
+        if self.config.rec.rectype in ["img", "imgseq"]:
+            nr = 1 if self.config.rec.rectype == "img" else self.config.img.imgnr
+            return nr * imgsize(literal_eval(str(self.config.img.imgdims)),
+                                self.config.img.imgquality)
+
+        if duration is None:
+            duration = self.config.vid.vidduration + self.config.vid.viddelay
+        return vidsize(literal_eval(str(self.config.vid.viddims)), self.config.vid.vidfps,
+                       self.config.vid.vidquality, duration)
+
+
+    def _segsize(self, duration):
+
+        """Returns the projected size in bytes of a single video segment"""
+
+        if 0 < self.config.vid.maxviddur < duration:
+            duration = self.config.vid.maxviddur
+        size = self._projected(duration)
+        if self.config.vid.maxvidsize > 0:
+            size = min(size, int(self.config.vid.maxvidsize * 1000000))
+
+        return size
+
+
     def autoconfig(self):
 
         """
@@ -341,18 +401,50 @@ class PiRecorder:
             created inside the home directory. If no name is provided (""), the
             files are stored in the home directory. If "NAS" is provided it will
             additionally check if the folder links to a mounted drive.
+        recvolumes : list, default = None
+            Directories on other storage volumes, e.g. usb drives, to continue
+            recording in when recdir is full, in order of use. Directories
+            that are not absolute are relative to the home directory.
+        minfree : int, default = 1000
+            The free space in MB to keep on each recording volume. Recording
+            continues on the next volume before this limit is reached, and
+            recordings whose projected size does not fit on the volumes are
+            not started.
+        offloaddir : str, default = None
+            The directory, e.g. on a mounted NAS, to copy recordings to in
+            the background as soon as each file is finished. Directories that
+            are not absolute are relative to the home directory. If None,
+            recordings are not offloaded.
+        offloadrate : float, default = 0
+            The maximum rate in MB/s at which recordings are offloaded. 0
+            means no limit.
+        offloadworkers : int, default = 1
+            The number of files that are offloaded simultaneously.
+        offloaddelete : bool, default = False
+            If recordings should be deleted after they are offloaded and the
+            checksum of their copy is verified.
         subdirs : bool, default = False
             If files of individual recordings should be stored in subdirectories
             or not, to keep all files of a single recording session together.
         label : str, default = "test"
             Label that will be associated with the specific recording and stored
             in the filenames.
-        rectype : ["img", "imgseq", "vid", "vidseq"], default = "img"
+        rectype : ["img", "imgseq", "vid", "vidseq", "vidbuffer", "vidmotion"], default = "img"
             Recording type, either a single image or video or a sequence of
-            images or videos.
+            images or videos, or "vidbuffer" to continuously keep the last
+            vidbuffer seconds of video in memory and record videos that
+            include this video from before the moment they were triggered,
+            or "vidmotion" to do the same but trigger and stop videos with
+            motion detected in the region of interest.
         automode : bool, default = True
             If the shutterspeed and white balance should be set automatically
             and dynamically for each recording.
+        warmuptol : float, default = 0.05
+            The relative change in exposure speed, gains and white balance
+            gains between checks below which the camera is considered warmed
+            up before a recording.
+        warmupmax : float, default = 10
+            The maximum time in seconds to wait for the camera to warm up.
         maxres : str or tuple, default = "v2"
             The maximum potential resolution of the camera used. Either provide
             a tuple of the max resolution, or use "v1.3", "v1.5", "v2" (default)
@@ -442,6 +534,29 @@ class PiRecorder:
             Specifies the quality that the jpeg encoder should attempt to
             maintain. Use values between 1 and 100, where higher values are
             higher quality.
+        imgwriters : int, default = 2
+            The number of background threads that write the images of an
+            image sequence to file, so that capturing images does not wait
+            for storage. With 0, each image is written to file directly
+            after it has been captured.
+        imgburst : bool, default = False
+            If image sequences should be taken from the video port instead of
+            the still port. This makes it possible to take up to 40 images per
+            second, limited by the framerate of the camera, at the cost of
+            lower image quality and with a maximum resolution of the video
+            port (e.g. 1640 x 1232 for the v2 camera).
+        imgpack : bool, default = False
+            If the images of an image sequence should be stored together in a
+            single packed file (.mjpeg) with an index of the frame number and
+            time of each image, instead of as individual files. Packed image
+            sequences can be read with ImagePack, exported to individual
+            images with the unpack command and converted to video directly.
+        imgoverrun : ["skip", "catchup"], default = "skip"
+            What to do when capturing an image in a sequence took longer than
+            imgwait. With "skip" the images that could not be taken in time
+            are skipped and the sequence continues at the next interval, with
+            "catchup" they are taken directly one after the other until the
+            sequence is back on schedule.
         vidduration : int, default = 10
             Duration of video recording in seconds.
         viddelay : int, default = 0
@@ -449,6 +564,17 @@ class PiRecorder:
             Its use is to add a standard amount of time to the video that can be
             easily cropped or skipped, such as for tracking, but still provides
             useful information, such as behaviour during acclimation.
+        vidformat : ["h264", "mp4"], default = "h264"
+            The format videos are stored in, either raw h264 streams that need
+            to be converted to be played with correct timing, or mp4 files
+            that are written directly while recording, with the timestamps of
+            the camera, and that are directly playable.
+        vidsidecar : bool, default = True
+            If a sidecar file (.frames) should be stored with each video, with
+            for each frame its timestamp, position in the video, if it is a
+            keyframe, and the exposure and gains of the camera. Convert uses
+            the timestamps to create videos with the exact timing of the
+            recording.
         vidquality : int, default = 11
             Specifies the quality that the h264 encoder should attempt to
             maintain. Use values between 10 and 40, where 10 is extremely high
@@ -461,6 +587,22 @@ class PiRecorder:
             The maximum file size in Megabytes for single videos, beyond which
             videos will be automatically split. A value of 0 indicates there is
             no maximum file size.
+        vidbuffer : int, default = 10
+            The duration in seconds of video kept in memory with the
+            "vidbuffer" and "vidmotion" rectypes, which is stored before the
+            triggered video.
+        motionthresh : int, default = 15
+            The minimum change in pixel intensity, between 0 and 255, for a
+            pixel to count as moving with the "vidmotion" rectype.
+        motionarea : float, default = 0.5
+            The percentage of pixels in the region of interest that need to
+            move for a frame to count as having motion.
+        motionon : float, default = 0.2
+            The duration in seconds that motion needs to continue before a
+            video is triggered.
+        motionoff : float, default = 5
+            The duration in seconds without motion after which a triggered
+            video is stopped.
         nameparam1-5: str, default = ("label","date","rpi","counter","time")
             The elements of the filename to include
         """
@@ -468,6 +610,18 @@ class PiRecorder:
 
         if ("recdir" in kwargs and overwrite) or ("recdir" not in str(self.config) and not overwrite):
                 self.config.rec.recdir = kwargs["recdir"]
+        if ("recvolumes" in kwargs and overwrite) or ("recvolumes" not in str(self.config) and not overwrite):
+            self.config.rec.recvolumes = kwargs["recvolumes"]
+        if ("minfree" in kwargs and overwrite) or ("minfree" not in str(self.config) and not overwrite):
+            self.config.rec.minfree = kwargs["minfree"]
+        if ("offloaddir" in kwargs and overwrite) or ("offloaddir" not in str(self.config) and not overwrite):
+            self.config.rec.offloaddir = kwargs["offloaddir"]
+        if ("offloadrate" in kwargs and overwrite) or ("offloadrate" not in str(self.config) and not overwrite):
+            self.config.rec.offloadrate = kwargs["offloadrate"]
+        if ("offloadworkers" in kwargs and overwrite) or ("offloadworkers" not in str(self.config) and not overwrite):
+            self.config.rec.offloadworkers = kwargs["offloadworkers"]
+        if ("offloaddelete" in kwargs and overwrite) or ("offloaddelete" not in str(self.config) and not overwrite):
+            self.config.rec.offloaddelete = kwargs["offloaddelete"]
         if ("subdirs" in kwargs and overwrite) or ("subdirs" not in str(self.config) and not overwrite):
             self.config.rec.subdirs = kwargs["subdirs"]
         if ("label" in kwargs and overwrite) or ("label" not in str(self.config) and not overwrite):
@@ -532,6 +686,10 @@ class PiRecorder:
 
         if ("automode" in kwargs and overwrite) or ("automode" not in str(self.config) and not overwrite):
             self.config.cam.automode = kwargs["automode"]
+        if ("warmuptol" in kwargs and overwrite) or ("warmuptol" not in str(self.config) and not overwrite):
+            self.config.cam.warmuptol = kwargs["warmuptol"]
+        if ("warmupmax" in kwargs and overwrite) or ("warmupmax" not in str(self.config) and not overwrite):
+            self.config.cam.warmupmax = kwargs["warmupmax"]
         if ("brightness" in kwargs and overwrite) or ("brightness" not in str(self.config) and not overwrite):
             self.config.cam.brightness = kwargs["brightness"]
         if ("contrast" in kwargs and overwrite) or ("contrast" not in str(self.config) and not overwrite):
@@ -564,17 +722,39 @@ class PiRecorder:
             self.config.img.imgtime = kwargs["imgtime"]
         if ("imgquality" in kwargs and overwrite) or ("imgquality" not in str(self.config) and not overwrite):
             self.config.img.imgquality = kwargs["imgquality"]
+        if ("imgwriters" in kwargs and overwrite) or ("imgwriters" not in str(self.config) and not overwrite):
+            self.config.img.imgwriters = kwargs["imgwriters"]
+        if ("imgoverrun" in kwargs and overwrite) or ("imgoverrun" not in str(self.config) and not overwrite):
+            self.config.img.imgoverrun = kwargs["imgoverrun"]
+        if ("imgburst" in kwargs and overwrite) or ("imgburst" not in str(self.config) and not overwrite):
+            self.config.img.imgburst = kwargs["imgburst"]
+        if ("imgpack" in kwargs and overwrite) or ("imgpack" not in str(self.config) and not overwrite):
+            self.config.img.imgpack = kwargs["imgpack"]
 
         if ("vidduration" in kwargs and overwrite) or ("vidduration" not in str(self.config) and not overwrite):
             self.config.vid.vidduration = kwargs["vidduration"]
         if ("viddelay" in kwargs and overwrite) or ("viddelay" not in str(self.config) and not overwrite):
             self.config.vid.viddelay = kwargs["viddelay"]
+        if ("vidformat" in kwargs and overwrite) or ("vidformat" not in str(self.config) and not overwrite):
+            self.config.vid.vidformat = kwargs["vidformat"]
+        if ("vidsidecar" in kwargs and overwrite) or ("vidsidecar" not in str(self.config) and not overwrite):
+            self.config.vid.vidsidecar = kwargs["vidsidecar"]
         if ("vidquality" in kwargs and overwrite) or ("vidquality" not in str(self.config) and not overwrite):
             self.config.vid.vidquality = kwargs["vidquality"]
         if ("maxviddur" in kwargs and overwrite) or ("maxviddur" not in str(self.config) and not overwrite):
             self.config.vid.maxviddur = kwargs["maxviddur"]
         if ("maxvidsize" in kwargs and overwrite) or ("maxvidsize" not in str(self.config) and not overwrite):
             self.config.vid.maxvidsize = kwargs["maxvidsize"]
+        if ("vidbuffer" in kwargs and overwrite) or ("vidbuffer" not in str(self.config) and not overwrite):
+            self.config.vid.vidbuffer = kwargs["vidbuffer"]
+        if ("motionthresh" in kwargs and overwrite) or ("motionthresh" not in str(self.config) and not overwrite):
+            self.config.vid.motionthresh = kwargs["motionthresh"]
+        if ("motionarea" in kwargs and overwrite) or ("motionarea" not in str(self.config) and not overwrite):
+            self.config.vid.motionarea = kwargs["motionarea"]
+        if ("motionon" in kwargs and overwrite) or ("motionon" not in str(self.config) and not overwrite):
+            self.config.vid.motionon = kwargs["motionon"]
+        if ("motionoff" in kwargs and overwrite) or ("motionoff" not in str(self.config) and not overwrite):
+            self.config.vid.motionoff = kwargs["motionoff"]
 
         brightchange = False
         if os.path.exists(self.brightfile):
@@ -626,7 +806,7 @@ class PiRecorder:
 
 
     def schedule(self, jobname = None, timeplan = None, enable = True,
-                 showjobs = False, delete = None, test = False):
+                 showjobs = False, delete = None, test = False, daemon = False):
 
         """
         Schedule future recordings
@@ -668,6 +848,12 @@ class PiRecorder:
             The name of the configuration file to be used for the scheduled
             recordings. Make sure the file exists, otherwise the default
             configuration settings will be used.
+        daemon : bool, default = False
+            If the scheduled job should only send a record command to the
+            pirecorderd daemon, which keeps the camera open and configured,
+            instead of starting a new recorder. This reduces the time from
+            the scheduled time to the first frame from seconds to tens of
+            milliseconds. The daemon should run with the same configfile.
 
         Note: Make sure Recorder configuration timing settings are within the
         timespan between subsequent scheduled recordings based on the provided
@@ -678,17 +864,138 @@ class PiRecorder:
 
         S = Schedule(jobname, timeplan, enable, showjobs, delete, test,
                      logfolder = self.logfolder, internal=True,
-                     configfile = self.configfilerel)
+                     configfile = self.configfilerel, daemon = daemon)
+
+
+    def _vidinfo(self, video):
+
+        """Prints information on the videos recorded with a SegmentOutput"""
+
+        fps = float(self.cam.framerate)
+        for i, segment in enumerate(video.segments):
+            vidinfo = " ("+str(round(segment["frames"]/fps))+"s; "+\
+                      str(round(segment["size"]/1000000,2))+"MB; "+\
+                      str(segment["frames"])+" frames, "+\
+                      str(segment["dropped"])+" dropped"
+            if i > 0:
+                vidinfo += ", "+str(segment["gap"])+" lost at split"
+            lineprint("Finished recording "+segment["filename"]+vidinfo+")")
+        writer = video.writer
+        lineprint("Stored "+str(round(writer.written/1000000.,2))+"MB, max "+\
+                  str(writer.maxdepth)+"/"+str(writer.buffers)+\
+                  " buffers queued, longest write "+\
+                  str(round(writer.maxstall,3))+"s")
+
 
+    def trigger(self, command = "trigger"):
 
-    def record(self):
+        """
+        Triggers a video recording when recording with the "vidbuffer" or
+        "vidmotion" rectype, or stops the recording with command "stop"
+        """
+
+        if getattr(self, "triggers", None) is None:
+            lineprint("No vidbuffer or vidmotion recording running to trigger..")
+            return
+        self.triggers.trigger(command)
+
+
+    def stop(self):
+
+        """
+        Stops a running recording from another thread, after the current
+        image or video
+        """
+
+        self.stopping.set()
+        if getattr(self, "triggers", None) is not None:
+            self.triggers.trigger("stop")
+
+
+    def _started(self):
+
+        """Stores the time the first image or frame of a recording arrived"""
+
+        if self.started is None:
+            self.started = time()
+
+
+    def _wait(self, duration):
+
+        """Records video for duration seconds or until stopped"""
+
+        end = time() + duration
+        while not self.stopping.is_set() and time() < end:
+            self.cam.wait_recording(min(0.2, max(0, end - time())))
+
+
+    def record(self, interactive = True):
 
         """
         Starts a recording as configured and returns either one or multiple
-        .h264 or .jpg files that are named automatically
+        .h264, .mp4 or .jpg files that are named automatically. With the "vidbuffer"
+        rectype, videos are recorded whenever triggered by creating the file
+        "trigger" in the pirecorder folder, by the SIGUSR1 signal, by sending
+        "trigger" to the unix socket "trigger.sock" in the pirecorder folder,
+        or with the trigger function, until stopped by sending "stop" or with
+        Ctrl+C. With the "vidmotion" rectype, videos are also triggered when
+        motion is detected in a low resolution stream of the camera, and
+        continue until there has been no motion for motionoff seconds
+
+        Parameters
+        ----------
+        interactive : bool, default = True
+            If video recordings should wait for the user to press Enter before
+            starting each session. If False, recording starts directly and
+            vidseq recordings stop after the first session.
+
+        A recording can be stopped early from another thread with the stop
+        function. With keepcam set to True, the camera is kept open after a
+        recording and reused by the next one, as by the pirecorderd daemon,
+        and so is the offloader. Otherwise offloading is given at most 30
+        seconds to finish at the end of a recording, and files that have not
+        been offloaded yet are listed and offloaded the next time, or with the
+        offload command.
         """
 
-        self._setup_cam()
+        self.stopping.clear()
+        self.started = None
+
+        volumes = []
+        if self.config.rec.recvolumes is not None:
+            volumes = [os.path.join(self.home, volume) for volume in
+                       literal_eval(str(self.config.rec.recvolumes))]
+        self.storage = Storage([self.recdir] + volumes, self.config.rec.minfree)
+        projected = self._projected()
+        if not self.storage.fits(projected):
+            lineprint("Projected recording size of "+str(round(projected/1000000.))+\
+                      "MB does not fit in the "+\
+                      str(round(self.storage.available()/1000000.))+\
+                      "MB available, not recording..")
+            return
+        offload = None
+        if self.config.rec.offloaddir is not None:
+            settings = (os.path.abspath(os.path.join(self.home, self.config.rec.offloaddir)),
+                        [os.path.abspath(volume) for volume in self.storage.volumes],
+                        float(self.config.rec.offloadrate),
+                        int(self.config.rec.offloadworkers),
+                        self.config.rec.offloaddelete)
+            if self.offloader is not None and (self.offloader.stopped.is_set() or\
+               self.offloadsettings != settings):
+                self.offloader.close(wait = False)
+                self.offloader = None
+            if self.offloader is None:
+                self.offloader = Offloader(settings[0], self.storage.volumes,
+                                           settings[2], settings[3], settings[4],
+                                           self.setupdir+"/offload.pending")
+                self.offloadsettings = settings
+            offload = self.offloader.add
+        elif self.offloader is not None:
+            self.offloader.close(wait = False)
+            self.offloader = None
+
+        if not self.keepcam or getattr(self, "cam", None) is None or self.cam.closed:
+            self._setup_cam()
         self._namefile()
         startdate = datetime.now()
 
@@ -698,9 +1005,13 @@ class PiRecorder:
                 filename = self.filename.replace("{timestamp:%H%M%S}",strftime("%H%M%S"))
             if self.config.cus.annotatesize > 5:
                 self.cam.annotate_text = filename.replace(".jpg","").split("/",1)[0]
+            filename = self.storage.path(filename, projected)
             self.cam.capture(filename, format="jpeg", resize = self.resize,
                              quality = self.config.img.imgquality)
+            self._started()
             lineprint("Captured "+filename)
+            if offload is not None:
+                offload(filename)
 
         elif self.config.rec.rectype == "imgseq":
 
@@ -713,19 +1024,67 @@ class PiRecorder:
                     filename = filename.replace("{counter:05d}","00001").split("/",1)[::-1][0]
                 self.cam.annotate_text = filename.replace(".jpg","")
             counter= 1
-            for i, img in enumerate(self.cam.capture_continuous(self.filename,
-                                    format="jpeg", resize = self.resize,
+            writer = None
+            pack = None
+            if self.config.img.imgpack:
+                pack = ImagePack(self.storage.path(self._seqname("pack", ".mjpeg",
+                                 starttime), projected), "a")
+                writer = ImageWriter(pack = pack, storage = self.storage)
+                lineprint("Storing images in "+pack.filename)
+            elif self.config.img.imgwriters > 0:
+                writer = ImageWriter(threads = self.config.img.imgwriters,
+                                     storage = self.storage, onclose = offload)
+            logname = self._seqname("timing", ".csv", starttime)
+            burst = self.config.img.imgburst
+            if burst:
+                # Report the size of a test image to show the load on storage
+                stream = BytesIO()
+                self.cam.capture(stream, format = "jpeg", use_video_port = True,
+                                 resize = self.resize,
+                                 quality = self.config.img.imgquality)
+                imgmb = stream.tell() / 1000000.
+                rate = min(1. / self.config.img.imgwait, float(self.cam.framerate))
+                lineprint("Burst mode: "+str(self.resize[0])+"x"+str(self.resize[1])+\
+                          " images of quality "+str(self.config.img.imgquality)+\
+                          " from the video port, "+str(round(rate,1))+" of max "+\
+                          str(round(float(self.cam.framerate),1))+" images/s")
+                lineprint("Burst mode: ~"+str(round(imgmb*1000))+"KB per image, ~"+\
+                          str(round(imgmb*rate,2))+"MB/s to storage, lower "+\
+                          "imgquality or imgdims for higher rates..")
+            timer = Deadlines(self.config.img.imgwait, self.config.img.imgoverrun,
+                              logname, self.stopping)
+            for i, img in enumerate(self.cam.capture_continuous(writer or self.filename,
+                                    format="jpeg", use_video_port = burst,
+                                    resize = self.resize,
                                     quality = self.config.img.imgquality)):
+                timer.captured()
+                self._started()
+                if writer is not None:
+                    img = self.filename.format(counter = counter, timestamp = timepoint)
+                    if pack is None:
+                        img = self.storage.path(img, projected // self.config.img.imgnr)
+                    writer.save(img, counter, timepoint.timestamp())
+                    if pack is not None:
+                        img = "image "+str(counter)
+                elif offload is not None:
+                    offload(img)
                 counter += 1
                 if startdate.day < datetime.now().day:
+                    if writer is not None:
+                        writer.close()
+                    if pack is not None:
+                        pack.close()
+                    timer.close()
                     self.cam.close()
                     self.record()
-                tottimepassed = (datetime.now() - starttime).total_seconds()
-                if i < self.config.img.imgnr-1 and tottimepassed < self.config.img.imgtime:
-                    timepassed = (datetime.now() - timepoint).total_seconds()
-                    delay = max(0, self.config.img.imgwait - timepassed)
-                    lineprint("Captured "+img+", sleeping "+str(round(delay,2))+"s..")
-                    sleep(delay)
+                tottimepassed = timer.elapsed()
+                if i < self.config.img.imgnr-1 and tottimepassed < self.config.img.imgtime\
+                   and not self.stopping.is_set():
+                    delay = timer.remaining()
+                    if not burst or i % max(1, int(rate)) == 0:
+                        lineprint("Captured "+img+", sleeping "+str(round(delay,2))+"s..")
+                    if timer.wait() is None:
+                        break
                     timepoint = datetime.now()
                     if self.config.cus.annotatesize>5:
                         if "{timestamp:%H%M%S}" in self.filename:
@@ -736,6 +1095,30 @@ class PiRecorder:
                 else:
                     lineprint("Captured "+img)
                     break
+            if writer is not None:
+                writer.close()
+                latencies = sorted(writer.latencies)
+                if len(latencies) > 0:
+                    lineprint("Stored "+str(writer.saved)+" images, max "+\
+                              str(writer.maxdepth)+"/"+str(writer.buffers)+\
+                              " buffers queued, write time mean "+\
+                              str(round(sum(latencies)/len(latencies),3))+"s, 95% "+\
+                              str(round(latencies[int(0.95*(len(latencies)-1))],3))+\
+                              "s, max "+str(round(latencies[-1],3))+"s")
+            if pack is not None:
+                pack.close()
+                if offload is not None:
+                    offload(pack.filename)
+                    offload(pack.indexfile)
+            timer.close()
+            if offload is not None:
+                offload(logname)
+            timing = timer.summary()
+            lineprint("Capture timing: "+str(round(timing["p50"]*1000,1))+\
+                      "ms median, "+str(round(timing["p99"]*1000,1))+"ms 99% and "+\
+                      str(round(timing["max"]*1000,1))+"ms max delay, "+\
+                      str(timing["skipped"])+" skipped, "+str(round(timing["rate"],2))+\
+                      " images/s, log stored in "+logname)
 
         elif self.config.rec.rectype in ["vid","vidseq"]:
 
@@ -746,51 +1129,146 @@ class PiRecorder:
             # self.cam.stop_recording()
 
             # Wait for user input before starting the first video session
-            input("Press Enter to start the first video session...")
+            if interactive:
+                input("Press Enter to start the first video session...")
         
             for session in ["_S%02d" % i for i in range(1,999)]:
                 if "{timestamp:%H%M%S}" in self.filename:
                     filename = self.filename.replace("{timestamp:%H%M%S}",strftime("%H%M%S"))
                 session = "" if self.config.rec.rectype == "vid" else session
-                filename = filename.replace(".h264",session)
-                timeremaining = self.config.vid.vidduration+self.config.vid.viddelay
-                counter = 0
-                while timeremaining > 0:
-                    counter += 1
-                    waittime = timeremaining
-                    if self.config.vid.maxviddur > 0:
-                        waittime = min(timeremaining, self.config.vid.maxviddur)
-                    if waittime == timeremaining and self.config.vid.maxvidsize == 0:
-                        nr = ""
-                    else:
-                        nr = "_v"+str(counter).zfill(2)
-                    finalname = filename+nr+self.filetype
-                    video = VidOutput(finalname)
-                    if self.config.cus.annotatesize > 5:
-                        self.cam.annotate_text = finalname.replace(".h264","").split("/",1)[::-1][0]
-                    self.cam.start_recording(video, resize = self.resize,
-                                            quality = self.config.vid.vidquality,
-                                            level = "4.2",
-                                            format = self.filetype[1:])
-                    lineprint("Start recording "+filename)
-                    rectime = 0
-                    while video.size < self.maxvidsize*1000000 and rectime < waittime:
-                        rectime += 0.1
-                        if self.config.cus.annotatesize > 5:
-                            filename = self.filename.replace("{timestamp:%H%M%S}",strftime("%H%M%S"))
-                            self.cam.annotate_text = filename.replace(".h264","").split("/",1)[::-1][0]
-                        self.cam.wait_recording(0.1)
-                    timeremaining -= rectime
-                    self.cam.stop_recording()
-                    vidinfo = " ("+str(round(rectime))+"s; "+str(round(video.size/1000000,2))+"MB)"
-                    lineprint("Finished recording "+finalname+vidinfo)
-                if self.config.rec.rectype == "vid":
+                filename = filename.replace(self.filetype,session)
+                duration = self.config.vid.vidduration+self.config.vid.viddelay
+                maxdur = self.config.vid.maxviddur
+                numbered = self.config.vid.maxvidsize > 0 or 0 < maxdur < duration
+                segsize = self._segsize(duration)
+                annotate = None
+                if self.config.cus.annotatesize > 5:
+                    annotate = self.filename.replace(self.filetype,"").split("/",1)[::-1][0]
+                video = SegmentOutput(self.cam, filename, self.filetype, maxdur,
+                                      self.config.vid.maxvidsize, numbered, annotate,
+                                      sidecar = self.config.vid.vidsidecar,
+                                      storage = self.storage, prealloc = segsize,
+                                      onclose = offload, onstart = self._started)
+                self.cam.start_recording(video, resize = self.resize,
+                                        quality = self.config.vid.vidquality,
+                                        level = "4.2", inline_headers = True,
+                                        format = "h264")
+                lineprint("Start recording "+filename)
+                self._wait(duration)
+                self.cam.stop_recording()
+                video.close()
+                self._vidinfo(video)
+                if self.config.rec.rectype == "vid" or not interactive or\
+                   self.stopping.is_set():
                     break
                 else:
                     msg = "\nPress Enter for new session, or e and Enter to exit: "
                     if input(msg) == "e":
                         break
-        self.cam.close()
+        elif self.config.rec.rectype in ["vidbuffer", "vidmotion"]:
+
+            duration = self.config.vid.vidduration+self.config.vid.viddelay
+            maxdur = self.config.vid.maxviddur
+            numbered = self.config.vid.maxvidsize > 0 or 0 < maxdur < duration
+            segsize = self._segsize(duration)
+            annotate = None
+            if self.config.cus.annotatesize > 5:
+                annotate = self.filename.replace(self.filetype,"").split("/",1)[::-1][0]
+            buffer = BufferOutput(self.cam, self.config.vid.vidbuffer)
+            self.triggers = Triggers(self.setupdir+"/trigger",
+                                     self.setupdir+"/trigger.sock")
+            self.cam.start_recording(buffer, resize = self.resize,
+                                     quality = self.config.vid.vidquality,
+                                     level = "4.2", inline_headers = True,
+                                     format = "h264")
+            detector = None
+            if self.config.rec.rectype == "vidmotion":
+                fps = float(self.cam.framerate)
+                size = analysissize(self.resize)
+                detector = MotionDetector(size, None, self.config.vid.motionthresh,
+                                          self.config.vid.motionarea,
+                                          round(self.config.vid.motionon * fps),
+                                          round(self.config.vid.motionoff * fps),
+                                          callback = self.triggers.trigger)
+                self.cam.start_recording(detector, format = "yuv", resize = size,
+                                         splitter_port = 2)
+                lineprint("Detecting motion at "+str(size[0])+"x"+str(size[1])+\
+                          " pixels..")
+            lineprint("Keeping last "+str(self.config.vid.vidbuffer)+\
+                      "s of video in memory, waiting for triggers..")
+            try:
+                while True:
+                    command = self.triggers.wait(1)
+                    self.cam.wait_recording(0)
+                    if command is None or command == "release":
+                        continue
+                    if command == "stop":
+                        break
+                    filename = self.filename.replace("{timestamp:%H%M%S}",strftime("%H%M%S"))
+                    video = SegmentOutput(self.cam, filename[:-len(self.filetype)],
+                                          self.filetype, maxdur,
+                                          self.config.vid.maxvidsize, numbered, annotate,
+                                          sidecar = self.config.vid.vidsidecar,
+                                          storage = self.storage, prealloc = segsize,
+                                          onclose = offload, onstart = self._started,
+                                          preroll = self.config.vid.vidbuffer)
+                    buffer.trigger(video)
+                    if detector is None:
+                        lineprint("Triggered, recording "+filename)
+                        self._wait(duration)
+                    else:
+                        # Follow the motion, or record vidduration when
+                        # triggered manually while there is no motion
+                        motion = detector.motion
+                        lineprint(("Motion detected" if motion else "Triggered")+\
+                                  ", recording "+filename)
+                        end = time() + duration
+                        while command != "stop":
+                            command = self.triggers.wait(1)
+                            self.cam.wait_recording(0)
+                            if detector.exception is not None:
+                                raise detector.exception
+                            if command == "trigger" and detector.motion:
+                                motion = True
+                            elif command == "release" and motion:
+                                break
+                            elif not motion and time() > end:
+                                break
+                    buffer.release()
+                    while not buffer.released.wait(1):
+                        self.cam.wait_recording(0)
+                    video.close()
+                    self._vidinfo(video)
+                    if command == "stop" or (detector is None and\
+                                             self.triggers.clear() == "stop"):
+                        break
+                    lineprint("Waiting for triggers..")
+            except KeyboardInterrupt:
+                lineprint("Buffered recording stopped..")
+            finally:
+                if detector is not None:
+                    self.cam.stop_recording(splitter_port = 2)
+                    detector.close()
+                    lineprint("Analysed "+str(detector.analysed)+" of "+\
+                              str(detector.frames)+" frames for motion..")
+                self.cam.stop_recording()
+                self.triggers.close()
+                self.triggers = None
+
+        if not self.keepcam:
+            self.cam.close()
+        if not self.keepcam and self.offloader is not None:
+            self.offloader.close(timeout = 30)
+            for filename in self.offloader.pending:
+                lineprint("Not offloaded yet: "+filename)
+            for volume in self.offloader.roots:
+                if any(filename.startswith(volume+os.sep)
+                       for filename in self.offloader.pending):
+                    lineprint("Run offload "+volume+" "+self.offloader.target+\
+                              " to offload them now..")
+            self.offloader = None
+        if self.config.rec.rectype != "img":
+            self.storage.summary()
 
 
 def rec():
@@ -804,10 +1282,19 @@ def rec():
                         default="pirecorder.conf",
                         action="store",
                         help="pirecorder configuration file")
+    parser.add_argument("-b",
+                        "--backend",
+                        default="picamera",
+                        choices=["picamera", "sim"],
+                        help="camera backend, sim for a simulated camera")
+    parser.add_argument("-n",
+                        "--noninteractive",
+                        action="store_true",
+                        help="start video recordings without waiting for Enter")
     args = parser.parse_args()
-    if not isrpi():
+    if args.backend != "sim" and not isrpi():
         lineprint("PiRecorder only works on a raspberry pi. Exiting..")
         return
-    rec = PiRecorder(args.configfile)
+    rec = PiRecorder(args.configfile, backend = args.backend)
     rec.settings(internal = True)
-    rec.record()
+    rec.record(interactive = not args.noninteractive)
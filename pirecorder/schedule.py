@@ -27,6 +27,7 @@ import datetime
 from pythutils.sysutils import lineprint
 from cron_descriptor import get_description
 
+from .daemon import clientcode, socketpath
 from .__version__ import __version__
 
 class Schedule:
@@ -39,7 +40,7 @@ class Schedule:
     def __init__(self, jobname = None, timeplan = None, enable = None,
                  showjobs = False, delete = None, test = False,
                  internal = False, configfile = "pirecorder.conf",
-                 logfolder = "/home/pi/pirecorder/"):
+                 logfolder = "/home/pi/pirecorder/", daemon = False):
 
         if internal:
             lineprint("Running schedule function.. ")
@@ -49,8 +50,13 @@ class Schedule:
         if jobname is not None:
             self.jobname = "REC_" + jobname
             pexec = sys.executable + " -c "
-            pcomm1 = """'import pirecorder; """
-            pcomm2 = """R=pirecorder.PiRecorder("%s"); R.record()'""" % configfile
+            if daemon:
+                # Only send a command to the running pirecorderd daemon
+                pcomm1 = ""
+                pcomm2 = "'" + clientcode(socketpath(), "record", configfile) + "'"
+            else:
+                pcomm1 = """'import pirecorder; """
+                pcomm2 = """R=pirecorder.PiRecorder("%s"); R.record()'""" % configfile
             log1 = " >> " + logfolder + "$(date +%y%m%d)_"
             log2 = str(self.jobname[4:])+".log 2>&1"
             self.task = pexec+pcomm1+pcomm2+log1+log2
@@ -202,9 +208,11 @@ def sch():
     parser.add_argument("-d","--delete", default=None, metavar="")
     parser.add_argument("-t","--test", default=False, metavar="")
     parser.add_argument("-c","--configfile", default="pirecorder.conf", metavar="")
+    parser.add_argument("-D","--daemon", action="store_true",
+                        help="let the pirecorderd daemon record")
 
     args = parser.parse_args()
     Schedule(jobname = args.jobname, timeplan = args.timeplan,
              enable = args.enable, showjobs = args.showjobs,
              delete = args.delete, test = args.test,
-             configfile = args.configfile)
+             configfile = args.configfile, daemon = args.daemon)
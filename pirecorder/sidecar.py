@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Per-frame sidecar files with the timing and camera settings of each frame
+"""
+
+import os
+import time
+import struct
+import numpy as np
+from threading import Thread, Event
+
+# Fixed-width record of a single frame, stored without header so that files
+# can simply be appended to and memory-mapped
+FRAMES = np.dtype([("index", "<u8"), ("timestamp", "<i8"), ("offset", "<u8"),
+                   ("size", "<u4"), ("keyframe", "<u4"), ("exposure", "<u4"),
+                   ("analoggain", "<f4"), ("digitalgain", "<f4"),
+                   ("redgain", "<f4"), ("bluegain", "<f4"), ("reserved", "<u4")])
+RECORD = struct.Struct("<QqQIIIffffI")
+EXT = ".frames"
+
+def readframes(filename):
+
+    """
+    Returns the frame records of a sidecar file as a memory-mapped numpy
+    structured array, ignoring an incomplete last record
+    """
+
+    nr = os.path.getsize(filename) // FRAMES.itemsize
+    if nr == 0:
+        return np.zeros(0, FRAMES)
+
+    return np.memmap(filename, FRAMES, mode = "r", shape = (nr,))
+
+
+def sidecarname(videofile):
+
+    """Returns the name of the sidecar file of a video"""
+
+    return videofile + EXT
+
+
+class FrameLog(object):
+
+    """
+    Writes a sidecar file for a video with a fixed-width record for each
+    frame, holding the frame index, the camera timestamp in microseconds
+    (-1 if unknown), the byte offset and size of the frame in the h264
+    stream, if it is a keyframe, and the exposure speed, analog and digital
+    gain and the red and blue white balance gains of the camera.
+
+    As querying the camera takes time, the camera settings are sampled by a
+    background thread every interval seconds instead of for each frame, and
+    records are written to file by an AsyncWriter, so logging frames does
+    not slow down the encoder. Records are passed on to the writer at most
+    every flushinterval seconds, or when a buffer is full, so bursts of
+    frames, e.g. buffered video written at once, do not fill the writer with
+    small buffers.
+
+    Parameters
+    -----------
+    camera : PiCamera
+        The camera that records the video.
+    writer : AsyncWriter
+        The writer to write the records with.
+    interval : float, default = 0.2
+        The time in seconds between samples of the camera settings.
+    flushinterval : float, default = 1
+        The time in seconds between flushes of the records to the writer.
+    """
+
+    def __init__(self, camera, writer, interval = 0.2, flushinterval = 1):
+
+        self.camera = camera
+        self.writer = writer
+        self.interval = interval
+        self.flushinterval = flushinterval
+        self.flushed = time.monotonic()
+        self.settings = (0, 0., 0., 0., 0.)
+        self.index = 0
+        self.stopped = Event()
+        self._sample()
+        self.thread = Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _sample(self):
+
+        try:
+            red, blue = self.camera.awb_gains
+            self.settings = (int(self.camera.exposure_speed),
+                             float(self.camera.analog_gain),
+                             float(self.camera.digital_gain),
+                             float(red), float(blue))
+        except Exception:
+            pass
+
+
+    def _run(self):
+
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+
+    def open(self, filename):
+
+        """Continues logging to a new sidecar file, e.g. of a new segment"""
+
+        self.writer.open(filename)
+        self.index = 0
+
+
+    def add(self, timestamp, offset, size, keyframe):
+
+        """Adds the record of a frame"""
+
+        timestamp = -1 if timestamp is None else int(timestamp)
+        self.writer.write(RECORD.pack(self.index, timestamp, offset, size,
+                                      int(keyframe), *self.settings + (0,)))
+        self.index += 1
+        if time.monotonic() - self.flushed >= self.flushinterval:
+            self.flush()
+
+
+    def flush(self):
+
+        self.writer.flush()
+        self.flushed = time.monotonic()
+
+
+    def close(self):
+
+        self.stopped.set()
+        self.thread.join()
+        self.writer.close()
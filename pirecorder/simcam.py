@@ -0,0 +1,541 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Simulated raspberry pi camera with the parts of the picamera interface used
+by pirecorder, such that recordings can be run and profiled on any linux
+computer. Images are synthetic frames encoded with OpenCV and videos are
+synthetic frames encoded to h264 in real-time by FFmpeg.
+"""
+
+import io
+import os
+import cv2
+import time
+import subprocess
+import numpy as np
+from datetime import datetime
+from threading import Thread, Event
+from collections import namedtuple
+
+MAXRES = (3264, 2464)
+STILLTIME = 0.45
+
+PiVideoFrame = namedtuple("PiVideoFrame", ["index", "frame_type", "frame_size",
+                          "video_size", "split_size", "timestamp", "complete"])
+
+class PiVideoFrameType:
+
+    frame = 0
+    key_frame = 1
+    sps_header = 2
+    motion_data = 3
+
+
+class Color:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class PiRGBArray(io.BytesIO):
+
+    """Simulated picamera.array.PiRGBArray that holds the last bgr capture"""
+
+    def __init__(self, camera, size = None):
+        super(PiRGBArray, self).__init__()
+        self.camera = camera
+        self.size = size
+        self.array = None
+
+    def truncate(self, size = None):
+        if size == 0:
+            self.array = None
+        return super(PiRGBArray, self).truncate(size)
+
+
+class SimEncoder(Thread):
+
+    """
+    Encodes synthetic frames in real-time with FFmpeg and writes the h264
+    stream to the output frame by frame, like the encoder of the camera
+    """
+
+    def __init__(self, camera, output, size, quality = 0, bitrate = 17000000,
+                 intra_period = None):
+
+        Thread.__init__(self)
+        self.daemon = True
+        self.camera = camera
+        self.size = tuple(int(v) for v in size)
+        self.output, self.opened = self._open(output)
+        self.splitoutput = None
+        self.splitdone = Event()
+        self.stopped = Event()
+        self.exception = None
+        self.index = -1
+        self.videosize = 0
+        self.splitsize = 0
+        self.frame = None
+
+        fps = float(camera.framerate)
+        period = int(intra_period) if intra_period else max(int(round(fps)), 1)
+        comm = ["ffmpeg", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt",
+                "bgr24", "-s", "%dx%d" % self.size, "-r", str(fps), "-i", "pipe:0",
+                "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+                "-g", str(period), "-x264-params", "repeat-headers=1:sliced-threads=0"]
+        if quality > 0:
+            comm += ["-crf", str(quality)]
+            if bitrate > 0:
+                comm += ["-maxrate", str(bitrate), "-bufsize", str(2*bitrate)]
+        elif bitrate > 0:
+            comm += ["-b:v", str(bitrate)]
+        self.proc = subprocess.Popen(comm + ["-f", "h264", "pipe:1"],
+                                     stdin = subprocess.PIPE,
+                                     stdout = subprocess.PIPE, bufsize = 0)
+        self.feeder = Thread(target = self.feed)
+        self.feeder.daemon = True
+
+
+    def start(self):
+
+        Thread.start(self)
+        self.feeder.start()
+
+
+    def feed(self):
+
+        """Writes synthetic frames to the encoder at the camera framerate"""
+
+        period = 1. / float(self.camera.framerate)
+        start = time.time()
+        index = 0
+        pos = 0
+        try:
+            while not self.stopped.is_set():
+                self.proc.stdin.write(self.camera._image(self.size, pos).tobytes())
+                index += 1
+                pos += 1 if self.camera.motion else 0
+                self.stopped.wait(max(0, start + index*period - time.time()))
+        except (IOError, OSError):
+            pass
+        finally:
+            self.proc.stdin.close()
+
+
+    def _open(self, output):
+
+        if isinstance(output, str):
+            return io.open(output, "wb"), True
+        return output, False
+
+
+    def _close(self, output, opened):
+
+        if hasattr(output, "flush"):
+            output.flush()
+        if opened:
+            output.close()
+
+
+    def run(self):
+
+        buf = b""
+        unit, unittype = b"", None
+        try:
+            while True:
+                data = os.read(self.proc.stdout.fileno(), 1<<16)
+                buf += data
+                nals = []
+                i = buf.find(b"\x00\x00\x01", 3)
+                while i != -1 and i + 4 < len(buf):
+                    j = i-1 if buf[i-1:i] == b"\x00" else i
+                    nals.append(buf[:j])
+                    buf = buf[j:]
+                    i = buf.find(b"\x00\x00\x01", 4)
+                if not data:
+                    nals.append(buf)
+                for nal in nals:
+                    k = nal.find(b"\x00\x00\x01") + 3
+                    if k + 1 >= len(nal):
+                        continue
+                    naltype = nal[k] & 0x1f
+                    if naltype in (1, 5):
+                        if nal[k+1] & 0x80 and unit:
+                            self._write(unit, unittype)
+                            unit = b""
+                        if not unit:
+                            unittype = PiVideoFrameType.key_frame if naltype == 5 \
+                                       else PiVideoFrameType.frame
+                    else:
+                        if unit and unittype != PiVideoFrameType.sps_header:
+                            self._write(unit, unittype)
+                            unit = b""
+                        unittype = PiVideoFrameType.sps_header
+                    unit += nal
+                if not data:
+                    if unit:
+                        self._write(unit, unittype)
+                    break
+        except Exception as e:
+            self.exception = e
+        finally:
+            self._close(self.output, self.opened)
+            self.splitdone.set()
+
+
+    def _write(self, data, frametype):
+
+        if frametype == PiVideoFrameType.sps_header and self.splitoutput is not None:
+            self._close(self.output, self.opened)
+            self.output, self.opened = self._open(self.splitoutput)
+            self.splitoutput = None
+            self.splitsize = 0
+            self.splitdone.set()
+        if frametype != PiVideoFrameType.sps_header:
+            self.index += 1
+        self.videosize += len(data)
+        self.splitsize += len(data)
+        self.frame = PiVideoFrame(max(self.index, 0), frametype, len(data),
+                                  self.videosize, self.splitsize,
+                                  int(max(self.index, 0)*1e6/float(self.camera.framerate)),
+                                  True)
+        self.output.write(data)
+
+
+    def split(self, output):
+
+        """Switches to a new output at the start of the next keyframe"""
+
+        self.splitdone.clear()
+        self.splitoutput = output
+        self.splitdone.wait()
+
+
+    def stop(self):
+
+        self.stopped.set()
+        self.feeder.join()
+        self.join()
+        self.proc.wait()
+
+
+class SimYUVEncoder(Thread):
+
+    """
+    Writes unencoded synthetic frames in yuv420 format to the output, one
+    frame per write at the camera framerate, with the width and height of
+    the planes padded to multiples of 32 and 16 like the camera does. Only
+    the Y (luminance) plane holds the image, the chroma planes are neutral.
+    """
+
+    def __init__(self, camera, output, size):
+
+        Thread.__init__(self)
+        self.daemon = True
+        self.camera = camera
+        self.size = tuple(int(v) for v in size)
+        self.output = output
+        self.stopped = Event()
+        self.exception = None
+        self.frame = None
+        w, h = self.size
+        self.fwidth, self.fheight = (w + 31) // 32 * 32, (h + 15) // 16 * 16
+
+
+    def run(self):
+
+        period = 1. / float(self.camera.framerate)
+        w, h = self.size
+        fw, fh = self.fwidth, self.fheight
+        buf = np.full(fw * fh * 3 // 2, 128, np.uint8)
+        yplane = buf[:fw*fh].reshape(fh, fw)
+        start = time.time()
+        index = 0
+        pos = 0
+        try:
+            while not self.stopped.is_set():
+                img = self.camera._image(self.size, pos)
+                yplane[:h,:w] = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                self.frame = PiVideoFrame(index, PiVideoFrameType.frame, len(buf),
+                                          len(buf)*(index+1), len(buf)*(index+1),
+                                          int(index*1e6*period), True)
+                self.output.write(buf.tobytes())
+                index += 1
+                pos += 1 if self.camera.motion else 0
+                self.stopped.wait(max(0, start + index*period - time.time()))
+        except Exception as e:
+            self.exception = e
+
+
+    def stop(self):
+
+        self.stopped.set()
+        self.join()
+
+
+class PiCamera:
+
+    """
+    Simulated picamera.PiCamera. Camera settings can be set and read as
+    usual but do not affect the synthetic frames, except for the resolution,
+    framerate, zoom and annotation text. Still captures take
+    the time a real camera would need at the given resolution, captures from
+    the video port and video frames are delivered in real-time. The scene
+    moves a little with every frame, unless motion is set to False. In the
+    automatic exposure mode, the gains settle over about a second after the
+    camera is opened, like those of a real camera.
+
+    Videos are recorded as h264 streams with inline headers. The simulated
+    encoder can not be asked for a keyframe, so split_recording switches to
+    the new output at the next periodic keyframe, by default every second.
+    """
+
+    def __init__(self, resolution = (1280, 720), framerate = 30):
+
+        self.resolution = resolution
+        self.framerate = framerate
+        self.rotation = 0
+        self.zoom = (0, 0, 1, 1)
+        self.exposure_compensation = 0
+        self.exposure_mode = "auto"
+        self.awb_mode = "auto"
+        self.shutter_speed = 0
+        self.awb_gains = (1.5, 1.5)
+        self.brightness = 50
+        self.contrast = 0
+        self.saturation = 0
+        self.iso = 0
+        self.sharpness = 0
+        self.annotate_text = ""
+        self.annotate_text_size = 32
+        self.annotate_background = None
+        self.motion = True
+        self.closed = False
+        self.encoders = {}
+        self._base = {}
+        self._frameindex = 0
+        self._start = time.time()
+
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, value):
+        self._resolution = tuple(int(v) for v in value)
+        self._base = {}
+
+    def _settle(self, value):
+        if self.exposure_mode == "off":
+            return value
+        return value * (1 - np.exp(-(time.time() - self._start) / 0.25))
+
+    @property
+    def analog_gain(self):
+        return self._settle(2.0)
+
+    @property
+    def digital_gain(self):
+        return self._settle(1.0)
+
+    @property
+    def exposure_speed(self):
+        if self.shutter_speed > 0:
+            return int(self.shutter_speed)
+        return int(1000000 / float(self.framerate))
+
+    @property
+    def frame(self):
+        encoder = self.encoders.get(1)
+        return encoder.frame if encoder is not None else None
+
+    @property
+    def recording(self):
+        return len(self.encoders) > 0
+
+
+    def _wait_frame(self):
+
+        """Waits until the next frame of the video port is available"""
+
+        period = 1. / float(self.framerate)
+        nextframe = self._start + (int((time.time()-self._start)/period)+1)*period
+        time.sleep(max(0, nextframe - time.time()))
+        self._frameindex += 1
+
+
+    def _image(self, resize = None, index = None):
+
+        """
+        Returns a synthetic bgr frame with the current zoom and annotation,
+        which moves a little with every frame
+        """
+
+        w, h = self.resolution
+        resize = tuple(int(v) for v in resize) if resize is not None else None
+        key = (tuple(self.zoom), resize)
+        if key not in self._base:
+            x = np.linspace(0, 255, w, dtype = np.float32)
+            y = np.linspace(0, 255, h, dtype = np.float32)[:,None]
+            base = np.dstack([np.broadcast_to(x, (h, w)),
+                              np.broadcast_to(y, (h, w)),
+                              np.broadcast_to((x+y)/2, (h, w))]).astype(np.uint8)
+            zx, zy, zw, zh = self.zoom
+            base = base[int(zy*h):int((zy+zh)*h), int(zx*w):int((zx+zw)*w)]
+            if resize is not None and resize != base.shape[1::-1]:
+                base = cv2.resize(base, resize)
+            self._base[key] = base
+        index = self._frameindex if index is None else index
+        img = np.roll(self._base[key], index * 4, axis = 1)
+        if self.annotate_text:
+            size = self.annotate_text_size / 32.
+            (tw, th), _ = cv2.getTextSize(self.annotate_text, cv2.FONT_HERSHEY_SIMPLEX, size, 2)
+            x = max(0, (img.shape[1] - tw) // 2)
+            if self.annotate_background is not None:
+                cv2.rectangle(img, (x-4, 0), (x+tw+4, th+12), (0,0,0), -1)
+            cv2.putText(img, self.annotate_text, (x, th+6),
+                        cv2.FONT_HERSHEY_SIMPLEX, size, (255,255,255), 2)
+
+        return img
+
+
+    def _save(self, output, img, format, quality):
+
+        if format == "bgr":
+            if isinstance(output, PiRGBArray):
+                output.array = img
+            else:
+                output.write(img.tobytes())
+            return
+        ext = ".png" if format == "png" else ".jpg"
+        _, data = cv2.imencode(ext, img, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        if isinstance(output, str):
+            with io.open(output, "wb") as f:
+                f.write(data.tobytes())
+        else:
+            output.write(data.tobytes())
+
+
+    def capture(self, output, format = None, use_video_port = False,
+                resize = None, quality = 85, **options):
+
+        """Captures a single synthetic image to a filename or stream"""
+
+        start = time.time()
+        self._wait_frame()
+        if not use_video_port:
+            w, h = self.resolution
+            stilltime = STILLTIME * (w * h) / float(MAXRES[0] * MAXRES[1])
+            time.sleep(max(0, start + stilltime - time.time()))
+        format = format or os.path.splitext(str(output))[1][1:] or "jpeg"
+        self._save(output, self._image(resize), format, quality)
+
+
+    def capture_continuous(self, output, format = None, use_video_port = False,
+                           resize = None, quality = 85, **options):
+
+        """
+        Generator that continuously captures images. If output is a string it
+        is formatted with counter and timestamp and the filename is yielded,
+        otherwise the image is written to output which is then yielded.
+        """
+
+        counter = 1
+        while not self.closed:
+            if isinstance(output, str):
+                filename = output.format(counter = counter, timestamp = datetime.now())
+                self.capture(filename, format, use_video_port, resize, quality)
+                yield filename
+            else:
+                self.capture(output, format, use_video_port, resize, quality)
+                yield output
+            counter += 1
+
+
+    def start_recording(self, output, format = "h264", resize = None,
+                        splitter_port = 1, quality = 0, bitrate = 17000000,
+                        intra_period = None, **options):
+
+        """
+        Starts recording a h264 video to a filename or stream, or unencoded
+        yuv frames to a stream
+        """
+
+        if format not in ["h264", "yuv"]:
+            raise ValueError("Simulated camera only records h264 or yuv video..")
+        if splitter_port in self.encoders:
+            raise RuntimeError("The camera is already recording on port " +
+                               str(splitter_port))
+        size = resize if resize is not None else self.resolution
+        if format == "yuv":
+            encoder = SimYUVEncoder(self, output, size)
+        else:
+            encoder = SimEncoder(self, output, size, quality, bitrate, intra_period)
+        encoder.start()
+        self.encoders[splitter_port] = encoder
+
+
+    def wait_recording(self, timeout = 0, splitter_port = 1):
+
+        """Waits for timeout seconds and raises errors of the encoder"""
+
+        encoder = self.encoders[splitter_port]
+        encoder.join(timeout)
+        if encoder.exception is not None:
+            raise encoder.exception
+        if not encoder.is_alive():
+            raise RuntimeError("Simulated encoder stopped unexpectedly..")
+
+
+    def split_recording(self, output, splitter_port = 1, **options):
+
+        """Continues the recording to a new output from the next keyframe"""
+
+        self.encoders[splitter_port].split(output)
+
+
+    def request_key_frame(self, splitter_port = 1):
+
+        """
+        The simulated encoder writes keyframes at a fixed interval only, so
+        requests are ignored and the next keyframe follows within a second
+        """
+
+        pass
+
+
+    def stop_recording(self, splitter_port = 1):
+
+        encoder = self.encoders[splitter_port]
+        encoder.stop()
+        del self.encoders[splitter_port]
+        if encoder.exception is not None:
+            raise encoder.exception
+
+
+    def close(self):
+
+        for port in list(self.encoders):
+            self.stop_recording(port)
+        self.closed = True
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Management of the storage volumes that recordings are written to
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+from threading import Lock
+from pythutils.sysutils import lineprint
+
+FALLOC_FL_KEEP_SIZE = 0x01
+_fallocate = None
+
+def fallocate(fd, size):
+
+    """
+    Reserves size bytes of disk space for the open file fd with linux
+    fallocate, without changing the size of the file, such that the file is
+    stored contiguously. Returns False when the filesystem does not support
+    preallocation.
+    """
+
+    global _fallocate
+    if _fallocate is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno = True)
+        _fallocate = getattr(libc, "fallocate64", None) or \
+                     getattr(libc, "fallocate", False)
+        if _fallocate:
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_int64, ctypes.c_int64]
+    if not _fallocate or size <= 0:
+        return False
+
+    return _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, int(size)) == 0
+
+
+def freespace(path):
+
+    """Returns the free space in bytes available to the user at path"""
+
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def vidsize(dims, fps, quality, duration, bitrate = 17000000):
+
+    """
+    Returns the projected size in bytes of a h264 video with resolution dims,
+    framerate fps, and encoder quality, recorded for duration seconds. The
+    bits per pixel halve with every 6 steps of quality, from 0.5 at quality
+    10, up to the maximum bitrate of the encoder.
+    """
+
+    bpp = 0.5 * 2 ** (-(quality - 10) / 6.)
+    rate = min(bpp * dims[0] * dims[1] * fps, bitrate)
+
+    return int(rate / 8. * duration)
+
+
+def imgsize(dims, quality):
+
+    """Returns the projected size in bytes of a jpeg image"""
+
+    return int(dims[0] * dims[1] * (0.1 + 0.9 * (quality / 100.) ** 2))
+
+
+class Storage(object):
+
+    """
+    Keeps track of the free space and write throughput of one or more
+    storage volumes that recordings are written to. Files are stored on the
+    first volume until storing the next file would leave less than minfree
+    MB free, after which recording rolls over to the next volume. The free
+    space of a volume is checked at most every interval seconds, and
+    reduced by the projected size of the files stored in between.
+
+    Parameters
+    -----------
+    volumes : list
+        The directories to store recordings in, in order of use.
+    minfree : float, default = 1000
+        The free space in MB to keep on each volume.
+    interval : float, default = 5
+        The time in seconds between checks of the free space of a volume.
+    """
+
+    def __init__(self, volumes, minfree = 1000, interval = 5):
+
+        self.volumes = [os.path.abspath(volume) for volume in volumes]
+        self.minfree = int(minfree * 1000000)
+        self.interval = interval
+        self.current = 0
+        self.checked = 0
+        self.free = 0
+        self.stats = {volume: [0, 0.] for volume in self.volumes}
+        self.lock = Lock()
+
+
+    @property
+    def volume(self):
+
+        """The volume that is currently recorded to"""
+
+        return self.volumes[self.current]
+
+
+    def space(self, volume):
+
+        """Returns the free space in bytes of a volume, 0 if not available"""
+
+        try:
+            return freespace(volume if os.path.exists(volume) else
+                             os.path.dirname(volume))
+        except OSError:
+            return 0
+
+
+    def available(self):
+
+        """
+        Returns the space in bytes that can be recorded to on the current
+        and next volumes while keeping minfree free
+        """
+
+        return sum(max(0, self.space(volume) - self.minfree)
+                   for volume in self.volumes[self.current:])
+
+
+    def fits(self, size):
+
+        """Returns if a recording of size bytes fits on the volumes"""
+
+        return size <= self.available()
+
+
+    def path(self, filename, size = 0):
+
+        """
+        Returns the path to store filename, with a projected size of size
+        bytes, relative to the volume with enough space. When all volumes
+        are full the file is stored on the last volume, using the reserved
+        free space.
+        """
+
+        with self.lock:
+            if time.time() - self.checked > self.interval:
+                self.free = self.space(self.volume)
+                self.checked = time.time()
+            while self.free - size < self.minfree and \
+                  self.current < len(self.volumes) - 1:
+                self.current += 1
+                self.free = self.space(self.volume)
+                self.checked = time.time()
+                lineprint("Recording volume full, continuing on "+self.volume+\
+                          " ("+str(round(self.free/1000000000.,1))+"GB free)..")
+            if self.free - size < self.minfree and self.free >= self.minfree:
+                lineprint("All recording volumes are nearly full..")
+            self.free -= size
+            path = os.path.join(self.volume, filename)
+            if self.volume == os.getcwd():
+                path = filename
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        return path
+
+
+    def report(self, filename, size, duration):
+
+        """Adds a write of size bytes to filename that took duration seconds"""
+
+        filename = os.path.abspath(filename)
+        for volume in self.volumes:
+            if filename.startswith(volume + os.sep):
+                self.stats[volume][0] += size
+                self.stats[volume][1] += duration
+                return
+
+
+    def throughput(self, volume = None):
+
+        """
+        Returns the measured write throughput of a volume in bytes per second,
+        by default of the current volume, or None if nothing was written yet
+        """
+
+        written, duration = self.stats[volume or self.volume]
+
+        return written / duration if duration > 0 else None
+
+
+    def summary(self):
+
+        """Prints the free space and measured throughput of each volume"""
+
+        for volume in self.volumes:
+            info = volume+": "+str(round(self.space(volume)/1000000000.,1))+"GB free"
+            rate = self.throughput(volume)
+            if rate is not None:
+                info += ", "+str(round(self.stats[volume][0]/1000000.,1))+\
+                        "MB written at "+str(round(rate/1000000.,1))+"MB/s"
+            lineprint(info)
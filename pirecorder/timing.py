@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import io
+import time
+from datetime import datetime
+
+class Deadlines:
+
+    """
+    Schedules captures at fixed intervals from the start of a sequence, with
+    capture k due at start + k * interval on the monotonic clock, so timing
+    errors do not accumulate and changes of the system clock have no effect.
+    When a capture takes longer than the interval, the next capture is
+    either taken directly and the following ones as fast as possible until
+    the schedule is caught up ("catchup"), or the deadlines that have passed
+    are skipped and the schedule continues at the nearest deadline ("skip").
+
+    The caller reports each capture with captured, right after it has been
+    taken, so the lateness includes any delay of the capture itself. The
+    target and actual time and the lateness of each capture can be written
+    to a csv timing log.
+
+    Parameters
+    -----------
+    interval : float
+        The time between captures in seconds.
+    policy : ["skip", "catchup"], default = "skip"
+        What to do with deadlines that have passed.
+    logfile : str, default = None
+        The csv file to write the timing log to. If None, no log is written.
+    stop : threading.Event, default = None
+        Event that ends a wait for the next capture early when it is set.
+    """
+
+    def __init__(self, interval, policy = "skip", logfile = None, stop = None):
+
+        if policy not in ["skip", "catchup"]:
+            raise ValueError("policy should be 'skip' or 'catchup'..")
+        self.interval = float(interval)
+        self.policy = policy
+        self.stop = stop
+        self.start = time.monotonic()
+        self.startdate = datetime.now()
+        self.frame = 0
+        self.skipped = 0
+        self.lateness = []
+        self.actual = 0
+
+        self.log = None
+        if logfile is not None:
+            self.log = io.open(logfile, "w")
+            self.log.write("# start "+self.startdate.isoformat()+", interval "+\
+                           str(self.interval)+"s, policy "+policy+"\n")
+            self.log.write("frame,target,actual,lateness\n")
+
+
+    def elapsed(self):
+
+        """Returns the time in seconds since the start of the sequence"""
+
+        return time.monotonic() - self.start
+
+
+    def captured(self, now = None):
+
+        """
+        Records the timing of the capture of the current deadline, taken at
+        monotonic time now, by default the current time
+        """
+
+        self._record(time.monotonic() if now is None else now)
+
+
+    def _record(self, now):
+
+        target = self.frame * self.interval
+        actual = now - self.start
+        self.actual = actual
+        self.lateness.append(actual - target)
+        if self.log is not None:
+            self.log.write("%d,%.6f,%.6f,%.6f\n" % (self.frame, target, actual,
+                                                     actual - target))
+
+
+    def _next(self, now):
+
+        # Deadlines more than half an interval ago count as missed
+        frame = self.frame + 1
+        if self.policy == "skip":
+            frame = max(frame, int((now - self.start) / self.interval + 0.5))
+        return frame
+
+
+    def remaining(self):
+
+        """Returns the time in seconds until the next capture is due"""
+
+        now = time.monotonic()
+        return max(0, self.start + self._next(now) * self.interval - now)
+
+
+    def wait(self):
+
+        """
+        Waits until the next capture is due and returns the number of its
+        deadline, or None when the stop event was set while waiting
+        """
+
+        frame = self._next(time.monotonic())
+        target = self.start + frame * self.interval
+        while True:
+            delay = target - time.monotonic()
+            if delay <= 0:
+                break
+            if self.stop is None:
+                time.sleep(delay)
+            elif self.stop.wait(delay):
+                return None
+        self.skipped += frame - self.frame - 1
+        self.frame = frame
+
+        return frame
+
+
+    def summary(self):
+
+        """
+        Returns the number of captures, the number of skipped deadlines, the
+        achieved rate in captures per second, and the 50th and 99th
+        percentile and maximum lateness in seconds
+        """
+
+        if len(self.lateness) == 0:
+            return {"captures": 0, "skipped": self.skipped, "rate": 0,
+                    "p50": 0, "p99": 0, "max": 0}
+        late = sorted(self.lateness)
+        pick = lambda q: late[min(len(late)-1, int(round(q * (len(late)-1))))]
+        rate = (len(late) - 1) / self.actual if self.actual > 0 else 0
+        return {"captures": len(late), "skipped": self.skipped, "rate": rate,
+                "p50": pick(0.5), "p99": pick(0.99), "max": late[-1]}
+
+
+    def close(self):
+
+        if self.log is not None:
+            self.log.close()
+            self.log = None
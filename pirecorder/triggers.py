@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import socket
+import signal
+import threading
+from queue import Queue, Empty
+
+from .watch import DirWatcher
+
+class Triggers:
+
+    """
+    Collects recording triggers from a signal, the creation of a trigger
+    file, a local unix socket and direct calls, into a single queue of
+    commands, either "trigger" or "stop", or "release" when a triggered
+    recording should end, as sent by a MotionDetector.
+
+    Parameters
+    -----------
+    triggerfile : str, default = None
+        File that triggers a recording when it is created, e.g. with touch.
+        The file is removed again once the trigger is received.
+    socketfile : str, default = None
+        Unix socket that accepts "trigger" and "stop" commands, one per line,
+        e.g. with: echo trigger | nc -U socketfile
+    signum : int, default = signal.SIGUSR1
+        Signal that triggers a recording, e.g. with: kill -USR1 pid. Only
+        used when created in the main thread.
+    """
+
+    def __init__(self, triggerfile = None, socketfile = None,
+                 signum = signal.SIGUSR1):
+
+        self.queue = Queue()
+        self.closed = False
+        self.threads = []
+
+        self.signum = None
+        if signum is not None and threading.current_thread() is threading.main_thread():
+            self.signum = signum
+            self.oldhandler = signal.signal(signum, self._signal)
+
+        self.triggerfile = triggerfile
+        if triggerfile is not None:
+            if os.path.exists(triggerfile):
+                os.remove(triggerfile)
+            self.watcher = DirWatcher(os.path.dirname(os.path.abspath(triggerfile)))
+            self._thread(self._watchfile)
+
+        self.socketfile = socketfile
+        if socketfile is not None:
+            if os.path.exists(socketfile):
+                os.remove(socketfile)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(socketfile)
+            self.sock.listen(5)
+            self.sock.settimeout(0.5)
+            self._thread(self._listen)
+
+
+    def _thread(self, target):
+
+        thread = threading.Thread(target = target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+
+    def _signal(self, signum, frame):
+
+        # Queue from another thread, as the main thread may hold the queue lock
+        threading.Thread(target = self.queue.put, args = ("trigger",)).start()
+
+
+    def _watchfile(self):
+
+        name = os.path.basename(self.triggerfile)
+        while not self.closed:
+            if name in self.watcher.events(0.5):
+                if os.path.exists(self.triggerfile):
+                    os.remove(self.triggerfile)
+                self.queue.put("trigger")
+
+
+    def _listen(self):
+
+        while not self.closed:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            with conn:
+                conn.settimeout(2)
+                try:
+                    for line in conn.makefile("r"):
+                        command = line.strip()
+                        if command in ["trigger", "stop"]:
+                            self.queue.put(command)
+                            conn.sendall(b"ok\n")
+                        elif command:
+                            conn.sendall(b"unknown command\n")
+                except (socket.timeout, OSError):
+                    pass
+
+
+    def trigger(self, command = "trigger"):
+
+        """Adds a command, "trigger", "release" or "stop", to the queue"""
+
+        self.queue.put(command)
+
+
+    def wait(self, timeout = None):
+
+        """Returns the next command or None when there was none in timeout"""
+
+        try:
+            return self.queue.get(timeout = timeout)
+        except Empty:
+            return None
+
+
+    def clear(self):
+
+        """
+        Removes all waiting triggers, and returns "stop" if a stop command
+        was waiting
+        """
+
+        command = None
+        while True:
+            try:
+                if self.queue.get_nowait() == "stop":
+                    command = "stop"
+            except Empty:
+                return command
+
+
+    def close(self):
+
+        self.closed = True
+        for thread in self.threads:
+            thread.join()
+        if self.signum is not None:
+            signal.signal(self.signum, self.oldhandler)
+        if self.triggerfile is not None:
+            self.watcher.close()
+        if self.socketfile is not None:
+            self.sock.close()
+            os.remove(self.socketfile)
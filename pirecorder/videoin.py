@@ -25,17 +25,25 @@ import numpy as np
 from pythutils.sysutils import isrpi
 from pythutils.mediautils import *
 
+from .warmup import warmup
+
 class VideoIn:
 
     def __init__(self, system = "auto", vidsize = 0.2, framerate = 32,
                  crop = False, rotation = 0, maxres = None):
 
-        """Opens a video stream from native camera, webcam or rpi camera"""
+        """
+        Opens a video stream from native camera, webcam, rpi camera or video
+        file. Frames of a video file are read as fast as possible and the
+        stream stops by itself at the end of the file.
+        """
 
         if system == "auto":
             self.cam = "rpi" if isrpi() else 0
         elif system in ["rpi",0,1,2]:
             self.cam = system
+        elif isinstance(system, str) and os.path.isfile(system):
+            self.cam = system
         else:
             self.cam = 0
 
@@ -67,6 +75,11 @@ class VideoIn:
             self.stream = self.camera.capture_continuous(self.rawCapture,
                           format="bgr", use_video_port=True)
 
+        elif isinstance(self.cam, str):
+            self.stream = cv2.VideoCapture(self.cam)
+            self.maxres = (int(self.stream.get(3)), int(self.stream.get(4)))
+            self.res = (int(self.maxres[0]*vidsize), int(self.maxres[1]*vidsize))
+
         else:
             self.stream = cv2.VideoCapture(self.cam)
             self.stream.set(3, 4000)
@@ -76,12 +89,26 @@ class VideoIn:
             self.stream.set(4, int(self.maxres[1]*vidsize))
             self.res = (int(self.stream.get(3)), int(self.stream.get(4)))
 
+        self.frames = 0
         self.stopped = False
 
 
-    def start(self):
+    def start(self, timeout = 2):
+
+        """
+        Starts reading frames, and waits until the first frame is read, and
+        for the raspberry pi camera until its exposure and white balance have
+        settled, or at most timeout seconds
+        """
+
+        start = time.time()
         Thread(target=self.update, args=()).start()
-        time.sleep(2)
+        if self.cam == "rpi":
+            warmup(self.camera, timeout = timeout)
+        while self.frames == 0 and not self.stopped and \
+              time.time() - start < timeout:
+            time.sleep(0.01)
+        self.warmup = time.time() - start
         return self
 
 
@@ -89,15 +116,28 @@ class VideoIn:
         if self.cam == "rpi":
             for f in self.stream:
                 self.frame = f.array
+                self.frames += 1
                 self.rawCapture.truncate(0)
                 if self.stopped:
                     self.stream.close()
                     self.rawCapture.close()
                     self.camera.close()
                     return
+        elif isinstance(self.cam, str):
+            while not self.stopped:
+                grabbed, frame = self.stream.read()
+                if not grabbed:
+                    self.stopped = True
+                    break
+                if self.res != self.maxres:
+                    frame = cv2.resize(frame, self.res)
+                self.frame = frame
+                self.frames += 1
+            self.stream.release()
         else:
             while True:
                 _, self.frame = self.stream.read()
+                self.frames += 1
                 if self.stopped:
                     self.stream.release()
                     return
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Camera warm-up that waits for the automatic exposure and white balance
+"""
+
+import os
+import time
+from datetime import datetime
+
+def camsettings(camera):
+
+    """
+    Returns the exposure speed, analog and digital gain and red and blue
+    white balance gains of the camera
+    """
+
+    red, blue = camera.awb_gains
+    return (float(camera.exposure_speed), float(camera.analog_gain),
+            float(camera.digital_gain), float(red), float(blue))
+
+
+def warmup(camera, tolerance = 0.05, timeout = 10, interval = 0.1, stable = 3):
+
+    """
+    Waits until the automatic exposure and white balance of the camera have
+    converged, i.e. until the exposure speed, gains and white balance gains
+    all changed less than the relative tolerance over stable consecutive
+    checks, or until timeout seconds have passed. The camera is checked
+    every interval seconds, or every frame with long exposures. Returns the
+    time waited in seconds, if the settings converged, and the settings.
+    """
+
+    start = time.monotonic()
+    interval = max(interval, 1. / float(camera.framerate))
+    timeout = max(timeout, (stable + 1) * interval)
+    previous = camsettings(camera)
+    count = 0
+    while True:
+        time.sleep(interval)
+        current = camsettings(camera)
+        elapsed = time.monotonic() - start
+        # Gains are 0 until the camera has started adjusting
+        settled = current[1] > 0 and all(abs(c - p) <= tolerance * abs(p)
+                                         for c, p in zip(current, previous))
+        count = count + 1 if settled else 0
+        previous = current
+        if count >= stable:
+            return elapsed, True, current
+        if elapsed >= timeout:
+            return elapsed, False, current
+
+
+def logwarmup(logfile, host, elapsed, converged, settings):
+
+    """Appends the result of a warm-up to a csv log"""
+
+    new = not os.path.exists(logfile)
+    with open(logfile, "a") as f:
+        if new:
+            f.write("date,host,seconds,converged,exposure,analoggain,"+\
+                    "digitalgain,redgain,bluegain\n")
+        f.write(",".join([datetime.now().isoformat(timespec = "seconds"), host,
+                          "%.3f" % elapsed, str(converged)] +
+                         ["%.4g" % value for value in settings]) + "\n")
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+class DirWatcher:
+
+    """
+    Watches a directory with linux inotify and returns the names of files
+    that were closed after writing or moved into the directory, i.e. files
+    that are completely written and ready to be processed.
+
+    Parameters
+    -----------
+    dirname : str
+        The directory to watch.
+    """
+
+    def __init__(self, dirname):
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno = True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system..")
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not initialise inotify")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(dirname),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "Could not watch "+dirname)
+        self.overflow = False
+
+
+    def events(self, timeout = None):
+
+        """
+        Returns a list of names of files that are ready, waiting at most
+        timeout seconds for them. When the kernel event queue overflowed
+        self.overflow is set and the directory should be rescanned.
+        """
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, 1<<16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        names = []
+        i = 0
+        while i + 16 <= len(data):
+            _, mask, _, length = struct.unpack_from("iIII", data, i)
+            name = data[i+16:i+16+length].rstrip(b"\0")
+            i += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+            elif name and not mask & IN_ISDIR:
+                names.append(os.fsdecode(name))
+
+        return names
+
+
+    def close(self):
+
+        os.close(self.fd)
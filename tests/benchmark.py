@@ -0,0 +1,438 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Performance benchmarks for pirecorder that run on any linux computer, no
+raspberry pi camera required. All media is generated synthetically with
+FFmpeg and OpenCV. Run from the command line, e.g.:
+
+python tests/benchmark.py imgseq --sizes 1000 10000 100000
+python tests/benchmark.py all --json results.json
+
+Results stored as json can be compared between releases to track
+performance regressions.
+"""
+
+import os
+import sys
+import cv2
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+
+def make_imgseq(imgdir, nr, dims = (160, 120), quality = 80):
+
+    """Writes a sequence of nr synthetic jpeg images to imgdir"""
+
+    if not os.path.exists(imgdir):
+        os.makedirs(imgdir)
+    w, h = dims
+    base = np.random.randint(0, 255, (h, w, 3), dtype = np.uint8)
+    for i in range(nr):
+        img = np.roll(base, i, axis = 1)
+        cv2.putText(img, str(i), (5, h-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                    (255,255,255), 1)
+        cv2.imwrite(os.path.join(imgdir, "bench_im%06d.jpg" % i), img,
+                    [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+
+def make_video(filename, dims = (640, 480), frames = 250, fps = 25):
+
+    """
+    Writes a synthetic video with frames frames to filename. Files with the
+    .h264 extension are written as raw h264 streams with inline headers and
+    a keyframe every second, like those of the raspberry pi camera.
+    """
+
+    comm = ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i",
+            "testsrc=size=%dx%d:rate=%d" % (dims[0], dims[1], fps),
+            "-frames:v", str(frames), "-c:v", "libx264", "-preset", "ultrafast",
+            "-pix_fmt", "yuv420p", "-g", str(fps)]
+    if filename.endswith(".h264"):
+        comm += ["-x264-params", "repeat-headers=1", "-f", "h264"]
+    subprocess.check_call(comm + [filename])
+
+
+def run_child(code):
+
+    """Runs python code in a new process and returns (seconds, peak rss MB)"""
+
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, "-c", code])
+    _, status, usage = os.wait4(proc.pid, 0)
+    assert status == 0, "benchmark process failed.."
+
+    return time.time() - start, usage.ru_maxrss / 1024.
+
+
+def bench_imgseq(sizes, dims, workdir, pools = (1, 4)):
+
+    """Peak memory and throughput of converting image sequences to video"""
+
+    print("BENCHMARK: image sequence to video conversion")
+    print("images     pools  seconds   imgs/s    peak rss (MB)")
+    results = []
+    for nr in sizes:
+        imgdir = os.path.join(workdir, "imgs%d" % nr)
+        make_imgseq(imgdir, nr, dims)
+        for pool in pools:
+            code = "import pirecorder; pirecorder.Convert(indir='%s', " \
+                   "outdir='%s', type='.jpg', pools=%d)" \
+                   % (imgdir, imgdir + "_out", pool)
+            secs, rss = run_child(code)
+            print("%-10d %-6d %-9.1f %-9.1f %.1f" % (nr, pool, secs, nr/secs, rss))
+            results.append({"images": nr, "dims": list(dims), "pools": pool,
+                            "seconds": secs, "imgs_s": nr/secs, "rss_mb": rss})
+            shutil.rmtree(imgdir + "_out")
+        shutil.rmtree(imgdir)
+    print("DONE..\n")
+
+    return results
+
+
+def bench_convert(dims, frames, nrvids, workdir, pools = (1, 4),
+                  resizevals = (1, 0.5), withframes = (False, True)):
+
+    """Throughput of converting h264 videos across conversion settings"""
+
+    print("BENCHMARK: h264 video conversion")
+    print("pools  resizeval  withframe  seconds   frames/s  peak rss (MB)")
+    viddir = os.path.join(workdir, "vids")
+    os.makedirs(viddir)
+    for i in range(nrvids):
+        make_video(os.path.join(viddir, "bench_%03d.h264" % i), dims, frames)
+    results = []
+    for pool in pools:
+        for resizeval in resizevals:
+            for withframe in withframes:
+                code = "import pirecorder; pirecorder.Convert(indir='%s', " \
+                       "outdir='%s', pools=%d, resizeval=%s, withframe=%s, " \
+                       "fps=25)" % (viddir, viddir + "_out", pool, resizeval,
+                                    repr(withframe))
+                secs, rss = run_child(code)
+                nr = nrvids * frames
+                print("%-6d %-10s %-10s %-9.1f %-9.1f %.1f" % (pool, resizeval,
+                      withframe, secs, nr/secs, rss))
+                results.append({"videos": nrvids, "frames": frames,
+                                "dims": list(dims), "pools": pool,
+                                "resizeval": resizeval, "withframe": withframe,
+                                "seconds": secs, "frames_s": nr/secs,
+                                "rss_mb": rss})
+                shutil.rmtree(viddir + "_out")
+    shutil.rmtree(viddir)
+    print("DONE..\n")
+
+    return results
+
+
+def bench_settings(workdir, nr = 200):
+
+    """Latency of generating filenames and storing settings"""
+
+    import pirecorder.pirecorder as pr
+
+    # Set up a recorder with simulated camera in the benchmark folder
+    pr.homedir = lambda: workdir + "/"
+    rec = pr.PiRecorder(logging = False, backend = "sim")
+
+    print("BENCHMARK: filename and settings latency")
+    print("function                  us per call")
+    results = []
+    for rectype in ["img", "imgseq", "vid"]:
+        rec.settings(rectype = rectype, internal = "")
+        start = time.time()
+        for i in range(nr):
+            rec._namefile()
+        t = (time.time() - start) / nr * 1e6
+        print("%-25s %.1f" % ("_namefile ("+rectype+")", t))
+        results.append({"function": "_namefile", "rectype": rectype, "us": t})
+    for i, kwargs in enumerate([{}, {"label": "bench"}]):
+        start = time.time()
+        for j in range(nr):
+            rec.settings(internal = "", **kwargs)
+        t = (time.time() - start) / nr * 1e6
+        name = "settings (%d changes)" % len(kwargs)
+        print("%-25s %.1f" % (name, t))
+        results.append({"function": "settings", "changes": len(kwargs), "us": t})
+    print("DONE..\n")
+
+    return results
+
+
+def bench_record(workdir, dims = (640, 480), duration = 5):
+
+    """End-to-end recording with a simulated camera"""
+
+    import pirecorder.pirecorder as pr
+    from pythutils.fileutils import listfiles
+
+    pr.homedir = lambda: workdir + "/"
+    rec = pr.PiRecorder(configfile = "record.conf", logging = False,
+                        backend = "sim")
+
+    print("BENCHMARK: recording with simulated camera")
+    print("rectype  seconds   setup (s)  files  MB")
+    results = []
+    configs = [{"rectype": "img", "imgdims": dims},
+               {"rectype": "imgseq", "imgdims": dims, "imgwait": 0.5,
+                "imgnr": int(duration/0.5), "imgtime": duration},
+               {"rectype": "vid", "viddims": dims, "vidduration": duration,
+                "viddelay": 0, "maxviddur": 0},
+               {"rectype": "vidseq", "viddims": dims, "vidduration": duration,
+                "viddelay": 0, "maxviddur": duration/2.}]
+    for config in configs:
+        rec.settings(internal = "", label = config["rectype"], **config)
+        start = time.time()
+        rec._setup_cam()
+        setup = time.time() - start
+        rec.cam.close()
+        start = time.time()
+        rec.record(interactive = False)
+        secs = time.time() - start
+        files = [f for f in listfiles(rec.recdir, keepdir = True) if config["rectype"] ==
+                 os.path.basename(f).split("_")[0]]
+        size = sum(os.path.getsize(f) for f in files) / 1000000.
+        print("%-8s %-9.2f %-10.2f %-6d %.2f" % (config["rectype"], secs, setup,
+                                                len(files), size))
+        results.append({"rectype": config["rectype"], "dims": list(dims),
+                        "seconds": secs, "setup_s": setup, "files": len(files),
+                        "mb": size})
+    print("DONE..\n")
+
+    return results
+
+
+def bench_burst(workdir, dims = (640, 480), rates = (10, 20, 30), duration = 5):
+
+    """Sustained rate of burst image sequences with a simulated camera"""
+
+    import glob
+    import pirecorder.pirecorder as pr
+
+    pr.homedir = lambda: workdir + "/"
+    rec = pr.PiRecorder(configfile = "burst.conf", logging = False,
+                        backend = "sim")
+
+    print("BENCHMARK: burst image sequences with simulated camera")
+    print("target/s  images/s  skipped  p99 late (ms)")
+    results = []
+    for rate in rates:
+        label = "burst%d" % rate
+        rec.settings(internal = "", label = label, rectype = "imgseq",
+                     imgburst = True, imgdims = dims, imgwait = 1. / rate,
+                     imgnr = int(duration * rate), imgtime = duration + 1,
+                     shutterspeed = 1000)
+        rec.record()
+        logfile = glob.glob(os.path.join(rec.recdir, label + "_*timing*.csv"))[0]
+        timing = np.loadtxt(logfile, delimiter = ",", skiprows = 2, ndmin = 2)
+        achieved = (len(timing) - 1) / timing[-1, 2]
+        skipped = int(timing[-1, 0]) + 1 - len(timing)
+        p99 = np.percentile(timing[:, 3], 99) * 1000
+        print("%-9d %-9.1f %-8d %.1f" % (rate, achieved, skipped, p99))
+        results.append({"dims": list(dims), "rate": rate, "images_s": achieved,
+                        "skipped": skipped, "p99_ms": p99})
+    print("DONE..\n")
+
+    return results
+
+
+def bench_videoin(dims, frames, workdir, vidsizes = (1, 0.5)):
+
+    """Read rate of VideoIn streams from video files"""
+
+    from pirecorder import VideoIn
+
+    print("BENCHMARK: VideoIn read rate from file")
+    print("format  vidsize  frames/s")
+    results = []
+    for ext in [".h264", ".mp4"]:
+        filename = os.path.join(workdir, "videoin" + ext)
+        make_video(filename, dims, frames)
+        for vidsize in vidsizes:
+            vid = VideoIn(system = filename, vidsize = vidsize)
+            start = time.time()
+            vid.update()
+            fps = vid.frames / (time.time() - start)
+            print("%-7s %-8s %.1f" % (ext, vidsize, fps))
+            results.append({"format": ext, "dims": list(dims), "frames": frames,
+                            "vidsize": vidsize, "frames_s": fps})
+        os.remove(filename)
+    print("DONE..\n")
+
+    return results
+
+
+def make_motionvideo(filename, dims, spans, frames, fps = 25):
+
+    """
+    Writes a synthetic video of a static noisy scene with a moving object
+    during the (start, stop) frame spans, with the same h264 settings as
+    make_video
+    """
+
+    w, h = dims
+    comm = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt",
+            "gray", "-s", "%dx%d" % (w, h), "-r", str(fps), "-i", "-", "-c:v",
+            "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-g",
+            str(fps), "-x264-params", "repeat-headers=1", "-f", "h264", filename]
+    proc = subprocess.Popen(comm, stdin = subprocess.PIPE)
+    rng = np.random.default_rng(0)
+    base = cv2.GaussianBlur(rng.integers(60, 200, (h, w), dtype = np.uint8), (0, 0), 5)
+    size = h // 6
+    for i in range(frames):
+        img = cv2.add(base, rng.integers(0, 6, (h, w), dtype = np.uint8))
+        for start, stop in spans:
+            if start <= i < stop:
+                x = int((i - start) * (w - size) / max(1, stop - start - 1))
+                img[h//2-size//2:h//2+size//2, x:x+size] = 240
+        proc.stdin.write(img.tobytes())
+    proc.stdin.close()
+    proc.wait()
+
+
+def bench_motion(dims, workdir, fps = 25, widths = (160, 320)):
+
+    """Analysis rate and accuracy of motion detection on recorded footage"""
+
+    from pirecorder.motion import detectfile
+
+    print("BENCHMARK: Motion detection on recorded footage")
+    spans = [(2*fps, 4*fps), (7*fps, 8*fps), (12*fps, 15*fps)]
+    frames = 18*fps
+    filename = os.path.join(workdir, "motion.h264")
+    make_motionvideo(filename, dims, spans, frames, fps)
+    print("true spans: " + str(spans))
+    print("width  frames/s  detected spans")
+    results = []
+    for width in widths:
+        detected, rate = detectfile(filename, width, onframes = int(0.2*fps),
+                                    offframes = fps)
+        print("%-6s %-9.1f %s" % (width, rate, detected))
+        results.append({"dims": list(dims), "width": width, "frames": frames,
+                        "frames_s": rate, "spans": spans, "detected": detected})
+    os.remove(filename)
+    print("DONE..\n")
+
+    return results
+
+
+def bench_overlay(nr = 2000):
+
+    """Speed of drawing frame numbers with draw_text and NumberOverlay"""
+
+    from pythutils.drawutils import draw_text
+    from pirecorder.overlay import NumberOverlay
+
+    print("BENCHMARK: frame number overlay")
+    print("resolution   draw_text (us)   NumberOverlay (us)   max pixel diff   auto")
+    results = []
+    numberer = NumberOverlay((10,10), 0.9, col="white", shadow=True,
+                             method="atlas")
+    for w, h in [(1920, 1080), (3840, 2160)]:
+        frame = np.random.randint(0, 255, (h, w, 3), dtype = np.uint8)
+        ref, new = frame.copy(), frame.copy()
+        start = time.time()
+        for i in range(nr):
+            draw_text(ref, str(i), (10,10), 0.9, col="white", shadow=True)
+        t1 = (time.time() - start) / nr * 1e6
+        start = time.time()
+        for i in range(nr):
+            numberer.draw(new, i)
+        t2 = (time.time() - start) / nr * 1e6
+        ref, new = frame.copy(), frame.copy()
+        draw_text(ref, "123456", (10,10), 0.9, col="white", shadow=True)
+        numberer.draw(new, 123456)
+        diff = np.abs(ref.astype(int) - new.astype(int)).max()
+        auto = NumberOverlay((10,10), 0.9, col="white", shadow=True).calibrate(frame)
+        print("%-12s %-16.1f %-20.1f %-16d %s" % ("%dx%d" % (w, h), t1, t2, diff, auto))
+        results.append({"dims": [w, h], "draw_text_us": t1,
+                        "numberoverlay_us": t2, "maxdiff": int(diff),
+                        "auto": auto})
+    print("DONE..\n")
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="benchmark",
+             description="Runs pirecorder performance benchmarks")
+    parser.add_argument("bench", choices=["imgseq", "overlay", "convert",
+                        "settings", "record", "burst", "videoin", "motion",
+                        "all"])
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--dims", nargs=2, type=int, default=None)
+    parser.add_argument("--frames", type=int, default=250)
+    parser.add_argument("--videos", type=int, default=4)
+    parser.add_argument("--pools", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--resizevals", nargs="+", type=float, default=[1, 0.5])
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--json", default=None, metavar="FILE",
+                        help="store the results in a json file")
+    args = parser.parse_args()
+
+    benches = ["imgseq", "overlay", "convert", "settings", "record", "burst",
+               "videoin", "motion"]
+    benches = benches if args.bench == "all" else [args.bench]
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    results = {}
+    try:
+        if "imgseq" in benches:
+            dims = tuple(args.dims) if args.dims else (160, 120)
+            results["imgseq"] = bench_imgseq(args.sizes, dims, workdir, args.pools)
+        if "overlay" in benches:
+            results["overlay"] = bench_overlay()
+        if "convert" in benches:
+            dims = tuple(args.dims) if args.dims else (640, 480)
+            results["convert"] = bench_convert(dims, args.frames, args.videos,
+                                               workdir, args.pools, args.resizevals)
+        if "settings" in benches:
+            results["settings"] = bench_settings(workdir)
+        if "record" in benches:
+            dims = tuple(args.dims) if args.dims else (640, 480)
+            results["record"] = bench_record(workdir, dims)
+        if "burst" in benches:
+            dims = tuple(args.dims) if args.dims else (640, 480)
+            results["burst"] = bench_burst(workdir, dims)
+        if "videoin" in benches:
+            dims = tuple(args.dims) if args.dims else (640, 480)
+            results["videoin"] = bench_videoin(dims, args.frames, workdir)
+        if "motion" in benches:
+            dims = tuple(args.dims) if args.dims else (640, 480)
+            results["motion"] = bench_motion(dims, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        from pirecorder import __version__
+        output = {"version": __version__,
+                  "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                  "host": platform.node(),
+                  "machine": platform.machine(),
+                  "cpus": os.cpu_count(),
+                  "python": platform.python_version(),
+                  "opencv": cv2.__version__,
+                  "args": vars(args),
+                  "results": results}
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent = 2)
+        print("Results stored in " + args.json)
@@ -0,0 +1,188 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Shared fixtures of the behavioural tests, which use the simulated camera
+and run on any linux computer, e.g. with python -m pytest tests. Tests that
+record or encode h264 video need FFmpeg and are skipped without it.
+"""
+
+import os
+import cv2
+import shutil
+import pytest
+import numpy as np
+from io import BytesIO
+
+from pirecorder.simcam import PiCamera, PiVideoFrame
+
+BITS = 10
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None,
+                                  reason = "FFmpeg is not installed")
+
+
+def numbered(nr, dims = (160, 120)):
+
+    """Returns an image that shows nr in binary as black and white bands"""
+
+    w, h = dims
+    img = np.zeros((h, w, 3), np.uint8)
+    band = w // BITS
+    for bit in range(BITS):
+        if nr >> bit & 1:
+            img[:, bit*band:(bit+1)*band] = 255
+
+    return img
+
+
+def readnumber(img):
+
+    """Returns the number shown by an image made with numbered"""
+
+    h, w = img.shape[:2]
+    band = w // BITS
+    return sum(1 << bit for bit in range(BITS)
+               if img[h//2, bit*band + band//2].mean() > 127)
+
+
+def expgolomb(values):
+
+    """Returns the bits of unsigned exp-golomb coded values as a string"""
+
+    bits = ""
+    for value in values:
+        code = bin(value + 1)[2:]
+        bits += "0" * (len(code) - 1) + code
+
+    return bits
+
+
+def nal(naltype, bits, payload = b""):
+
+    """Returns a nal unit with start code from a bit string and payload"""
+
+    bits += "1"
+    bits += "0" * (-len(bits) % 8)
+    data = bytes(int(bits[i:i+8], 2) for i in range(0, len(bits), 8))
+
+    return b"\x00\x00\x00\x01" + bytes([0x60 | naltype]) + data + payload
+
+
+def synthunits(frames, gop = 10, dims = (320, 240), slices = 1, size = 200):
+
+    """
+    Generator of the units of a h264 elementary stream with the structure of
+    that of the camera, as the encoder passes them to its output: the inline
+    headers before each keyframe, with frame type 2, and frames, with frame
+    type 1 for keyframes and 0 otherwise, that may consist of several
+    slices. The slice data can not be decoded.
+    """
+
+    w, h = (dims[0] + 15) // 16, (dims[1] + 15) // 16
+    # Baseline profile, level 4, poc type 2, no cropping and no vui
+    sps = nal(7, "01000010" + "00000000" + "00101000" +
+              expgolomb([0, 0, 2, 1]) + "0" + expgolomb([w - 1, h - 1]) + "1100")
+    pps = nal(8, expgolomb([0, 0]) + "00" + expgolomb([0, 0, 0]))
+    for i in range(frames):
+        keyframe = i % gop == 0
+        if keyframe:
+            yield sps + pps, 2
+        data = b""
+        for j in range(slices):
+            # Slice data without zero bytes, so without start codes
+            payload = bytes((i * 7 + j * 3 + k) % 200 + 50 for k in range(size))
+            data += nal(5 if keyframe else 1,
+                        expgolomb([j * w * h // slices, 7 if keyframe else 5, 0]),
+                        payload)
+        yield data, 1 if keyframe else 0
+
+
+def synthetic(frames, gop = 10, dims = (320, 240), slices = 1, size = 200):
+
+    """Returns a h264 elementary stream made of the units of synthunits"""
+
+    return b"".join(data for data, _ in synthunits(frames, gop, dims, slices, size))
+
+
+def feed(output, units, timestamps):
+
+    """
+    Writes the units of a h264 stream to output with their frame
+    information, as the camera encoder does, with the timestamp of each frame
+    """
+
+    index = -1
+    size = 0
+    for data, frametype in units:
+        if frametype != 2:
+            index += 1
+        size += len(data)
+        output.write(data, PiVideoFrame(max(index, 0), frametype, len(data), size,
+                                        size, timestamps[max(index, 0)], True))
+
+
+def decodedframes(filename):
+
+    """Returns the frames that can be decoded from a video"""
+
+    cap = cv2.VideoCapture(filename)
+    frames = []
+    while True:
+        flag, frame = cap.read()
+        if not flag:
+            break
+        frames.append(frame)
+    cap.release()
+
+    return frames
+
+
+def simvideo(filename, seconds = 4, intra_period = 10, resolution = (320, 240),
+             framerate = 30):
+
+    """Records a h264 video with the simulated camera"""
+
+    with PiCamera(resolution = resolution, framerate = framerate) as cam:
+        cam.start_recording(filename, format = "h264", intra_period = intra_period)
+        cam.wait_recording(seconds)
+        cam.stop_recording()
+
+    return filename
+
+
+@pytest.fixture(scope = "session")
+def video(tmp_path_factory):
+
+    """A 4 second h264 recording of the simulated camera, keyframe every 10 frames"""
+
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("FFmpeg is not installed")
+
+    return simvideo(str(tmp_path_factory.mktemp("video") / "sim.h264"))
+
+
+@pytest.fixture(scope = "session")
+def images():
+
+    """A list of jpeg images captured with the simulated camera"""
+
+    images = []
+    with PiCamera(resolution = (160, 120), framerate = 30) as cam:
+        for _ in range(12):
+            stream = BytesIO()
+            cam.capture(stream, format = "jpeg", use_video_port = True)
+            images.append(stream.getvalue())
+
+    return images
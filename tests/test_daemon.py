@@ -0,0 +1,158 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the recording daemon with the simulated camera
+"""
+
+import os
+import re
+import time
+import pytest
+import threading
+
+from pirecorder.daemon import Daemon, SETTINGS, convert, schema, send
+from pirecorder.pirecorder import PiRecorder
+from conftest import needs_ffmpeg
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+
+    """A daemon with the simulated camera, running on a temporary socket"""
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    socketfile = str(tmp_path / "d.sock")
+    daemon = Daemon(backend = "sim", socketfile = socketfile, logging = False)
+    daemon.rec.settings(rectype = "imgseq", imgdims = (160, 120), imgnr = 1000,
+                        imgtime = 100, automode = False)
+    thread = threading.Thread(target = daemon.run)
+    thread.start()
+    while not os.path.exists(socketfile) or getattr(daemon.rec, "cam", None) is None:
+        time.sleep(0.05)
+    yield daemon, lambda command: send(command, socketfile, timeout = 30)
+
+    if thread.is_alive():
+        send("quit", socketfile)
+    thread.join()
+
+
+def latency(reply):
+
+    match = re.match(r"^ok, first frame after (-?[\d.]+)ms$", reply)
+    assert match is not None, reply
+    return float(match.group(1))
+
+
+def test_schema():
+
+    # Every documented setting can be reconfigured
+    if PiRecorder.settings.__doc__ is not None:
+        documented = re.findall(r"^ {8}(\w+) : ", PiRecorder.settings.__doc__, re.M)
+        assert set(documented) - {"overwrite"} == set(SETTINGS)
+
+    settings = schema(("label", "date", ""))
+    assert convert("vidfps", "20", settings) == 20
+    assert convert("warmupmax", "3", settings) == 3.0
+    assert convert("gains", "(1.5, 2)", settings) == (1.5, 2)
+    assert convert("roi", "None", settings) is None
+    assert convert("recvolumes", "['/media/usb1']", settings) == ["/media/usb1"]
+    assert convert("label", "123", settings) == "123"
+    assert convert("maxres", "(640, 480)", settings) == (640, 480)
+    assert convert("maxres", "v2", settings) == "v2"
+    assert convert("imgburst", "True", settings) is True
+    assert convert("rectype", "vidbuffer", settings) == "vidbuffer"
+    assert convert("nameparam1", "date", settings) == "date"
+
+    # Values are never evaluated, and have to match the type of the setting
+    for key, value in [("gains", "__import__('os').system('false')"),
+                       ("gains", "(1, 2, 3)"), ("gains", "None"),
+                       ("vidfps", "abc"), ("vidfps", "2.5"), ("imgburst", "1"),
+                       ("rectype", "video"), ("nameparam2", "host"),
+                       ("recvolumes", "[1, 2]"), ("foo", "1")]:
+        with pytest.raises(ValueError):
+            convert(key, value, settings)
+
+
+def test_commands(daemon):
+
+    daemon, command = daemon
+    assert command("status") == "camera ready, idle, 0 recordings"
+
+    # A recording replies once its first image has arrived, with the
+    # latency from the time the command was sent
+    assert latency(command("record")) >= 0
+    assert command("record") == "error, already recording"
+    status = command("status")
+    assert status.startswith("camera ready, recording imgseq since ")
+    assert re.search(r", 1 recordings, latency last [\d.]+ms, median [\d.]+ms$", status)
+    assert command("trigger") == "error, no vidbuffer or vidmotion recording running"
+    assert command("reconfigure vidfps=20") == "error, recording running"
+    assert command("stop") == "ok"
+    assert command("stop") == "ok, not recording"
+    assert command("status").startswith("camera ready, idle, 1 recordings, latency")
+    assert len(os.listdir(daemon.rec.recdir)) > 0
+
+    assert latency(command("record " + repr(time.time()) + " pirecorder.conf")) >= 0
+    assert command("stop") == "ok"
+    assert len(daemon.latencies) == 2
+
+
+def test_reconfigure(daemon):
+
+    daemon, command = daemon
+    assert command("reconfigure vidfps=20 gains=(1.5,2.0) roi=None") == "ok"
+    assert daemon.rec.config.vid.vidfps == 20
+    assert str(daemon.rec.config.cus.gains) == "(1.5, 2.0)"
+    assert not daemon.rec.cam.closed
+
+    # Nothing is changed when any of the values does not match its setting
+    for settings in ["vidfps=abc", "vidfps=4 gains=(1,2,3)", "vidfps=4 foo=1",
+                     "vidfps=4 rectype=video",
+                     "gains=__import__('os').system('false')"]:
+        assert command("reconfigure " + settings).startswith("error, ")
+        assert daemon.rec.config.vid.vidfps == 20
+    assert command("reconfigure") == "error, no settings given"
+    assert command("reconfigure vidfps") == "error, settings should be given as key=value"
+
+
+def test_invalid_input(daemon, tmp_path):
+
+    daemon, command = daemon
+    assert command("record 12.5 other.conf") == "error, daemon runs with pirecorder.conf"
+    assert command("foo") == "unknown command"
+    assert command("recordx") == "unknown command"
+    assert command("status now") == "camera ready, idle, 0 recordings"
+
+    # The daemon stops on quit and removes its socket
+    assert command("quit") == "ok"
+    assert daemon.stopped.is_set()
+    end = time.time() + 5
+    while os.path.exists(str(tmp_path / "d.sock")) and time.time() < end:
+        time.sleep(0.05)
+    assert not os.path.exists(str(tmp_path / "d.sock"))
+
+
+@needs_ffmpeg
+def test_trigger(daemon):
+
+    daemon, command = daemon
+    assert command("reconfigure rectype=vidbuffer vidbuffer=1 vidduration=1 "+\
+                   "viddims=(320,240) vidfps=30") == "ok"
+    assert command("record") == "ok, waiting for triggers"
+    time.sleep(1.5)
+    assert latency(command("trigger " + repr(time.time()))) >= 0
+    assert command("stop") == "ok"
+    assert daemon.recordings == 1
+    assert len(daemon.latencies) == 1
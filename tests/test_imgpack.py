@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of packed image sequences and rebuilding their index
+"""
+
+import os
+import numpy as np
+
+from pirecorder.imgpack import ImagePack
+
+
+def makepack(filename, images):
+
+    with ImagePack(filename, "a") as pack:
+        for i, data in enumerate(images):
+            pack.append(data, frame = 2 * i + 1, timestamp = 1000. + i)
+    with ImagePack(filename) as pack:
+        return pack.index.copy()
+
+
+def test_read_images(images, tmp_path):
+
+    filename = str(tmp_path / "seq.mjpeg")
+    index = makepack(filename, images)
+    with ImagePack(filename) as pack:
+        assert len(pack) == len(images)
+        assert [pack.read(i) for i in range(len(pack))] == images
+        assert pack.read(pack.byframe(7)) == images[3]
+        assert pack.image(0).shape == (120, 160, 3)
+    assert list(index["frame"]) == list(range(1, 2 * len(images), 2))
+
+
+def test_rebuild_index(images, tmp_path):
+
+    filename = str(tmp_path / "seq.mjpeg")
+    index = makepack(filename, images)
+    os.remove(filename + ".idx")
+
+    # The offsets and sizes are found again, the images numbered from 1
+    with ImagePack(filename) as pack:
+        rebuilt = pack.index
+        assert list(rebuilt["offset"]) == list(index["offset"])
+        assert list(rebuilt["size"]) == list(index["size"])
+        assert list(rebuilt["frame"]) == list(range(1, len(images) + 1))
+        assert np.isnan(rebuilt["time"]).all()
+
+        # Independent of the size of the chunks the pack is read in
+        for chunksize in [7, 100, len(images[0]), 1 << 22]:
+            scanned = pack._scan(0, chunksize = chunksize)
+            assert list(scanned["offset"]) == list(index["offset"])
+            assert list(scanned["size"]) == list(index["size"])
+
+
+def test_rebuild_incomplete_index(images, tmp_path):
+
+    filename = str(tmp_path / "seq.mjpeg")
+    index = makepack(filename, images)
+
+    # An index that lost its last entries keeps the entries it has
+    with open(filename + ".idx", "r+b") as f:
+        f.truncate(os.path.getsize(filename + ".idx") - 3 * index.itemsize)
+    with ImagePack(filename) as pack:
+        assert list(pack.index["offset"]) == list(index["offset"])
+        assert list(pack.index["frame"][:-3]) == list(index["frame"][:-3])
+        assert list(pack.index["frame"][-3:]) == [index["frame"][-4] + i for i in (1, 2, 3)]
+
+    # And an interrupted last image is removed before appending
+    with open(filename, "ab") as f:
+        f.write(images[0][:100])
+    with ImagePack(filename, "a") as pack:
+        assert len(pack) == len(images)
+        pack.append(images[0])
+    with ImagePack(filename) as pack:
+        assert len(pack) == len(images) + 1
+        assert pack.read(len(images)) == images[0]
+
+
+def test_rebuild_index_corrupt(images, tmp_path):
+
+    # An image that never ends is skipped once it exceeds the maximum size,
+    # without reading the rest of the pack into memory
+    filename = str(tmp_path / "seq.mjpeg")
+    maxsize = 2 * max(len(data) for data in images)
+    corrupt = b"\xff\xd8" + b"\x00" * (4 * maxsize)
+    offsets = []
+    with open(filename, "wb") as f:
+        for i, data in enumerate(images):
+            if i == 4:
+                f.write(corrupt)
+            offsets.append(f.tell())
+            f.write(data)
+    with ImagePack(filename) as pack:
+        scanned = pack._scan(0, chunksize = 100, maxsize = maxsize)
+        assert list(scanned["offset"]) == offsets
+        assert list(scanned["size"]) == [len(data) for data in images]
@@ -0,0 +1,94 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of converting image sequences to video, which uses OpenCV only
+"""
+
+import os
+import cv2
+import glob
+
+from pirecorder.convert import Convert
+from conftest import numbered, readnumber, decodedframes
+
+
+def imgseq(imgdir, nr):
+
+    imgdir.mkdir()
+    for i in range(nr):
+        cv2.imwrite(str(imgdir / ("img_%05d.jpg" % i)), numbered(i))
+
+    return [str(imgdir / ("img_%05d.jpg" % i)) for i in range(nr)]
+
+
+def test_convert_imgseq(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    imgseq(tmp_path / "imgs", 300)
+
+    Convert(str(tmp_path / "imgs"), str(tmp_path / "out"), type = ".jpg",
+            pools = 3, prefetch = 4)
+
+    videos = glob.glob(str(tmp_path / "out" / "*.mp4"))
+    assert len(videos) == 1
+    assert os.listdir(str(tmp_path / "out")) == [os.path.basename(videos[0])]
+    frames = decodedframes(videos[0])
+    assert [readnumber(frame) for frame in frames] == list(range(300))
+
+
+def test_imgstream_bounded(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    files = imgseq(tmp_path / "imgs", 100)
+    (tmp_path / "empty").mkdir()
+    converter = Convert(str(tmp_path / "empty"), type = ".jpg", pools = 2,
+                        prefetch = 5)
+
+    # Images are read at most the prefetch window ahead of the consumer
+    read = []
+    readimg = converter.readimg
+    converter.readimg = lambda filename, pack = None: read.append(filename) or \
+                                                      readimg(filename, pack)
+    ahead = []
+    numbers = []
+    for frame in converter.imgstream(files):
+        ahead.append(len(read) - len(numbers))
+        numbers.append(readnumber(frame))
+    assert numbers == list(range(100))
+    assert max(ahead) <= 5
+
+
+def test_convert_unreadable_images(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    files = imgseq(tmp_path / "imgs", 20)
+
+    # Truncated images, e.g. of a partial copy, are skipped, also the first
+    for i in [0, 1, 7]:
+        with open(files[i], "r+b") as f:
+            f.truncate(100)
+    Convert(str(tmp_path / "imgs"), str(tmp_path / "out"), type = ".jpg")
+
+    videos = glob.glob(str(tmp_path / "out" / "*.mp4"))
+    assert len(videos) == 1
+    numbers = [readnumber(frame) for frame in decodedframes(videos[0])]
+    assert numbers == [i for i in range(20) if i not in [0, 1, 7]]
+
+    # And without any readable image no video is made
+    for filename in files:
+        with open(filename, "r+b") as f:
+            f.truncate(100)
+    Convert(str(tmp_path / "imgs"), str(tmp_path / "none"), type = ".jpg")
+    assert os.listdir(str(tmp_path / "none")) == []
@@ -0,0 +1,127 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the conversion ledger
+"""
+
+import os
+import json
+import shutil
+
+from pirecorder.ledger import Ledger
+from pirecorder.convert import Convert
+from conftest import needs_ffmpeg
+
+PARAMS = {"type": ".h264", "resizeval": 1}
+
+
+def media(tmp_path):
+
+    source = tmp_path / "video.h264"
+    source.write_bytes(os.urandom(100000))
+    output = tmp_path / "video.mp4"
+    output.write_bytes(os.urandom(50000))
+
+    return str(source), str(output)
+
+
+def test_isdone(tmp_path):
+
+    source, output = media(tmp_path)
+    ledger = Ledger(str(tmp_path / "ledger.jsonl"))
+    assert not ledger.isdone(source, PARAMS)
+    ledger.record(source, output, PARAMS, 1.5, "done")
+    assert ledger.isdone(source, PARAMS)
+    assert not ledger.isdone(source, dict(PARAMS, resizeval = 0.5))
+
+    # A touched but unchanged source is still done, a changed one not
+    os.utime(source, (1, 1))
+    assert ledger.isdone(source, PARAMS)
+    with open(source, "r+b") as f:
+        f.write(b"changed")
+    assert not ledger.isdone(source, PARAMS)
+
+
+def test_failed_and_changed_output(tmp_path):
+
+    source, output = media(tmp_path)
+    ledger = Ledger(str(tmp_path / "ledger.jsonl"))
+    ledger.record(source, output, PARAMS, 1.5, "failed")
+    assert not ledger.isdone(source, PARAMS)
+    ledger.record(source, output, PARAMS, 1.5, "done")
+    with open(output, "ab") as f:
+        f.write(b"\0")
+    assert not ledger.isdone(source, PARAMS)
+
+
+def test_update_and_compact(tmp_path):
+
+    source, output = media(tmp_path)
+    filename = str(tmp_path / "ledger.jsonl")
+    ledger = Ledger(filename)
+
+    # Entries appended by another process, e.g. a conversion worker, are
+    # added by update, except for a partly written last line
+    Ledger(filename).record(source, output, PARAMS, 1.5, "done")
+    with open(filename, "a") as f:
+        f.write('{"source": "partial"')
+    assert not ledger.isdone(source, PARAMS)
+    assert ledger.update() == 1
+    assert ledger.isdone(source, PARAMS)
+    assert ledger.update() == 0
+
+    # A ledger with many superseded entries is compacted when opened
+    with open(filename, "w") as f:
+        pass
+    for _ in range(150):
+        ledger.record(source, output, PARAMS, 1.5, "done")
+    ledger = Ledger(filename)
+    assert len(open(filename).readlines()) == 1
+    assert ledger.isdone(source, PARAMS)
+
+
+@needs_ffmpeg
+def test_convert_skips_converted(video, tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    indir = tmp_path / "in"
+    indir.mkdir()
+    shutil.copy(video, str(indir))
+    outdir = tmp_path / "out"
+    output = str(outdir / "sim.mp4")
+
+    Convert(str(indir), str(outdir), ledger = True)
+    assert os.path.exists(output)
+    mtime = os.stat(output).st_mtime_ns
+    ledgerfile = str(outdir / "convert_ledger.jsonl")
+    entries = [json.loads(line) for line in open(ledgerfile)]
+    assert [entry["status"] for entry in entries] == ["done"]
+    assert entries[0]["output"] == output
+
+    # A rerun with the same parameters skips the video
+    converter = Convert(str(indir), str(outdir), ledger = True)
+    assert converter.todo == []
+    assert os.stat(output).st_mtime_ns == mtime
+
+    # As does a rerun after the original is touched but not changed
+    os.utime(str(indir / "sim.h264"))
+    assert Convert(str(indir), str(outdir), ledger = True).todo == []
+
+    # But not when the parameters or the output changed
+    assert Convert(str(indir), str(outdir), resizeval = 0.5, ledger = True).todo != []
+    assert Convert(str(indir), str(outdir), resizeval = 0.5, ledger = True).todo == []
+    with open(output, "ab") as f:
+        f.write(b"\0")
+    assert Convert(str(indir), str(outdir), resizeval = 0.5, ledger = True).todo != []
@@ -0,0 +1,151 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of muxing the h264 output of the camera directly into fragmented mp4
+"""
+
+import struct
+from io import BytesIO
+
+from pirecorder.h264 import splitnals
+from pirecorder.simcam import PiCamera
+from pirecorder.mp4mux import MP4Muxer
+from pirecorder.outputs import SegmentOutput
+from conftest import needs_ffmpeg, decodedframes, feed, synthunits
+
+CONTAINERS = [b"moov", b"trak", b"mdia", b"minf", b"stbl", b"mvex",
+              b"moof", b"traf", b"mfra"]
+
+
+def boxes(data, start = 0, end = None):
+
+    """Returns the (name, offset, size, children) of the boxes in data"""
+
+    end = len(data) if end is None else end
+    result = []
+    while start < end:
+        size, name = struct.unpack(">I4s", data[start:start+8])
+        assert size >= 8 and start + size <= end
+        children = boxes(data, start + 8, start + size) if name in CONTAINERS else []
+        result.append((name, start, size, children))
+        start += size
+
+    return result
+
+
+def child(box, name):
+
+    return [c for c in box[3] if c[0] == name][0]
+
+
+def mux(units, frames, framerate = 30):
+
+    output = BytesIO()
+    muxer = MP4Muxer(output, framerate)
+    feed(muxer, units, [int(i * 1000000 / framerate) for i in range(frames)])
+    muxer.close()
+
+    return muxer, output.getvalue()
+
+
+def test_mp4mux_structure():
+
+    units = list(synthunits(95, gop = 10, slices = 2))
+    muxer, data = mux(units, 95)
+    assert muxer.frames == 95
+    assert muxer.skipped == 0
+
+    # The headers are followed by a fragment for each group of frames, and
+    # the random access index at the end
+    top = boxes(data)
+    names = [name for name, _, _, _ in top]
+    assert names == [b"ftyp", b"moov"] + [b"moof", b"mdat"] * 10 + [b"mfra"]
+    mfra = top[-1]
+    assert [name for name, _, _, _ in mfra[3]] == [b"tfra", b"mfro"]
+    _, offset, _, _ = child(mfra, b"mfro")
+    assert struct.unpack(">I", data[offset+12:offset+16])[0] == mfra[2]
+
+    counts = []
+    durations = []
+    fragments = list(zip(top[2:-1:2], top[3:-1:2]))
+    for i, (moof, mdat) in enumerate(fragments):
+        _, offset, _, _ = child(child(moof, b"traf"), b"trun")
+        nr, dataoffset = struct.unpack(">Ii", data[offset+12:offset+20])
+        entries = [struct.unpack(">3I", data[offset+20+12*j:offset+32+12*j])
+                   for j in range(nr)]
+        counts.append(nr)
+        durations += [duration for duration, _, _ in entries]
+
+        # Samples start at the data of the mdat and fill it exactly, with
+        # only the first sample of each fragment a keyframe
+        assert moof[1] + dataoffset == mdat[1] + 8
+        assert sum(size for _, size, _ in entries) == mdat[2] - 8
+        assert [flags for _, _, flags in entries] == \
+               [0x02000000] + [0x01010000] * (nr - 1)
+
+        # Samples hold the nal units of a frame with length prefixes in
+        # place of the start codes, without the headers
+        frames = [unit for unit, frametype in units if frametype != 2]
+        nals = splitnals(b"".join(frames[i*10:i*10+nr]))
+        assert data[mdat[1]+8:mdat[1]+mdat[2]] == \
+               b"".join(struct.pack(">I", len(nal)) + nal for nal in nals)
+
+    assert counts == [10] * 9 + [5]
+    assert durations == [3000] * 95
+
+    # The random access index points at the start of each fragment
+    _, offset, _, _ = child(mfra, b"tfra")
+    nr = struct.unpack(">I", data[offset+20:offset+24])[0]
+    entries = [struct.unpack(">QQ", data[offset+24+19*i:offset+40+19*i])
+               for i in range(nr)]
+    assert [moofoffset for _, moofoffset in entries] == \
+           [moof[1] for moof, _ in fragments]
+    assert [time for time, _ in entries] == list(range(0, 95 * 3000, 30000))
+
+
+def test_mp4mux_starts_at_keyframe():
+
+    # Frames before the first keyframe with headers can not be decoded and
+    # are skipped
+    units = list(synthunits(25, gop = 10))[2:]
+    muxer, data = mux(units, 25)
+    assert muxer.skipped == 9
+    assert muxer.frames == 15
+    assert [name for name, _, _, _ in boxes(data)] == \
+           [b"ftyp", b"moov", b"moof", b"mdat", b"moof", b"mdat", b"mfra"]
+
+    muxer, data = mux([], 0)
+    assert muxer.frames == 0
+    assert data == b""
+
+
+@needs_ffmpeg
+def test_mp4mux_recording(tmp_path):
+
+    with PiCamera(resolution = (320, 240), framerate = 30) as cam:
+        output = SegmentOutput(cam, str(tmp_path / "video"), ".mp4")
+        cam.start_recording(output, format = "h264", intra_period = 10,
+                            inline_headers = True)
+        encoder = cam.encoders[1]
+        cam.wait_recording(2)
+        cam.stop_recording()
+        output.close()
+
+    # Every frame of the encoder is muxed and can be decoded
+    filename = str(tmp_path / "video.mp4")
+    data = open(filename, "rb").read()
+    names = [name for name, _, _, _ in boxes(data)]
+    assert names[:2] == [b"ftyp", b"moov"] and names[-1] == b"mfra"
+    assert len(decodedframes(filename)) == encoder.index + 1
@@ -0,0 +1,145 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of offloading recordings, including resuming interrupted copies
+"""
+
+import os
+import sys
+import time
+
+from pirecorder.offload import Offloader, offload
+
+CHUNK = 1 << 12
+
+
+def recording(tmp_path, size = 25 * CHUNK + 100):
+
+    """Returns a recording directory with a single file of random data"""
+
+    recdir = tmp_path / "rec"
+    recdir.mkdir()
+    filename = str(recdir / "sim.h264")
+    with open(filename, "wb") as f:
+        f.write(os.urandom(size))
+
+    return str(recdir), filename
+
+
+def interrupted(filename, target, chunks):
+
+    """Starts copying filename to target and interrupts after chunks chunks"""
+
+    offloader = Offloader(target, [os.path.dirname(filename)], chunksize = CHUNK)
+    wait = offloader.limiter.wait
+    copied = []
+    def limit(size):
+        copied.append(size)
+        if len(copied) > chunks:
+            offloader.stopped.set()
+        return wait(size)
+    offloader.limiter.wait = limit
+    assert not offloader.copy(filename)
+    offloader.close(wait = False)
+
+    return offloader.destination(filename)
+
+
+def test_resume_after_interruption(tmp_path):
+
+    recdir, filename = recording(tmp_path)
+    target = str(tmp_path / "nas")
+
+    dest = interrupted(filename, target, 3)
+    part = os.path.join(target, ".sim.h264.part")
+    assert not os.path.exists(dest)
+    assert os.path.getsize(part) == 3 * CHUNK
+    assert len(open(part + ".sums").read().split()) == 3
+
+    offloader = Offloader(target, [recdir], chunksize = CHUNK)
+    assert offloader.copy(filename)
+    offloader.close(wait = False)
+    assert offloader.resumed == 1
+    assert offloader.bytes == os.path.getsize(filename) - 3 * CHUNK
+    assert open(dest, "rb").read() == open(filename, "rb").read()
+    assert not os.path.exists(part)
+    assert not os.path.exists(part + ".sums")
+
+
+def test_resume_skips_changed_chunks(tmp_path):
+
+    recdir, filename = recording(tmp_path)
+    target = str(tmp_path / "nas")
+    dest = interrupted(filename, target, 3)
+
+    # Chunks of the partial copy that no longer match the original are
+    # copied again, and the original is only deleted after verification
+    with open(filename, "r+b") as f:
+        f.seek(CHUNK + 10)
+        f.write(b"\0\0\0\0")
+    offloader = Offloader(target, [recdir], chunksize = CHUNK, delete = True)
+    original = open(filename, "rb").read()
+    assert offloader.copy(filename)
+    offloader.close(wait = False)
+    assert offloader.bytes == len(original) - CHUNK
+    assert open(dest, "rb").read() == original
+    assert not os.path.exists(filename)
+
+
+def test_pending_files_resume(tmp_path):
+
+    recdir, filename = recording(tmp_path)
+    target = str(tmp_path / "nas")
+    statefile = str(tmp_path / "offload.pending")
+
+    # Files that are still queued when the offloader is closed are kept in
+    # the statefile and offloaded by the next offloader
+    offloader = Offloader(target, [recdir], rate = 0.001, statefile = statefile,
+                          chunksize = CHUNK)
+    offloader.add(filename)
+    offloader.close(wait = False)
+    assert open(statefile).read().split() == [filename]
+
+    offloader = Offloader(target, [recdir], statefile = statefile,
+                          chunksize = CHUNK)
+    offloader.close()
+    assert offloader.copied == 1
+    assert open(statefile).read() == ""
+    assert open(os.path.join(target, "sim.h264"), "rb").read() == open(filename, "rb").read()
+
+
+def test_close_timeout(tmp_path, monkeypatch):
+
+    recdir, filename = recording(tmp_path)
+    target = str(tmp_path / "nas")
+    statefile = str(tmp_path / "offload.pending")
+
+    # Waiting for a slow offload gives up after the timeout, and keeps the
+    # files that are left for the next time
+    offloader = Offloader(target, [recdir], rate = 0.01, statefile = statefile,
+                          chunksize = CHUNK)
+    offloader.add(filename)
+    assert not offloader.wait(0.2)
+    start = time.monotonic()
+    offloader.close(timeout = 0.2)
+    assert time.monotonic() - start < 2
+    assert offloader.pending == [filename]
+    assert open(statefile).read().split() == [filename]
+
+    # Or to offload with the offload command
+    monkeypatch.setattr(sys, "argv", ["offload", recdir, target])
+    offload()
+    assert open(os.path.join(target, "sim.h264"), "rb").read() == \
+           open(filename, "rb").read()
@@ -0,0 +1,229 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the custom outputs of the camera encoder
+"""
+
+import os
+import time
+import pytest
+from threading import Thread, current_thread
+
+from pirecorder.simcam import PiCamera
+from pirecorder.h264 import framecount, nalunits, isframestart
+from pirecorder.outputs import AsyncWriter, BufferOutput, SegmentOutput
+from pirecorder.sidecar import readframes, sidecarname
+from pirecorder.storage import Storage
+from conftest import needs_ffmpeg, feed, synthunits, synthetic
+
+
+def simrecord(output, seconds, framerate = 30, intra_period = 10):
+
+    """
+    Records to output with the simulated camera and returns the number of
+    frames the encoder produced
+    """
+
+    with PiCamera(resolution = (320, 240), framerate = framerate) as cam:
+        output = output(cam)
+        cam.start_recording(output, format = "h264", intra_period = intra_period)
+        encoder = cam.encoders[1]
+        cam.wait_recording(seconds)
+        cam.stop_recording()
+        output.close()
+
+    return output, encoder.index + 1
+
+
+@needs_ffmpeg
+def test_segments_gapless(tmp_path):
+
+    requests = []
+    def segmented(cam):
+        cam.request_key_frame = lambda splitter_port = 1: requests.append(cam.frame.index)
+        return SegmentOutput(cam, str(tmp_path / "video"), maxdur = 0.5,
+                             numbered = True)
+    output, frames = simrecord(segmented, 3)
+
+    # Segments are rotated at the first keyframe after they are full, and
+    # together hold every frame of the encoder
+    segments = output.segments
+    assert len(segments) >= 4
+    assert sum(segment["frames"] for segment in segments) == frames
+    for i, segment in enumerate(segments):
+        assert segment["filename"] == str(tmp_path / ("video_v%02d.h264" % (i+1)))
+        assert framecount(segment["filename"]) == segment["frames"]
+        assert os.path.getsize(segment["filename"]) == segment["size"]
+        nals = list(nalunits(segment["filename"]))
+        assert nals[0][1] == 7
+        assert [naltype for _, naltype, firstmb in nals
+                if isframestart(naltype, firstmb)][0] == 5
+        assert segment["dropped"] == 0
+        assert segment["gap"] == 0
+    for segment in segments[:-1]:
+        assert segment["frames"] == 20
+
+    # A keyframe is requested once for each full segment
+    assert len(segments) - 1 <= len(requests) <= len(segments)
+
+
+def test_segments_dropped(tmp_path):
+
+    cam = PiCamera(resolution = (320, 240), framerate = 30)
+    storage = Storage([str(tmp_path)], minfree = 0)
+    threads = []
+    path = storage.path
+    storage.path = lambda *args: threads.append(current_thread()) or path(*args)
+    output = SegmentOutput(cam, "video", maxdur = 0.5, numbered = True,
+                           storage = storage)
+
+    # Two frames are dropped in the first segment and one frame is missing
+    # between the first and second segment
+    interval = 1000000 / 30.
+    skipped = [0] * 5 + [2] * 15 + [3] * 40
+    feed(output, synthunits(60, 10), [int((i + skip) * interval)
+                                      for i, skip in enumerate(skipped)])
+    output.close()
+    cam.close()
+
+    segments = output.segments
+    assert [segment["frames"] for segment in segments] == [20, 20, 20]
+    assert [segment["dropped"] for segment in segments] == [2, 0, 0]
+    assert [segment["gap"] for segment in segments] == [0, 1, 0]
+    assert [segment["filename"] for segment in segments] == \
+           [str(tmp_path / ("video_v%02d.h264" % nr)) for nr in [1, 2, 3]]
+    data = b"".join(open(segment["filename"], "rb").read() for segment in segments)
+    assert data == synthetic(60, 10)
+
+    # Only the path of the first segment is determined by the thread that
+    # writes, those of the next segments in the background
+    assert threads[0] == current_thread()
+    assert current_thread() not in threads[1:]
+
+
+@needs_ffmpeg
+def test_buffer_preroll(tmp_path):
+
+    with PiCamera(resolution = (320, 240), framerate = 30) as cam:
+        buffer = BufferOutput(cam, 1)
+        cam.start_recording(buffer, format = "h264", intra_period = 10,
+                            inline_headers = True)
+        cam.wait_recording(2)
+        video = SegmentOutput(cam, str(tmp_path / "video"), sidecar = True,
+                              preroll = 1)
+        triggered = cam.frame.timestamp
+        buffer.trigger(video)
+        cam.wait_recording(1)
+        buffer.release()
+        assert buffer.released.wait(5)
+        cam.wait_recording(0.5)
+        cam.stop_recording()
+        video.close()
+
+    # The released video starts with the headers of a keyframe, holds at
+    # least the buffered second before the trigger, and ends at the keyframe
+    # after the release
+    filename = str(tmp_path / "video.h264")
+    nals = list(nalunits(filename))
+    assert nals[0][1] == 7
+    assert [naltype for _, naltype, firstmb in nals
+            if isframestart(naltype, firstmb)][0] == 5
+    records = readframes(sidecarname(filename))
+    assert len(records) == framecount(filename)
+    assert list(records["index"]) == list(range(records["index"][0],
+                                                records["index"][0] + len(records)))
+    preroll = (triggered - records["timestamp"][0]) / 1000000.
+    assert 1 - 1.5 / 30 <= preroll <= 1 + 11 / 30.
+    assert len(records) % 10 == 0
+    assert len(buffer.groups) > 0
+
+
+def chunks(nr, seed = 0):
+
+    """Returns nr chunks of numbered data of varying sizes"""
+
+    return [bytes([(seed + i) % 256]) * (100 + i * 37 % 3000) for i in range(nr)]
+
+
+def test_asyncwriter_slow_sink(tmp_path, capsys):
+
+    # A fifo that is read slowly stands in for storage that can not keep up
+    fifo = str(tmp_path / "fifo")
+    os.mkfifo(fifo)
+    received = []
+    def read():
+        with open(fifo, "rb") as f:
+            while True:
+                data = f.read(4096)
+                if not data:
+                    return
+                received.append(data)
+                time.sleep(0.002)
+    reader = Thread(target = read)
+    reader.start()
+
+    writer = AsyncWriter(4096, 4)
+    writer.open(fifo)
+    data = chunks(200)
+    for chunk in data:
+        writer.write(chunk)
+    writer.close()
+    reader.join()
+
+    # All data arrives in order, and writing waited when all buffers were
+    # waiting to be written, which is warned about
+    assert b"".join(received) == b"".join(data)
+    assert writer.written == len(b"".join(data))
+    assert writer.maxdepth == 3
+    assert writer.waits > 0
+    assert writer.maxstall > 0
+    assert "Storage is falling behind" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("fsync", ["never", "close", "always", 1000])
+def test_asyncwriter_files(tmp_path, fsync):
+
+    closed = []
+    writer = AsyncWriter(4096, 4, fsync = fsync, onclose = closed.append)
+    syncs = []
+    sync = writer._sync
+    writer._sync = lambda fd: syncs.append(fd) or sync(fd)
+    files = [str(tmp_path / "first"), str(tmp_path / "second")]
+    data = [b"".join(chunks(20, 0)), b"".join(chunks(10, 1))]
+
+    # Preallocated space that is not used is released when a file is closed
+    writer.open(files[0], prealloc = 1<<20)
+    writer.write(data[0])
+    writer.open(files[1])
+    writer.write(data[1])
+    writer.close()
+
+    assert [open(filename, "rb").read() for filename in files] == data
+    assert closed == files
+    assert writer.written == len(data[0]) + len(data[1])
+
+    # Files are synced after each buffer, or only when they are closed
+    buffers = sum(-(-len(d) // writer.buffersize) for d in data)
+    expected = {"never": 0, "close": 2, "always": buffers + 2, 1000: 2}
+    assert len(syncs) == expected[fsync]
+
+
+def test_asyncwriter_error(tmp_path):
+
+    writer = AsyncWriter(4096, 4)
+    writer.open(str(tmp_path / "missing" / "video.h264"))
+    writer.write(b"\0" * 10000)
+    with pytest.raises(OSError):
+        writer.close()
@@ -0,0 +1,149 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the frame sidecar files and converting videos with their timestamps
+"""
+
+import os
+import time
+import pytest
+import threading
+import numpy as np
+
+from pirecorder.h264 import accessunits, framecount
+from pirecorder.convert import Convert
+from pirecorder.outputs import SegmentOutput
+from pirecorder.sidecar import FRAMES, readframes, sidecarname
+from pirecorder.simcam import PiCamera
+from conftest import needs_ffmpeg, decodedframes, synthetic
+
+
+@pytest.fixture(autouse = True)
+def workdir(tmp_path, monkeypatch):
+
+    # Converting changes the working directory to the input directory
+    monkeypatch.chdir(tmp_path)
+
+
+def records(nr, fps = 10):
+
+    records = np.zeros(nr, FRAMES)
+    records["index"] = np.arange(nr)
+    records["timestamp"] = np.arange(nr) * 1000000 // fps
+    return records
+
+
+def timed(tmp_path, frames, nr, age = 0):
+
+    """
+    Returns a converter and a synthetic video with a sidecar of nr records
+    that was last modified age seconds ago
+    """
+
+    (tmp_path / "empty").mkdir()
+    converter = Convert(str(tmp_path / "empty"))
+    filename = str(tmp_path / "video.h264")
+    with open(filename, "wb") as f:
+        f.write(synthetic(frames, 10))
+    records(nr).tofile(sidecarname(filename))
+    if age > 0:
+        mtime = time.time() - age
+        os.utime(sidecarname(filename), (mtime, mtime))
+
+    return converter, filename
+
+
+@needs_ffmpeg
+def test_sidecar_recording(tmp_path):
+
+    with PiCamera(resolution = (320, 240), framerate = 30) as cam:
+        output = SegmentOutput(cam, str(tmp_path / "video"), sidecar = True)
+        cam.start_recording(output, format = "h264", intra_period = 10,
+                            inline_headers = True)
+        encoder = cam.encoders[1]
+        cam.wait_recording(2)
+        cam.stop_recording()
+        output.close()
+
+    # The sidecar holds a record of each frame, with the position of the
+    # frame in the video and the time it was captured
+    filename = str(tmp_path / "video.h264")
+    frames = readframes(sidecarname(filename))
+    units = list(accessunits(filename))
+    assert len(frames) == len(units) == framecount(filename) == encoder.index + 1
+    assert list(frames["index"]) == list(range(len(frames)))
+    assert np.all(np.diff(frames["timestamp"]) > 0)
+    assert list(frames["offset"] + frames["size"])[:-1] == list(frames["offset"])[1:]
+    assert list(frames["offset"] + frames["size"]) == \
+           [offset + size for offset, size, _ in units]
+    assert list(frames["keyframe"]) == [keyframe for _, _, keyframe in units]
+    assert list(np.flatnonzero(frames["keyframe"])) == list(range(0, len(frames), 10))
+
+    # And is used to convert the video with the timestamps of the frames
+    (tmp_path / "empty").mkdir()
+    converter = Convert(str(tmp_path / "empty"))
+    assert converter.conv_timed(filename, str(tmp_path / "video.mp4"))
+    assert len(decodedframes(str(tmp_path / "video.mp4"))) == len(frames)
+
+
+def test_conv_timed(tmp_path):
+
+    converter, filename = timed(tmp_path, 30, 30)
+    fileout = str(tmp_path / "video.mp4")
+    assert converter.conv_timed(filename, fileout)
+    assert open(fileout, "rb").read(8)[4:] == b"ftyp"
+
+
+def test_conv_timed_mismatch(tmp_path, capsys):
+
+    # A sidecar that does not match the video falls back to a fixed framerate
+    converter, filename = timed(tmp_path, 30, 40)
+    start = time.time()
+    assert not converter.conv_timed(filename, str(tmp_path / "video.mp4"))
+    assert time.time() - start < 1
+    assert "do not match its sidecar" in capsys.readouterr().out
+    os.remove(sidecarname(filename))
+    assert not converter.conv_timed(filename, str(tmp_path / "video.mp4"))
+
+
+def test_conv_timed_wait(tmp_path):
+
+    # A sidecar that is still being written is given time to be completed
+    converter, filename = timed(tmp_path, 30, 20)
+    def complete():
+        time.sleep(0.5)
+        with open(sidecarname(filename), "ab") as f:
+            records(30)[20:].tofile(f)
+    thread = threading.Thread(target = complete)
+    thread.start()
+    start = time.time()
+    assert converter.conv_timed(filename, str(tmp_path / "video.mp4"))
+    assert time.time() - start >= 0.4
+    thread.join()
+
+
+def test_conv_timed_incomplete(tmp_path):
+
+    # But only up to 5 seconds after it was last modified
+    converter, filename = timed(tmp_path, 30, 20, age = 4)
+    start = time.time()
+    assert not converter.conv_timed(filename, str(tmp_path / "video.mp4"))
+    assert 0.5 < time.time() - start < 3
+
+    mtime = time.time() - 60
+    os.utime(sidecarname(filename), (mtime, mtime))
+    start = time.time()
+    assert not converter.conv_timed(filename, str(tmp_path / "video.mp4"))
+    assert time.time() - start < 1
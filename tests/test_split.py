@@ -0,0 +1,101 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of splitting h264 videos at keyframes and converting them in chunks
+"""
+
+import os
+import shutil
+
+from pirecorder.h264 import framecount, keyframes, nalunits, isframestart, splitfile
+from pirecorder.convert import Convert
+from conftest import needs_ffmpeg, decodedframes, synthetic
+
+
+def checkchunks(filename, chunks):
+
+    # Chunks are cut at the headers before a keyframe and together hold
+    # exactly the frames and bytes of the original
+    first = 0
+    for chunkname, frame in chunks:
+        assert frame == first
+        nals = list(nalunits(chunkname))
+        assert nals[0][1] == 7
+        assert [naltype for _, naltype, firstmb in nals
+                if isframestart(naltype, firstmb)][0] == 5
+        first += framecount(chunkname)
+    assert first == framecount(filename)
+    data = b"".join(open(chunkname, "rb").read() for chunkname, _ in chunks)
+    assert data == open(filename, "rb").read()
+
+
+def test_keyframes(tmp_path):
+
+    filename = str(tmp_path / "synthetic.h264")
+    with open(filename, "wb") as f:
+        f.write(synthetic(95, gop = 10, slices = 3))
+    assert framecount(filename) == 95
+    assert [frame for _, frame in keyframes(filename)] == list(range(0, 95, 10))
+
+
+def test_split_synthetic(tmp_path):
+
+    filename = str(tmp_path / "synthetic.h264")
+    with open(filename, "wb") as f:
+        f.write(synthetic(95, gop = 10, slices = 3))
+    size = os.path.getsize(filename)
+
+    # Chunks are at least chunksize, and a remainder of less than half a
+    # chunk is added to the last chunk
+    chunks = splitfile(filename, size / 4, str(tmp_path / "synthetic"))
+    assert [frame for _, frame in chunks] == [0, 30, 60]
+    checkchunks(filename, chunks)
+
+    chunks = splitfile(filename, size * 0.45, str(tmp_path / "large"))
+    assert len(chunks) == 2
+    checkchunks(filename, chunks)
+    assert splitfile(filename, size, str(tmp_path / "none")) == []
+
+
+def test_split_frame_exact(video, tmp_path):
+
+    chunks = splitfile(video, os.path.getsize(video) / 4, str(tmp_path / "sim"))
+    assert len(chunks) > 1
+    checkchunks(video, chunks)
+
+    # Each chunk decodes on its own
+    for chunkname, _ in chunks:
+        assert len(decodedframes(chunkname)) == framecount(chunkname)
+
+
+@needs_ffmpeg
+def test_split_join_frame_exact(video, tmp_path, monkeypatch, capsys):
+
+    monkeypatch.chdir(tmp_path)
+    indir = tmp_path / "in"
+    indir.mkdir()
+    shutil.copy(video, str(indir))
+    splitsize = os.path.getsize(video) / 4 / 1000000.
+
+    Convert(str(indir), str(tmp_path / "split"), resizeval = 0.5, pools = 2,
+            splitsize = splitsize)
+    assert "Split sim.h264 into" in capsys.readouterr().out
+    Convert(str(indir), str(tmp_path / "whole"), resizeval = 0.5, pools = 2)
+
+    split = decodedframes(str(tmp_path / "split" / "sim.mp4"))
+    whole = decodedframes(str(tmp_path / "whole" / "sim.mp4"))
+    assert len(split) == framecount(video)
+    assert len(split) == len(whole)
+    assert os.listdir(str(tmp_path / "split")) == ["sim.mp4"]
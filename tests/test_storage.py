@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the management of recording volumes
+"""
+
+import os
+import pytest
+
+import pirecorder.storage
+from pirecorder.storage import Storage, fallocate
+from pirecorder.outputs import AsyncWriter
+
+MB = 1000000
+
+
+@pytest.fixture
+def volumes(tmp_path, monkeypatch):
+
+    """Two volumes with a free space that can be set"""
+
+    volumes = [str(tmp_path / "first"), str(tmp_path / "second")]
+    for volume in volumes:
+        os.mkdir(volume)
+    free = {volume: 0 for volume in volumes}
+    def freespace(path):
+        if path not in free:
+            raise OSError("not mounted")
+        return free[path]
+    monkeypatch.setattr(pirecorder.storage, "freespace", freespace)
+
+    return volumes, free
+
+
+def test_rollover(volumes, capsys):
+
+    (first, second), free = volumes
+    free[first] = 5 * MB
+    free[second] = 20 * MB
+    storage = Storage([first, second], minfree = 1, interval = 1000)
+    assert storage.available() == 4 * MB + 19 * MB
+    assert storage.fits(23 * MB) and not storage.fits(24 * MB)
+
+    # Files are stored on the first volume while they leave minfree free,
+    # with the free space reduced by their projected size in between checks
+    assert storage.path("video_v01.h264", 2 * MB) == os.path.join(first, "video_v01.h264")
+    assert storage.path("video_v02.h264", 2 * MB) == os.path.join(first, "video_v02.h264")
+    assert capsys.readouterr().out == ""
+    assert storage.path("sub/video_v03.h264", 2 * MB) == \
+           os.path.join(second, "sub", "video_v03.h264")
+    assert os.path.isdir(os.path.join(second, "sub"))
+    assert "Recording volume full, continuing on "+second in capsys.readouterr().out
+    assert storage.volume == second
+    assert storage.available() == 19 * MB
+
+    # When all volumes are full, recording continues on the last volume
+    free[second] = 2 * MB
+    storage.checked = 0
+    assert storage.path("video_v04.h264", 2 * MB) == os.path.join(second, "video_v04.h264")
+    assert "All recording volumes are nearly full" in capsys.readouterr().out
+    assert storage.path("video_v05.h264", 2 * MB) == os.path.join(second, "video_v05.h264")
+    assert storage.available() == 1 * MB
+
+
+def test_minfree(volumes):
+
+    (first, second), free = volumes
+    free[first] = 1500 * MB
+    free[second] = 5000 * MB
+    storage = Storage([first, second], interval = 0)
+
+    # The default keeps 1000 MB free on each volume, rechecked each file
+    assert storage.path("a.h264", 400 * MB).startswith(first)
+    assert storage.path("b.h264", 400 * MB).startswith(first)
+    free[first] = 1300 * MB
+    assert storage.path("c.h264", 400 * MB).startswith(second)
+
+    # A volume that is not available has no space
+    storage = Storage([first, os.path.join(first, "missing", "volume")], minfree = 0)
+    assert storage.space(storage.volumes[1]) == 0
+
+
+def test_report(volumes, tmp_path):
+
+    (first, second), free = volumes
+    storage = Storage([first, second], minfree = 0)
+    assert storage.throughput() is None
+    storage.report(os.path.join(first, "video.h264"), 4 * MB, 2.)
+    storage.report(os.path.join(second, "video.h264"), 1 * MB, 1.)
+    storage.report(str(tmp_path / "elsewhere.h264"), 1 * MB, 1.)
+    assert storage.throughput() == 2 * MB
+    assert storage.throughput(second) == 1 * MB
+
+    # Writes of the asynchronous writer are reported
+    writer = AsyncWriter(4096, 4, storage = storage)
+    writer.open(os.path.join(second, "data"))
+    writer.write(b"\0" * 10000)
+    writer.close()
+    assert storage.stats[second][0] == 1 * MB + 10000
+
+
+def test_fallocate(tmp_path):
+
+    # Preallocated space is reserved without changing the size of the file,
+    # and released when the file is closed by the asynchronous writer
+    filename = str(tmp_path / "video.h264")
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT)
+    try:
+        assert not fallocate(fd, 0)
+        if not fallocate(fd, 4 * MB):
+            pytest.skip("Filesystem does not support preallocation")
+        assert os.fstat(fd).st_size == 0
+        assert os.fstat(fd).st_blocks * 512 >= 4 * MB
+    finally:
+        os.close(fd)
+
+    writer = AsyncWriter(4096, 4)
+    writer.open(filename, prealloc = 4 * MB)
+    writer.write(b"\1" * 10000)
+    writer.close()
+    assert os.path.getsize(filename) == 10000
+    assert os.stat(filename).st_blocks * 512 < 1 * MB
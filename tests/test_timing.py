@@ -0,0 +1,132 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the capture schedule of image sequences
+"""
+
+import time
+import pytest
+import threading
+
+import pirecorder.timing
+from pirecorder.timing import Deadlines
+
+
+class Clock(object):
+
+    """A monotonic clock that only advances when slept or moved"""
+
+    def __init__(self):
+
+        self.now = 1000.
+        self.slept = []
+
+
+    def monotonic(self):
+
+        return self.now
+
+
+    def sleep(self, delay):
+
+        self.slept.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(pirecorder.timing, "time", clock)
+    return clock
+
+
+def test_skip(clock):
+
+    deadlines = Deadlines(1, "skip")
+    deadlines.captured()
+    assert deadlines.wait() == 1
+    assert clock.now == 1001
+    deadlines.captured()
+
+    # A slow capture skips the deadlines that passed, up to the nearest one
+    clock.now = 1003.7
+    assert deadlines.remaining() == pytest.approx(0.3)
+    assert deadlines.wait() == 4
+    assert clock.now == pytest.approx(1004)
+    assert deadlines.skipped == 2
+    clock.now = 1004.2
+    assert deadlines.wait() == 5
+    assert clock.now == pytest.approx(1005)
+
+
+def test_catchup(clock):
+
+    deadlines = Deadlines(1, "catchup")
+    deadlines.captured()
+
+    # Deadlines that passed are captured directly, one after the other
+    clock.now = 1003.7
+    assert [deadlines.wait() for _ in range(3)] == [1, 2, 3]
+    assert clock.slept == []
+    assert deadlines.wait() == 4
+    assert clock.now == pytest.approx(1004)
+    assert deadlines.skipped == 0
+
+
+def test_captured_and_summary(clock, tmp_path):
+
+    logfile = str(tmp_path / "timing.csv")
+    deadlines = Deadlines(0.5, "skip", logfile)
+    with pytest.raises(ValueError):
+        Deadlines(0.5, "never")
+
+    # The lateness of each capture is measured from its deadline, also when
+    # the time of capture is given
+    late = [0.001 * (i % 100) for i in range(200)]
+    for i in range(200):
+        clock.now = deadlines.start + deadlines.interval * i + late[i]
+        deadlines.captured()
+        deadlines.frame += 1
+    deadlines.captured(deadlines.start + 100.25)
+    deadlines.close()
+
+    summary = deadlines.summary()
+    assert summary["captures"] == 201
+    assert summary["skipped"] == 0
+    assert summary["p50"] == pytest.approx(0.05)
+    assert summary["p99"] == pytest.approx(0.099)
+    assert summary["max"] == pytest.approx(0.25)
+    assert summary["rate"] == pytest.approx(200 / 100.25)
+
+    lines = open(logfile).read().splitlines()
+    assert lines[0].startswith("# start ")
+    assert lines[1] == "frame,target,actual,lateness"
+    assert len(lines) == 203
+    assert lines[-1] == "200,100.000000,100.250000,0.250000"
+
+
+def test_stop():
+
+    # A set stop event ends the wait for the next capture directly
+    stop = threading.Event()
+    deadlines = Deadlines(60, stop = stop)
+    deadlines.captured()
+    threading.Timer(0.05, stop.set).start()
+    start = time.monotonic()
+    assert deadlines.wait() is None
+    assert time.monotonic() - start < 5
+    assert deadlines.frame == 0
+    assert Deadlines(1).summary()["captures"] == 0
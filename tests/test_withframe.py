@@ -0,0 +1,91 @@
+"""
+Copyright (c) 2019 - 2025 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of converting videos with frame numbers drawn by the threaded pipeline
+"""
+
+import os
+import cv2
+import shutil
+import pytest
+import threading
+import numpy as np
+
+from pirecorder.h264 import framecount
+from pirecorder.convert import Convert, framerate
+from pirecorder.sidecar import FRAMES, sidecarname
+from conftest import decodedframes
+
+
+def test_framerate():
+
+    assert framerate([0, 100000, 200000, 300000]) == 10
+    assert framerate([-1, 0, 40000, -1, 80000]) == 25
+    assert framerate([5, 5, 5]) == 24
+    assert framerate([], None) is None
+
+
+def withframe(video, tmp_path, fps = None):
+
+    indir = tmp_path / "in"
+    indir.mkdir()
+    shutil.copy(video, str(indir))
+    if fps is not None:
+        records = np.zeros(framecount(video), FRAMES)
+        records["index"] = np.arange(len(records))
+        records["timestamp"] = np.arange(len(records)) * 1000000 // fps
+        records.tofile(sidecarname(str(indir / "sim.h264")))
+    Convert(str(indir), str(tmp_path / "out"), withframe = True, pools = 1)
+
+    return str(tmp_path / "out" / "sim.mp4")
+
+
+def test_conv_frames(video, tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    fileout = withframe(video, tmp_path)
+
+    # Every frame is converted, at a valid framerate although raw h264
+    # videos do not store their framerate
+    assert len(decodedframes(fileout)) == framecount(video)
+    vid = cv2.VideoCapture(fileout)
+    assert vid.get(cv2.CAP_PROP_FPS) > 0
+    vid.release()
+    assert os.listdir(str(tmp_path / "out")) == ["sim.mp4"]
+
+
+def test_conv_frames_sidecar_fps(video, tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    fileout = withframe(video, tmp_path, fps = 10)
+
+    assert len(decodedframes(fileout)) == framecount(video)
+    vid = cv2.VideoCapture(fileout)
+    assert round(vid.get(cv2.CAP_PROP_FPS)) == 10
+    vid.release()
+
+
+def test_conv_frames_error(video, tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "empty").mkdir()
+    converter = Convert(str(tmp_path / "empty"), withframe = True,
+                        resizeval = 0.001, prefetch = 2)
+    threads = threading.active_count()
+
+    # An error in a stage is raised instead of leaving the others waiting
+    with pytest.raises(cv2.error):
+        converter.conv_frames(video, str(tmp_path / "out.mp4"))
+    assert threading.active_count() == threads